@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+# Saving files that have to survive the power being cut at any moment
+
+import os
+import contextlib
+
+@contextlib.contextmanager
+def atomicWrite(path, mode = 'w'):
+	"""Open a file to replace path with, in one go once the block ends.
+
+	Written aside and renamed, so a power cut never leaves half a file:
+	the data goes to path + '.tmp' and is synced to disk before it's
+	renamed over path.  If the block raises, path is left as it was.
+	"""
+	temp_path = path + '.tmp'
+	try:
+		with open(temp_path, mode) as f:
+			yield f
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(temp_path, path)
+	except BaseException:
+		with contextlib.suppress(OSError):
+			os.remove(temp_path)
+		raise
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+# Audio input for the audio-reactive mode: PCM from a FIFO, a TCP socket or a
+# WAV file, cut into blocks and turned into per-band levels with a windowed
+# FFT.  Run directly to time the analysis against a WAV file:
+#
+#   ./audio.py song.wav
+
+import os
+import sys
+import json
+import math
+import time
+import wave
+import asyncio
+import argparse
+import numpy as np
+
+from instrument import Instruments
+
+# Raw PCM from a FIFO or socket is 16-bit little-endian mono at this rate
+AUDIO_RATE = 44100
+AUDIO_SAMPLE_BYTES = 2
+
+# Where the audio comes from: a .wav file (played in real time), 'tcp:PORT'
+# to listen for a stream on localhost, or the path of a FIFO to read
+AUDIO_SOURCE = os.environ.get('PARTYMODE_AUDIO', '/tmp/partymode.audio')
+
+# Samples per block (23 ms at 44.1 kHz), and the FFT window ending at each one
+AUDIO_BLOCK = 1024
+AUDIO_FFT_SIZE = 2048
+
+# Log-spaced bands between these frequencies
+AUDIO_BANDS = 16
+AUDIO_MIN_HZ = 40.0
+AUDIO_MAX_HZ = 16000.0
+
+# Levels are scaled to the loudest band seen lately: the top AUDIO_DYNAMIC_RANGE
+# dB below it map to 0..1.  The reference falls AUDIO_PEAK_DECAY dB a second
+# after loud passages, but never below AUDIO_QUIET_DB (full-scale sine = 0 dB)
+# so that silence stays dark.
+AUDIO_DYNAMIC_RANGE = 40.0
+AUDIO_PEAK_DECAY = 6.0
+AUDIO_QUIET_DB = -50.0
+# Levels jump up at once but fall away with this time constant
+AUDIO_RELEASE_TIME = 0.15
+
+# Bytes read from the source at a time
+AUDIO_READ_SIZE = 16384
+
+class BandAnalyzer:
+	"""Band levels of the last AUDIO_FFT_SIZE samples.
+
+	push() shifts new samples into a fixed window; analyze() runs a Hann
+	windowed real FFT over it and averages the power in each band.
+	"""
+	def __init__(self, rate = AUDIO_RATE, fft_size = AUDIO_FFT_SIZE, bands = AUDIO_BANDS):
+		self.rate = rate
+		self.fft_size = fft_size
+		self.window = np.hanning(fft_size).astype(np.float32)
+		# A full-scale sine comes out at 0 dB
+		self.scale = 4.0 / float(self.window.sum()) ** 2
+		self.samples = np.zeros(fft_size, dtype=np.float32)
+		edges = np.geomspace(AUDIO_MIN_HZ, min(AUDIO_MAX_HZ, 0.5 * rate), bands + 1)
+		bins = np.round(edges * fft_size / rate).astype(np.int64)
+		for i in range(1, len(bins)):
+			# Every band gets at least one bin
+			bins[i] = max(bins[i], bins[i - 1] + 1)
+		self.bins = bins
+		self.bin_counts = np.diff(bins).astype(np.float32)
+		self.peak = AUDIO_QUIET_DB
+		self.levels = np.zeros(bands, dtype=np.float32)
+
+	def push(self, samples):
+		n = min(len(samples), self.fft_size)
+		self.samples[:-n] = self.samples[n:]
+		self.samples[-n:] = samples[-n:]
+
+	def analyze(self, elapsed):
+		"""Update and return `levels` (0-1 per band) after `elapsed` seconds of new audio."""
+		spectrum = np.fft.rfft(self.samples * self.window)
+		power = spectrum.real ** 2 + spectrum.imag ** 2
+		energy = np.add.reduceat(power[:self.bins[-1]], self.bins[:-1]) / self.bin_counts
+		db = 10.0 * np.log10(energy * self.scale + 1e-12)
+		self.peak = max(float(db.max()), self.peak - AUDIO_PEAK_DECAY * elapsed, AUDIO_QUIET_DB)
+		levels = np.clip((db - (self.peak - AUDIO_DYNAMIC_RANGE)) / AUDIO_DYNAMIC_RANGE, 0.0, 1.0)
+		self.levels = np.maximum(levels, self.levels * math.exp(-elapsed / AUDIO_RELEASE_TIME)).astype(np.float32)
+		return self.levels
+
+def toSamples(data, channels = 1):
+	"""16-bit little-endian PCM bytes -> float32 mono samples in -1..1."""
+	samples = np.frombuffer(data, dtype='<i2').astype(np.float32) * (1.0 / 32768)
+	if channels > 1:
+		samples = samples.reshape(-1, channels).mean(axis=1)
+	return samples
+
+class AudioInput:
+	"""Reads PCM from `source` on the event loop and keeps `levels` up to date.
+
+	Data is handled as it arrives, in whole blocks: however many blocks one
+	read brings, their samples are all shifted into the window but only the
+	newest is analyzed, so a backlog never builds up and the levels are
+	never more than a block behind.  Only the part-block left over is kept
+	between reads.  `listener` is called after every analysis.
+
+	'audio.analysis' in `instruments` is the time from a read arriving to
+	its levels being ready, and 'audio.latency' from it arriving to the
+	levels being drawn (see rendered()).
+	"""
+	def __init__(self, source = AUDIO_SOURCE, instruments = None, listener = None):
+		self.source = source
+		self.instruments = Instruments() if instruments is None else instruments
+		self.listener = listener
+		self.analyzer = BandAnalyzer()
+		self.channels = 1
+		self.pending = bytearray()
+		self.arrival = None               # perf_counter() time the data behind `levels` arrived
+		self.drawn = None
+		self.blocks = 0
+		self.analyzed = 0
+		self.task = None
+
+	@property
+	def levels(self):
+		return self.analyzer.levels
+
+	def start(self):
+		self.task = asyncio.get_running_loop().create_task(self._run(), name='audio')
+
+	def stop(self):
+		if self.task is not None:
+			self.task.cancel()
+			self.task = None
+
+	def _setFormat(self, rate, channels):
+		if rate != self.analyzer.rate:
+			self.analyzer = BandAnalyzer(rate)
+		self.channels = channels
+		self.pending.clear()
+
+	def feed(self, data, arrival = None):
+		"""Take in PCM bytes; returns the new levels, or None if there wasn't a whole block yet."""
+		arrival = time.perf_counter() if arrival is None else arrival
+		self.pending += data
+		block_bytes = AUDIO_BLOCK * AUDIO_SAMPLE_BYTES * self.channels
+		blocks = len(self.pending) // block_bytes
+		if not blocks:
+			return None
+		used = blocks * block_bytes
+		self.analyzer.push(toSamples(self.pending[:used], self.channels))
+		del self.pending[:used]
+		levels = self.analyzer.analyze(blocks * AUDIO_BLOCK / float(self.analyzer.rate))
+		self.blocks += blocks
+		self.analyzed += 1
+		self.arrival = arrival
+		self.instruments.record('audio.analysis', time.perf_counter() - arrival)
+		if self.listener is not None:
+			self.listener()
+		return levels
+
+	def rendered(self):
+		"""Called by the renderer once it has drawn the current levels."""
+		if self.arrival is not None and self.drawn != self.arrival:
+			self.instruments.record('audio.latency', time.perf_counter() - self.arrival)
+			self.drawn = self.arrival
+
+	async def _run(self):
+		try:
+			if self.source.endswith('.wav'):
+				await self._playWav(self.source)
+			elif self.source.startswith('tcp:'):
+				await self._listen(int(self.source[len('tcp:'):]))
+			else:
+				await self._readFifo(self.source)
+		except (OSError, ValueError, wave.Error) as e:
+			print("Audio input %s failed: %s" % (self.source, e))
+
+	async def _consume(self, reader):
+		while True:
+			data = await reader.read(AUDIO_READ_SIZE)
+			if not data:
+				return
+			self.feed(data)
+
+	async def _readFifo(self, path):
+		if not os.path.exists(path):
+			os.mkfifo(path)
+		# Opened for writing as well, so that there's always a writer and
+		# reads wait for data instead of hitting EOF between senders
+		pipe = os.fdopen(os.open(path, os.O_RDWR | os.O_NONBLOCK), 'rb', buffering = 0)
+		loop = asyncio.get_running_loop()
+		reader = asyncio.StreamReader(limit = AUDIO_READ_SIZE)
+		transport, protocol = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+		try:
+			await self._consume(reader)
+		finally:
+			transport.close()
+
+	async def _listen(self, port):
+		async def client(reader, writer):
+			self._setFormat(AUDIO_RATE, 1)
+			try:
+				await self._consume(reader)
+			finally:
+				writer.close()
+		server = await asyncio.start_server(client, '127.0.0.1', port)
+		async with server:
+			await server.serve_forever()
+
+	async def _playWav(self, path):
+		# Fed in real time, as if it were coming down a pipe
+		with wave.open(path, 'rb') as wav:
+			if wav.getsampwidth() != AUDIO_SAMPLE_BYTES:
+				raise ValueError("%s isn't 16-bit PCM" % path)
+			self._setFormat(wav.getframerate(), wav.getnchannels())
+			started = time.monotonic()
+			played = 0
+			while True:
+				data = wav.readframes(AUDIO_BLOCK)
+				if not data:
+					return
+				self.feed(data)
+				played += AUDIO_BLOCK
+				await asyncio.sleep(max(0.0, started + played / float(self.analyzer.rate) - time.monotonic()))
+
+	def stats(self):
+		return {
+			'source': self.source,
+			'rate': self.analyzer.rate,
+			'blocks': self.blocks,
+			'analyzed': self.analyzed,
+			'peak_db': self.analyzer.peak,
+		}
+
+def analyzeWav(path):
+	"""Run a WAV file through the analysis as fast as it will go.
+
+	Returns (levels, seconds) arrays with one row/entry per block.
+	"""
+	with wave.open(path, 'rb') as wav:
+		if wav.getsampwidth() != AUDIO_SAMPLE_BYTES:
+			raise ValueError("%s isn't 16-bit PCM" % path)
+		audio = AudioInput(path)
+		audio._setFormat(wav.getframerate(), wav.getnchannels())
+		levels = []
+		costs = []
+		while True:
+			data = wav.readframes(AUDIO_BLOCK)
+			if len(data) < AUDIO_BLOCK * AUDIO_SAMPLE_BYTES * audio.channels:
+				break
+			started = time.perf_counter()
+			levels.append(audio.feed(data, started).copy())
+			costs.append(time.perf_counter() - started)
+	return np.array(levels), np.array(costs)
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Time the audio analysis on a WAV file')
+	parser.add_argument('path', help = '16-bit PCM WAV file')
+	parser.add_argument('--levels', action = 'store_true', help = 'print every block\'s band levels too')
+	args = parser.parse_args()
+
+	levels, costs = analyzeWav(args.path)
+	if not len(costs):
+		print("%s is shorter than one block" % args.path)
+		return 1
+	with wave.open(args.path, 'rb') as wav:
+		block_time = AUDIO_BLOCK / float(wav.getframerate())
+	if args.levels:
+		for row in levels:
+			print(' '.join('%.2f' % level for level in row))
+	print(json.dumps({
+		'blocks': len(costs),
+		'block_ms': 1e3 * block_time,
+		'mean_us': 1e6 * costs.mean(),
+		'p99_us': 1e6 * np.percentile(costs, 99),
+		'max_us': 1e6 * costs.max(),
+		'realtime_factor': block_time / costs.mean(),
+	}, indent = 1))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
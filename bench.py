@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+# Headless benchmarks for the LED code, run against mockstrip.py so they work
+# on any machine.  Results are written as JSON; given a baseline from an
+# earlier run, any metric that got worse by more than the threshold fails
+# the run.
+#
+#   ./bench.py -o before.json
+#   ./bench.py --baseline before.json --threshold 0.25
+
+import os
+os.environ.setdefault('PARTYMODE_MOCK_STRIP', '1')
+
+import sys
+import json
+import time
+import math
+import random
+import asyncio
+import argparse
+import datetime
+import platform
+import numpy as np
+
+import mockstrip
+import server
+from leds import *
+from modes import *
+from protocol import *
+from sunsky import SkyLight, SkyLightTable, SunPositionCache
+
+LED_COUNTS = (240, 1000, 2500, 5000)
+FRAMES = 200
+MICRO_TIME = 0.2
+SERVER_COMMANDS = 2000
+
+# Metrics in these units are better when higher; everything else is a time
+HIGHER_IS_BETTER = ('cmd/s', 'fps')
+
+class FixedSun:
+	"""Stands in for SunPositionCache with the sun parked at one spot."""
+	def __init__(self, altitude, azimuth = 180.0, longitude = 0.0):
+		self.altitude = altitude
+		self.azimuth = azimuth
+		self.longitude = longitude
+
+	def position(self, date):
+		return self.altitude, self.azimuth
+
+def benchRenderers():
+	sky = SkyLight()
+	table = SkyLightTable.build((MODE_SKYLIGHT_TURBIDITY,))
+	return {
+		'off': lambda count: SolidRenderer(0x000000),
+		'solid': lambda count: SolidRenderer(0xFF8000),
+		'white': lambda count: SolidRenderer(getWhite(2900)),
+		'kelvin': lambda count: KelvinRampRenderer(KelvinRamp(1900, 6500, 3600)),
+		'easter': lambda count: EasterRenderer(),
+		'christmas': lambda count: ChristmasRenderer(),
+		'rainbow': lambda count: RainbowRenderer(),
+		'romantic': lambda count: RomanticRenderer(),
+		'skylight_night': lambda count: SkylightRenderer(FixedSun(-20.0), table),
+		'skylight_dusk': lambda count: SkylightRenderer(FixedSun(-3.0), table),
+		'skylight_day': lambda count: SkylightRenderer(FixedSun(30.0), table),
+		'skylight_day_analytic': lambda count: SkylightRenderer(FixedSun(30.0), sky),
+	}
+
+def frameCost(renderer, count, frames = FRAMES):
+	"""Time render + push of `frames` frames on a mock strip of `count` LEDs.
+
+	Returns per-frame times in seconds.  Every frame is pushed, changed or
+	not, so the numbers are the worst case for each mode.
+	"""
+	strip = mockstrip.PixelStrip(count, LED_PIN, timing = False)
+	strip.begin()
+	frame = FrameBuffer(strip)
+	interval = renderer.interval or 0.1
+	renderer.start(0.0)
+	costs = np.empty(frames)
+	for i in range(frames):
+		started = time.perf_counter()
+		renderer.render(frame, i * interval)
+		frame.push()
+		strip.show()
+		costs[i] = time.perf_counter() - started
+	return costs
+
+def timeCall(function, min_time = MICRO_TIME):
+	"""Best-of-three seconds per call of function()."""
+	calls = 1
+	while True:
+		started = time.perf_counter()
+		for _ in range(calls):
+			function()
+		elapsed = time.perf_counter() - started
+		if elapsed >= min_time / 10:
+			break
+		calls *= 10
+	best = elapsed
+	for _ in range(2):
+		started = time.perf_counter()
+		for _ in range(calls):
+			function()
+		best = min(best, time.perf_counter() - started)
+	return best / calls
+
+def benchModes(metrics, counts):
+	renderers = benchRenderers()
+	for count in counts:
+		wire = mockstrip.transferTime(count, LED_FREQ_HZ)
+		metrics['wire.%d' % count] = (1e6 * wire, 'us')
+		for name, make in renderers.items():
+			costs = frameCost(make(count), count)
+			metrics['mode.%s.%d.mean' % (name, count)] = (1e6 * costs.mean(), 'us')
+			metrics['mode.%s.%d.p99' % (name, count)] = (1e6 * np.percentile(costs, 99), 'us')
+			# The driver sends in the background, so whichever is slower sets the pace
+			metrics['mode.%s.%d.max_rate' % (name, count)] = (1.0 / max(costs.mean(), wire), 'fps')
+
+def benchFunctions(metrics):
+	strip = mockstrip.PixelStrip(LED_COUNT, LED_PIN, timing = False)
+	strip.begin()
+	frame = FrameBuffer(strip)
+	sky = SkyLight()
+	sun = SunPositionCache(server.LATITUDE, server.LONGITUDE)
+	now = datetime.datetime.now(datetime.timezone.utc)
+	theta = np.linspace(MODE_SKYLIGHT_HORIZON_ANGLE, 0.0, LED_COUNT)
+	gamma = SkyLight.angleToSun(theta, MODE_SKYLIGHT_VIEW_AZIMUTH, math.radians(60), math.radians(180))
+	functions = {
+		'setColor': lambda: setColor(strip, 0xFF8000),
+		'rainbowFrame': lambda: rainbowFrame(frame.pixels, 17),
+		'frame.output': frame.output,
+		'frame.show': lambda: (frame.invalidate(), frame.show()),
+		'getWhite': lambda: getWhite(random.randint(1000, 10000)),
+		'correctColor': lambda: correctColor()(0xFF8000),
+		'gammaTable': lambda: gammaTable(2.0),
+		'SkyLight.skyRGB': lambda: sky.skyRGB(MODE_SKYLIGHT_TURBIDITY, 1.0, 0.5, math.radians(60)),
+		'SkyLight.skyRGBArray': lambda: sky.skyRGBArray(MODE_SKYLIGHT_TURBIDITY, theta, gamma, math.radians(60)),
+		'SunPositionCache.position': lambda: sun.position(now),
+	}
+	for name, function in functions.items():
+		metrics['function.%s' % name] = (1e6 * timeCall(function), 'us')
+
+async def _readMessages(reader, buffer, wanted):
+	# Read until `wanted` framed messages have arrived
+	seen = 0
+	while seen < wanted:
+		message, used = decodeMessage(buffer)
+		if message is None:
+			data = await reader.read(65536)
+			if not data:
+				raise ConnectionError("Server closed the connection")
+			buffer += data
+			continue
+		del buffer[:used]
+		seen += 1
+
+async def _benchServer(metrics, commands):
+	handler = server.LEDServerHandler()
+	loop = asyncio.get_running_loop()
+	listener = await loop.create_server(lambda: server.LEDServerProtocol(handler), server.LOCALHOST, 0)
+	engine = loop.create_task(handler.engine.run())
+	port = listener.sockets[0].getsockname()[1]
+	reader, writer = await asyncio.open_connection(server.LOCALHOST, port)
+	buffer = bytearray()
+	modes = [b'a', b'x', b'e', b'r']
+
+	# One command at a time: each waits for the previous ACK
+	started = time.perf_counter()
+	for seq in range(commands):
+		writer.write(encodeCommand(seq, b'm', modes[seq % len(modes)]))
+		await _readMessages(reader, buffer, 1)
+	elapsed = time.perf_counter() - started
+	metrics['server.roundtrip'] = (1e6 * elapsed / commands, 'us')
+	metrics['server.sequential'] = (commands / elapsed, 'cmd/s')
+
+	# Pipelined: everything written up front, as a busy client would
+	started = time.perf_counter()
+	for seq in range(commands):
+		writer.write(encodeCommand(seq, b'b', (b'f', b'm', b'd')[seq % 3]))
+	await writer.drain()
+	await _readMessages(reader, buffer, commands)
+	elapsed = time.perf_counter() - started
+	metrics['server.pipelined'] = (commands / elapsed, 'cmd/s')
+
+	writer.close()
+	engine.cancel()
+	listener.close()
+	await listener.wait_closed()
+
+def benchServer(metrics, commands = SERVER_COMMANDS):
+	asyncio.run(_benchServer(metrics, commands))
+
+def compare(results, baseline, threshold):
+	"""Print how results moved against baseline; returns the regressed metric names."""
+	regressions = []
+	for name, current in sorted(results['metrics'].items()):
+		previous = baseline['metrics'].get(name)
+		if previous is None or not previous['value']:
+			continue
+		change = current['value'] / previous['value'] - 1.0
+		if current['unit'] in HIGHER_IS_BETTER:
+			change = -change
+		flag = ''
+		if change > threshold:
+			regressions.append(name)
+			flag = '  REGRESSION'
+		print("%-45s %12.2f -> %12.2f %-6s %+7.1f%%%s" % \
+		      (name, previous['value'], current['value'], current['unit'], 100 * change, flag))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Benchmark the LED modes, helpers and server on a simulated strip')
+	parser.add_argument('-o', '--output', help = 'write the results to this JSON file')
+	parser.add_argument('-n', '--count', type = int, action = 'append', help = 'LED count to test (repeatable, default %s)' % \
+	                    ', '.join(str(count) for count in LED_COUNTS))
+	parser.add_argument('--only', choices = ('modes', 'functions', 'server'), action = 'append', help = 'run just these benchmarks (repeatable)')
+	parser.add_argument('--baseline', help = 'earlier results to compare against')
+	parser.add_argument('--threshold', type = float, default = 0.25, help = 'fail if a metric is worse than the baseline by this fraction')
+	args = parser.parse_args()
+
+	only = set(args.only or ('modes', 'functions', 'server'))
+	counts = tuple(args.count) if args.count else LED_COUNTS
+	random.seed(0)
+	np.random.seed(0)
+
+	metrics = {}
+	if 'modes' in only:
+		benchModes(metrics, counts)
+	if 'functions' in only:
+		benchFunctions(metrics)
+	if 'server' in only:
+		benchServer(metrics)
+
+	results = {
+		'meta': {
+			'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+			'host': platform.node(),
+			'machine': platform.machine(),
+			'python': platform.python_version(),
+			'numpy': np.__version__,
+			'led_counts': list(counts),
+		},
+		'metrics': {name: {'value': value, 'unit': unit} for name, (value, unit) in metrics.items()},
+	}
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent = 1, sort_keys = True)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		regressions = compare(results, baseline, args.threshold)
+		if regressions:
+			print("%d metric(s) regressed by more than %d%%" % (len(regressions), 100 * args.threshold))
+			return 1
+	else:
+		for name, (value, unit) in sorted(metrics.items()):
+			print("%-45s %12.2f %s" % (name, value, unit))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Color temperature -> LED color.  Whites are computed from Planck's law
+# integrated against the CIE 1931 observer, tabulated on first use, and
+# looked up in O(1).
+
+import functools
+import numpy as np
+
+from leds import LED_PURE_WHITE_CORRECTION, packRGB
+
+KELVIN_MIN = 1000
+KELVIN_MAX = 40000
+KELVIN_STEP = 10
+
+# Analytic fit to the CIE 1931 2-degree color matching functions, from
+# "Simple Analytic Approximations to the CIE XYZ Color Matching Functions",
+# Wyman, Sloan and Shirley, 2013.  Each lobe is (weight, mean, sigma below
+# the mean, sigma above the mean), wavelengths in nm.
+CIE_LOBES_X = ((1.056, 599.8, 37.9, 31.0), (0.362, 442.0, 16.0, 26.7), (-0.065, 501.1, 20.4, 26.2))
+CIE_LOBES_Y = ((0.821, 568.8, 46.9, 40.5), (0.286, 530.9, 16.3, 31.1))
+CIE_LOBES_Z = ((1.217, 437.0, 11.8, 36.0), (0.681, 459.0, 26.0, 13.8))
+
+XYZ_TO_LINEAR_SRGB = np.array([ \
+	[3.2406,	-1.5372,	-0.4986], \
+	[-0.9689,	1.8758,		0.0415], \
+	[0.0557,	-0.2040,	1.0570]])
+
+def _cieMatching(wavelengths, lobes):
+	total = np.zeros_like(wavelengths)
+	for weight, mean, sigma_below, sigma_above in lobes:
+		sigma = np.where(wavelengths < mean, sigma_below, sigma_above)
+		total += weight * np.exp(-0.5 * ((wavelengths - mean) / sigma) ** 2)
+	return total
+
+def blackbodyRGB(kelvin):
+	"""sRGB color (0-1, brightest channel at 1) of a blackbody at each temperature."""
+	kelvin = np.asarray(kelvin, dtype=np.float64)
+	wavelengths = np.arange(380.0, 781.0, 5.0)
+	cmf = np.stack([_cieMatching(wavelengths, lobes) for lobes in (CIE_LOBES_X, CIE_LOBES_Y, CIE_LOBES_Z)])
+
+	# Planck's law, up to a constant factor that the normalization below removes
+	second_radiation_constant = 1.4387769e7  # hc/k in nm K
+	meters = wavelengths * 1e-9
+	radiance = 1.0 / (meters ** 5 * np.expm1(second_radiation_constant / (wavelengths * kelvin[..., np.newaxis])))
+
+	rgb = (radiance @ cmf.T) @ XYZ_TO_LINEAR_SRGB.T
+	rgb = np.maximum(rgb, 0.0)
+	rgb /= rgb.max(axis=-1, keepdims=True)
+	return np.where(rgb <= 0.0031308, 12.92 * rgb, 1.055 * np.power(rgb, 1.0 / 2.4) - 0.055)
+
+@functools.lru_cache(maxsize = None)
+def kelvinTable():
+	"""White-balanced 0xRRGGBB color for every KELVIN_STEP from KELVIN_MIN to KELVIN_MAX."""
+	kelvin = np.arange(KELVIN_MIN, KELVIN_MAX + KELVIN_STEP, KELVIN_STEP)
+	correction = np.array([(LED_PURE_WHITE_CORRECTION >> 16) & 0xff, \
+	                       (LED_PURE_WHITE_CORRECTION >> 8) & 0xff, \
+	                       LED_PURE_WHITE_CORRECTION & 0xff]) / 255.0
+	rgb = (blackbodyRGB(kelvin) * correction * 255.0 + 0.5).astype(np.uint32)
+	return packRGB(rgb[:, 0], rgb[:, 1], rgb[:, 2])
+
+def clampKelvin(temp):
+	"""temp limited to the KELVIN_MIN..KELVIN_MAX range there are colors for."""
+	return min(max(temp, KELVIN_MIN), KELVIN_MAX)
+
+def getWhite(temp):
+	"""Return the (white-corrected) color for a temperature in Kelvin."""
+	temp = clampKelvin(temp)
+	return int(kelvinTable()[int((temp - KELVIN_MIN) / KELVIN_STEP + 0.5)])
+
+class KelvinRamp:
+	"""A fade between two color temperatures over `duration` seconds.
+
+	The ramp is linear in mireds (1e6 / K), which is much closer to how the
+	change is perceived than a linear ramp in Kelvin.
+	"""
+	def __init__(self, start_kelvin, end_kelvin, duration):
+		self.start_mired = 1e6 / start_kelvin
+		self.end_mired = 1e6 / end_kelvin
+		self.duration = duration
+
+	def kelvin(self, elapsed):
+		progress = min(max(elapsed / self.duration, 0.0), 1.0) if self.duration > 0 else 1.0
+		return 1e6 / (self.start_mired + progress * (self.end_mired - self.start_mired))
+
+	def color(self, elapsed):
+		return getWhite(self.kelvin(elapsed))
+
+	def done(self, elapsed):
+		return elapsed >= self.duration
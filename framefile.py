@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Recorded frame sequences: animations rendered ahead of time (or captured)
+# and played back by memory-mapping the file, so replaying costs a copy per
+# frame.  Record one offline with e.g.
+#
+#   ./framefile.py record skylight replay.pmf --seconds 600 --count 240
+#   ./framefile.py info replay.pmf
+#
+# The file is a FRAME_HEADER followed by frame count * LED count
+# little-endian uint32 0xRRGGBB pixels, frame after frame.
+
+import os
+import sys
+import time
+import struct
+import argparse
+import numpy as np
+
+from leds import PixelArray
+from modes import *
+
+FRAME_MAGIC = b'PMFR'
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct('<4sHHIIf')   # magic, version, header size, LED count, frame count, frames/second
+FRAME_DTYPE = np.dtype('<u4')
+
+class FrameWriter:
+	"""Writes a frame sequence one frame at a time."""
+	def __init__(self, path, count, frame_rate):
+		self.path = path
+		self.count = count
+		self.frame_rate = frame_rate
+		self.frames = 0
+		self.file = open(path, 'wb')
+		self.file.write(self._header())
+
+	def _header(self):
+		return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_HEADER.size, self.count, self.frames, self.frame_rate)
+
+	def write(self, pixels):
+		pixels = np.asarray(pixels, dtype=FRAME_DTYPE)
+		if pixels.shape != (self.count,):
+			raise ValueError("Frame has %d pixels, not %d" % (pixels.size, self.count))
+		self.file.write(pixels.tobytes())
+		self.frames += 1
+
+	def close(self):
+		# The frame count isn't known until the end
+		self.file.seek(0)
+		self.file.write(self._header())
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+class FrameSequence:
+	"""A frame sequence file, memory-mapped: `frames` is (frame count, LED count)."""
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			header = f.read(FRAME_HEADER.size)
+		if len(header) < FRAME_HEADER.size:
+			raise ValueError("%s is too short to be a frame sequence" % path)
+		magic, version, header_size, count, frames, frame_rate = FRAME_HEADER.unpack(header)
+		if magic != FRAME_MAGIC or version != FRAME_VERSION:
+			raise ValueError("%s isn't a version %d frame sequence" % (path, FRAME_VERSION))
+		if frames <= 0 or count <= 0 or frame_rate <= 0:
+			raise ValueError("%s is empty" % path)
+		self.path = path
+		self.count = count
+		self.frame_rate = frame_rate
+		self.frames = np.memmap(path, dtype=FRAME_DTYPE, mode='r', offset=header_size, shape=(frames, count))
+
+	def __len__(self):
+		return len(self.frames)
+
+	@property
+	def duration(self):
+		return len(self) / self.frame_rate
+
+class ReplayRenderer(Renderer):
+	"""Plays a FrameSequence at its own frame rate, looping or holding the last frame.
+
+	A sequence recorded for a different LED count is cut short or padded
+	with black.
+	"""
+	def __init__(self, sequence, loop = True):
+		self.sequence = sequence
+		self.loop = loop
+		self.interval = 1.0 / sequence.frame_rate
+
+	def render(self, frame, now):
+		index = int(round((now - self.start_time) * self.sequence.frame_rate))
+		if self.loop:
+			index %= len(self.sequence)
+		elif index >= len(self.sequence) - 1:
+			index = len(self.sequence) - 1
+			self.interval = None
+		n = min(len(frame), self.sequence.count)
+		frame.pixels[:n] = self.sequence.frames[index, :n]
+		frame.pixels[n:] = 0
+
+def record(renderer, path, count, seconds, frame_rate = None):
+	"""Render `seconds` of renderer into a frame sequence; returns the frame count.
+
+	Frames are drawn at the renderer's own interval unless frame_rate is
+	given; a mode that never changes is recorded as one frame.
+	"""
+	if frame_rate is None:
+		frame_rate = 1.0 / renderer.interval if renderer.interval else 1.0
+	pixels = PixelArray(np.zeros(count, dtype=np.uint32))
+	renderer.start(0.0)
+	with FrameWriter(path, count, frame_rate) as writer:
+		frames = max(1, int(round(seconds * frame_rate))) if renderer.interval else 1
+		for i in range(frames):
+			renderer.render(pixels, i / frame_rate)
+			writer.write(pixels.pixels)
+	return frames
+
+def main():
+	import server
+	from sunsky import SkyLightTable, SunPositionCache
+
+	makers = {
+		'rainbow': RainbowRenderer,
+		'romantic': RomanticRenderer,
+		'christmas': ChristmasRenderer,
+		'easter': EasterRenderer,
+		# The sky from now on, whatever speed it's recorded at
+		'skylight': lambda: SkylightRenderer(SunPositionCache(server.LATITUDE, server.LONGITUDE), \
+		                                     SkyLightTable.cached(server.SKYLIGHT_TABLE_PATH, (MODE_SKYLIGHT_TURBIDITY,)), \
+		                                     epoch = time.time()),
+	}
+	parser = argparse.ArgumentParser(description = 'Record or inspect frame sequences for replay mode')
+	commands = parser.add_subparsers(dest = 'command', required = True)
+	recorder = commands.add_parser('record', help = 'render a mode into a frame sequence')
+	recorder.add_argument('mode', choices = sorted(makers))
+	recorder.add_argument('path')
+	recorder.add_argument('--count', type = int, default = LED_COUNT, help = 'LEDs per frame (default %d)' % LED_COUNT)
+	recorder.add_argument('--seconds', type = float, default = 10.0)
+	recorder.add_argument('--rate', type = float, help = 'frames per second (default: the mode\'s own)')
+	info = commands.add_parser('info', help = 'describe a frame sequence')
+	info.add_argument('path')
+	args = parser.parse_args()
+
+	if args.command == 'record':
+		frames = record(makers[args.mode](), args.path, args.count, args.seconds, args.rate)
+		print("Wrote %d frames to %s (%d bytes)" % (frames, args.path, os.path.getsize(args.path)))
+	else:
+		sequence = FrameSequence(args.path)
+		print("%d frames of %d LEDs at %.2f frames/s (%.1f s)" % \
+		      (len(sequence), sequence.count, sequence.frame_rate, sequence.duration))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
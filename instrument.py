@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Runtime instrumentation for the LED server: cheap latency histograms that
+# are always on, plus an optional cProfile session.
+
+import io
+import time
+
+class Histogram:
+	"""Latency histogram with power-of-two microsecond buckets.
+
+	Bucket i counts samples below 2**i microseconds (and at least half
+	that), so record() is a few integer operations and cheap enough to call
+	on every frame.  Percentiles are reported as the upper edge of their
+	bucket, i.e. to within a factor of two.
+	"""
+	BUCKETS = 32
+
+	def __init__(self):
+		self.counts = [0] * self.BUCKETS
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def record(self, seconds):
+		micros = int(seconds * 1e6)
+		self.counts[min(micros.bit_length(), self.BUCKETS - 1) if micros > 0 else 0] += 1
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	def percentile(self, fraction):
+		"""Upper bound, in microseconds, of the given fraction of samples."""
+		threshold = fraction * self.count
+		seen = 0
+		for bucket, count in enumerate(self.counts):
+			seen += count
+			if count and seen >= threshold:
+				return float(1 << bucket)
+		return 0.0
+
+	def summary(self):
+		return {
+			'count': self.count,
+			'mean_us': 1e6 * self.total / self.count if self.count else 0.0,
+			'max_us': 1e6 * self.max,
+			'p50_us': self.percentile(0.5),
+			'p90_us': self.percentile(0.9),
+			'p99_us': self.percentile(0.99),
+		}
+
+class Instruments:
+	"""Named histograms plus an on-demand profiler."""
+	def __init__(self):
+		self.histograms = {}
+		self.profiler = None
+		self.started = time.monotonic()
+
+	def record(self, name, seconds):
+		histogram = self.histograms.get(name)
+		if histogram is None:
+			histogram = self.histograms[name] = Histogram()
+		histogram.record(seconds)
+
+	def summary(self):
+		return {
+			'uptime_s': time.monotonic() - self.started,
+			'profiling': self.profiler is not None,
+			'histograms': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+		}
+
+	def startProfile(self):
+		if self.profiler is None:
+			import cProfile
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+
+	def stopProfile(self, path = None, top = 25):
+		"""Stop profiling; save the raw stats to path and return a text report."""
+		if self.profiler is None:
+			return ''
+		self.profiler.disable()
+		if path is not None:
+			self.profiler.dump_stats(path)
+		import pstats
+		report = io.StringIO()
+		pstats.Stats(self.profiler, stream = report).sort_stats('cumulative').print_stats(top)
+		self.profiler = None
+		return report.getvalue()
@@ -1,8 +1,22 @@
 #!/usr/bin/env python3
 
-from rpi_ws281x import Color, PixelStrip, ws
+import os
+import sys
 import time
 import math
+import ctypes
+import functools
+import numpy as np
+
+# Fall back to the software strip when the hardware bindings aren't available
+# (or when explicitly asked for, e.g. to exercise the server on a laptop).
+if os.environ.get('PARTYMODE_MOCK_STRIP'):
+	from mockstrip import Color, PixelStrip, ws
+else:
+	try:
+		from rpi_ws281x import Color, PixelStrip, ws
+	except ImportError:
+		from mockstrip import Color, PixelStrip, ws
 
 # LED strip configuration:
 LED_COUNT = 240       # Number of LED pixels.
@@ -14,7 +28,33 @@ LED_INVERT = False    # True to invert the signal (when using NPN transistor lev
 LED_CHANNEL = 0
 LED_STRIP = ws.WS2812_STRIP
 
+# Every strip driven from this Pi, as (LED count, GPIO pin, DMA channel, PWM
+# channel); each one needs its own DMA channel.  Together they're treated as
+# one long run of LEDs, in this order.
+#
+# Each strip gets its own driver instance, and both PWM channels belong to
+# the one PWM block that every instance programs for itself, so at most one
+# strip can be on a PWM pin.  The others have to use PCM (GPIO 21) or SPI
+# (GPIO 10).
+LED_STRIPS = ((LED_COUNT, LED_PIN, LED_DMA, LED_CHANNEL),)
+
+# GPIO pins rpi_ws281x drives from the PWM block
+PWM_PINS = (12, 13, 18, 19, 40, 41, 45, 52, 53)
+
+# Named parts of that run that can be controlled separately, as
+# name: (first LED, LED count).  Empty means one segment, 'all', covering
+# every LED.
+LED_SEGMENTS = {}
+
 LED_PURE_WHITE_CORRECTION = 0xFFE08C
+LED_NO_CORRECTION = 0xFFFFFF
+
+# Output gamma, applied in software by FrameBuffer along with brightness
+LED_GAMMA = 2.0
+
+# Temporally dither the output, for smoother dim colors and fades at the
+# cost of sending every frame
+LED_DITHER = False
 
 class ColorTemperature:
 	# 1900 Kelvin
@@ -36,41 +76,6 @@ class ColorTemperature:
 	# 20000 Kelvin
 	ClearBlueSky = 0x409CFF   # 20000 K, 64, 156, 255
 
-# Get the color for a temperature
-def getWhite(temp):
-	temps = {
-		1900: ColorTemperature.Candle, \
-		2600: ColorTemperature.Tungsten40W, \
-		2850: ColorTemperature.Tungsten100W, \
-		3200: ColorTemperature.Halogen, \
-		5200: ColorTemperature.CarbonArc, \
-		5400: ColorTemperature.HighNoonSun, \
-		6000: ColorTemperature.DirectSunlight, \
-		7000: ColorTemperature.OvercastSky, \
-		20000: ColorTemperature.ClearBlueSky, \
-	}
-	temp_keys = sorted(temps.keys())
-	if temp < temp_keys[0]:
-		return temps[temp_keys[0]]
-	elif temp > temp_keys[-1]:
-		return temps[temp_keys[-1]]
-	else:
-		for i in range(len(temp_keys) - 1):
-			if temp >= temp_keys[i] and temp <= temp_keys[i + 1]:
-				c1 = temp_keys[i]
-				c2 = temp_keys[i + 1]
-				break
-		else:
-			# This should be impossible
-			return temps[temp_keys[-1]]
-
-	ratio = (temp - c1) / (c2 - c1)
-	c1 = temps[c1]
-	c2 = temps[c2]
-	channelCorrect = lambda ch1, ch2, ratio: int(float(ch2) * ratio + float(ch1) * (1.0 - ratio))
-	componentCorrect = lambda c1, c2, bit_offset, ratio: channelCorrect((c1 >> bit_offset) & 0x0ff, (c2 >> bit_offset) & 0x0ff, ratio) << bit_offset
-	return componentCorrect(c1, c2, 16, ratio) | componentCorrect(c1, c2, 8, ratio) | componentCorrect(c1, c2, 0, ratio)
-
 # Correct color balance
 class correctColor:
 	color_factor_r = (LED_PURE_WHITE_CORRECTION >> 16) & 0xff
@@ -85,16 +90,231 @@ class correctColor:
 def gammaTable(gamma = 2.8, max_in = 255, max_out = 255):
 	return [int(math.pow(float(i) / float(max_in), gamma) * float(max_out) + 0.5) for i in range(256)]
 
+# Pack separate channel arrays (or an (N, 3) array via *rgb.T) into 0xRRGGBB
+def packRGB(r, g, b):
+	return (np.asarray(r, dtype=np.uint32) << 16) | \
+	       (np.asarray(g, dtype=np.uint32) << 8) | \
+	       np.asarray(b, dtype=np.uint32)
+
+# Inverse of packRGB: returns an (N, 3) uint8 array
+def unpackRGB(colors):
+	colors = np.asarray(colors, dtype=np.uint32)
+	return np.stack(((colors >> 16) & 0xff, (colors >> 8) & 0xff, colors & 0xff), axis=-1).astype(np.uint8)
+
+def ledBuffer(strip):
+	"""Return a uint32 NumPy view of the driver's LED buffer.
+
+	The buffer only exists once `strip.begin()` has been called.  For the real
+	driver this aliases the C library's `ws2811_led_t` array, so writing into
+	it is the same as calling setPixelColor() on every pixel.
+	"""
+	leds = ws.ws2811_channel_t_leds_get(strip._channel)
+	if isinstance(leds, np.ndarray):
+		return leds
+	# SWIG pointers convert to their address
+	array_type = ctypes.c_uint32 * strip.numPixels()
+	return np.ctypeslib.as_array(array_type.from_address(int(leds)))
+
+def openStrips(strips = None):
+	"""Create and begin() a PixelStrip for every entry of strips (default LED_STRIPS)."""
+	strips = LED_STRIPS if strips is None else strips
+	pwm_pins = [pin for count, pin, dma, channel in strips if pin in PWM_PINS]
+	if len(pwm_pins) > 1:
+		raise ValueError("Only one strip can use PWM, not GPIO %s; put the others on PCM or SPI" % \
+		                 ' and '.join(str(pin) for pin in pwm_pins))
+	opened = []
+	for count, pin, dma, channel in strips:
+		strip = PixelStrip(count, pin, LED_FREQ_HZ, dma, LED_INVERT, LED_BRIGHTNESS, channel, LED_STRIP)
+		strip.begin()
+		# Gamma and brightness are applied by FrameBuffer, so the driver
+		# passes pixels through untouched
+		ws.ws2811_channel_t_gamma_set(strip._channel, gammaTable(1.0))
+		opened.append(strip)
+	return opened
+
+# Which color channel each byte of a uint32 0xRRGGBB pixel holds, in memory order
+PIXEL_BYTE_CHANNELS = (2, 1, 0, None) if sys.byteorder == 'little' else (None, 0, 1, 2)
+
+@functools.lru_cache(maxsize = 1024)
+def outputTable(brightness = 255, white = LED_NO_CORRECTION, gamma = LED_GAMMA, dither = False):
+	"""The compiled output stage for one set of parameters.
+
+	Returns a (4, 256) array that maps every byte of a uint32 pixel (in
+	PIXEL_BYTE_CHANNELS order) to what the strip should get: the channel is
+	white-balanced by `white` (as correctColor() does), scaled by brightness
+	(as the driver does) and then gamma corrected.  Without dither it's
+	uint8, bit-for-bit what the driver would have produced.  With dither
+	it's uint16 with 8 fractional bits, for FrameBuffer to dither away.
+	Tables are cached, so switching between brightness levels is free.
+	"""
+	levels = np.arange(256)
+	factors = ((white >> 16) & 0xff, (white >> 8) & 0xff, white & 0xff)
+	table = np.zeros((4, 256), dtype=np.uint16 if dither else np.uint8)
+	for row, channel in enumerate(PIXEL_BYTE_CHANNELS):
+		if channel is None:
+			continue
+		if dither:
+			linear = levels * (factors[channel] / 255.0) * ((brightness + 1) / 256.0) / 255.0
+			table[row] = np.round(np.power(linear, gamma) * 255.0 * 256.0)
+		else:
+			gamma_table = np.array(gammaTable(gamma), dtype=np.uint8)
+			table[row] = gamma_table[(((levels * factors[channel]) // 255) * (brightness + 1)) >> 8]
+	table.flags.writeable = False
+	return table
+
+_TABLE_ROW_OFFSETS = np.arange(0, 1024, 256, dtype=np.uint16)
+
+# Each pixel's own offset into the dither sequence, so neighbors don't flicker in step
+DITHER_SEED = 0x5EED
+DITHER_STEP = 97              # odd, so each pixel cycles through all 256 thresholds
+
+class PixelArray:
+	"""What renderers draw into: a uint32 array of 0xRRGGBB `pixels`.
+
+	FrameBuffer and FrameSegment are PixelArrays; so is any bare array
+	wrapped in one, e.g. a frame being rendered in another process.
+	"""
+	def __init__(self, pixels):
+		self.pixels = pixels
+
+	def __len__(self):
+		return len(self.pixels)
+
+	def fill(self, color):
+		self.pixels.fill(color)
+
+	def setRGB(self, rgb):
+		"""Fill the pixels from an (N, 3) array of 0-255 channel values."""
+		rgb = np.asarray(rgb)
+		self.pixels[:] = packRGB(rgb[..., 0], rgb[..., 1], rgb[..., 2])
+
+	def getRGB(self):
+		return unpackRGB(self.pixels)
+
+class FrameSegment(PixelArray):
+	"""A named run of LEDs within a FrameBuffer, with its own output settings.
+
+	`pixels` is a view into the frame's own array, so drawing into the
+	segment draws into the frame.  `brightness` (0-255), `white` (white
+	balance, as 0xRRGGBB) and `dither` pick the segment's outputTable().
+	"""
+	def __init__(self, frame, name, start, count):
+		super().__init__(frame.pixels[start:start + count])
+		self.frame = frame
+		self.name = name
+		self.start = start
+		self.brightness = 255
+		self.white = LED_NO_CORRECTION
+		self.dither = LED_DITHER
+
+	def table(self):
+		return outputTable(int(self.brightness), self.white, LED_GAMMA, self.dither)
+
+class FrameBuffer(PixelArray):
+	"""One frame of 0xRRGGBB pixels, covering one or more strips end to end.
+
+	Renderers fill `pixels` (or a FrameSegment of it) with array ops, and
+	nothing touches the strips until push() (or show()).  On the way out
+	each segment goes through its outputTable() in one indexed lookup
+	(LEDs outside every segment get the default table), then each strip's
+	part of the frame is copied into its driver buffer in a single step.
+
+	show() only sends the strips whose part of the frame changed since the
+	last show(), with one strip.show() apiece; `frames_rendered` and
+	`frames_pushed` count the calls and the ones that sent anything.
+	"""
+	def __init__(self, strips):
+		if not isinstance(strips, (list, tuple)):
+			strips = [strips]
+		self.strips = list(strips)
+		self.bounds = []
+		start = 0
+		for strip in self.strips:
+			self.bounds.append((start, start + strip.numPixels()))
+			start += strip.numPixels()
+		super().__init__(np.zeros(start, dtype=np.uint32))
+		self.segments = {}
+		self.frames_rendered = 0
+		self.frames_pushed = 0
+		self._leds = None
+		self._output = np.zeros_like(self.pixels)
+		self._shown = None
+		self._covered = np.zeros(len(self.pixels), dtype=bool)
+		self._dither_offsets = np.random.default_rng(DITHER_SEED).integers(0, 256, len(self.pixels)).astype(np.uint16)
+		self._dither_frame = 0
+
+	def addSegment(self, name, start, count):
+		if start < 0 or count <= 0 or start + count > len(self.pixels):
+			raise ValueError("Segment %s (%d LEDs from %d) is outside the %d LED frame" % \
+			                 (name, count, start, len(self.pixels)))
+		segment = self.segments[name] = FrameSegment(self, name, start, count)
+		self._covered[start:start + count] = True
+		return segment
+
+	def dithering(self):
+		"""True if the output changes from frame to frame even when the pixels don't."""
+		return any(segment.dither and segment.brightness > 0 for segment in self.segments.values())
+
+	def _map(self, start, end, table):
+		source = self.pixels[start:end].view(np.uint8).reshape(-1, 4)
+		target = self._output[start:end].view(np.uint8).reshape(-1, 4)
+		# One lookup for every byte, through the table flattened to 1024 entries
+		mapped = np.take(table.ravel(), source + _TABLE_ROW_OFFSETS)
+		if table.dtype == np.uint16:
+			# Round up with a probability equal to the fraction
+			thresholds = (self._dither_offsets[start:end] + ((DITHER_STEP * self._dither_frame) & 0xff)) & 0xff
+			mapped = (mapped + thresholds[:, np.newaxis]) >> 8
+		target[:] = mapped
+
+	def output(self):
+		"""The frame as it goes to the strips, through each segment's outputTable()."""
+		if not self._covered.all():
+			self._map(0, len(self.pixels), outputTable())
+		for segment in self.segments.values():
+			self._map(segment.start, segment.start + len(segment), segment.table())
+		self._dither_frame += 1
+		return self._output
+
+	def _buffers(self):
+		if self._leds is None:
+			self._leds = [ledBuffer(strip) for strip in self.strips]
+		return self._leds
+
+	def push(self):
+		output = self.output()
+		for leds, (start, end) in zip(self._buffers(), self.bounds):
+			np.copyto(leds, output[start:end])
+
+	def invalidate(self):
+		"""Force the next show() through, e.g. after changing driver settings."""
+		self._shown = None
+
+	def show(self):
+		"""Send the strips whose pixels changed.  Returns True if any were sent."""
+		self.frames_rendered += 1
+		output = self.output()
+		pushed = False
+		for strip, leds, (start, end) in zip(self.strips, self._buffers(), self.bounds):
+			if self._shown is not None and np.array_equal(output[start:end], self._shown[start:end]):
+				continue
+			np.copyto(leds, output[start:end])
+			strip.show()
+			pushed = True
+		if pushed:
+			self._shown = output.copy()
+			self.frames_pushed += 1
+		return pushed
+
 # Define functions which animate LEDs in various ways.
 def setColor(strip, color):
-	for i in range(strip.numPixels()):
-		strip.setPixelColor(i, color)
+	ledBuffer(strip).fill(color)
 	strip.show()
 
 def colorWipe(strip, color, wait_ms=50):
 	"""Wipe color across display a pixel at a time."""
+	leds = ledBuffer(strip)
 	for i in range(strip.numPixels()):
-		strip.setPixelColor(i, color)
+		leds[i] = color
 		strip.show()
 		time.sleep(wait_ms / 1000.0)
 
@@ -109,11 +329,33 @@ def wheel(pos):
         pos -= 170
         return Color(0, pos * 3, 255 - pos * 3)
 
+# wheel() for every position, so whole frames can be built by indexing
+WHEEL_TABLE = np.array([wheel(pos) for pos in range(256)], dtype=np.uint32)
+
+# Patterns kept by each frame cache (one per LED count, mode parameters...)
+FRAME_CACHE_SIZE = 16
+
+@functools.lru_cache(maxsize=FRAME_CACHE_SIZE)
+def rainbowCycle(count):
+    """The wheel repeated over count + 256 pixels.
+
+    Frame j of rainbow() on `count` pixels is the slice [j:j + count] of
+    this one row, so every frame of the cycle is just a copy.
+    """
+    cycle = WHEEL_TABLE[np.arange(count + 256) & 255]
+    cycle.flags.writeable = False
+    return cycle
+
+def rainbowFrame(pixels, j):
+    """Fill a pixel array with frame j of rainbow()."""
+    j &= 255
+    pixels[:] = rainbowCycle(len(pixels))[j:j + len(pixels)]
+
 def rainbow(strip, wait_ms=20, iterations=1):
     """Draw rainbow that fades across all pixels at once."""
+    frame = FrameBuffer(strip)
     for j in range(256 * iterations):
-        for i in range(strip.numPixels()):
-            strip.setPixelColor(i, wheel((i + j) & 255))
-        strip.show()
+        rainbowFrame(frame.pixels, j)
+        frame.show()
         time.sleep(wait_ms / 1000.0)
 
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Software stand-in for the parts of the rpi_ws281x bindings that PartyMode3
+# uses, so the LED code can run (and be poked at) on a machine without a strip.
+
+import os
+import time
+import numpy as np
+
+WS2811_STRIP_RGB = 0x00100800
+WS2811_STRIP_GRB = 0x00081000
+
+# Signal timing: every LED takes 24 bits at the strip frequency, and the line
+# then has to be held low for the reset (latch) time before the next frame
+LED_BITS = 24
+LED_RESET_US = 55
+
+# Set to make every strip simulate the time the real driver spends sending
+SIMULATE_TIMING = bool(os.environ.get('PARTYMODE_MOCK_TIMING'))
+
+def transferTime(count, freq_hz = 800000):
+	"""Seconds it takes to clock one frame out to `count` LEDs."""
+	return count * LED_BITS / float(freq_hz) + LED_RESET_US * 1e-6
+
+def Color(red, green, blue, white = 0):
+	"""Convert the provided red, green, blue color to a 24-bit color value."""
+	return (white << 24) | (red << 16) | (green << 8) | blue
+
+class _Channel:
+	def __init__(self):
+		self.count = 0
+		self.gpionum = 0
+		self.brightness = 0
+		self.strip_type = WS2811_STRIP_GRB
+		self.gamma = list(range(256))
+		self.leds = None
+
+class _Controller:
+	def __init__(self):
+		self.channels = [_Channel(), _Channel()]
+		self.freq = 800000
+		self.dmanum = 10
+
+class ws:
+	"""Mirror of the SWIG-generated `_rpi_ws281x` accessors PartyMode3 calls."""
+	WS2811_STRIP_RGB = WS2811_STRIP_RGB
+	WS2811_STRIP_GRB = WS2811_STRIP_GRB
+	WS2812_STRIP = WS2811_STRIP_GRB
+	SK6812_STRIP = WS2811_STRIP_GRB
+
+	@staticmethod
+	def ws2811_channel_get(leds, channum):
+		return leds.channels[channum]
+
+	@staticmethod
+	def ws2811_channel_t_gamma_set(channel, gamma):
+		channel.gamma = list(gamma)
+
+	@staticmethod
+	def ws2811_channel_t_brightness_set(channel, brightness):
+		channel.brightness = brightness
+
+	@staticmethod
+	def ws2811_channel_t_brightness_get(channel):
+		return channel.brightness
+
+	@staticmethod
+	def ws2811_channel_t_count_get(channel):
+		return channel.count
+
+	@staticmethod
+	def ws2811_channel_t_leds_get(channel):
+		return channel.leds
+
+class PixelStrip:
+	"""Drop-in replacement for `rpi_ws281x.PixelStrip` backed by a NumPy array.
+
+	The driver's LED buffer is `self._channel.leds`, a uint32 array holding
+	0xWWRRGGBB values exactly like the C library's.  Every `show()` snapshots
+	the buffer into `self.shown` and bumps `self.show_count`; with
+	`record` set it also appends a copy to `self.frames`.
+
+	With `timing` set (default: SIMULATE_TIMING), show() behaves like the
+	real driver's DMA: it returns as soon as the frame is handed over, but
+	first waits for the previous frame to finish clocking out, which takes
+	transferTime().  `wire_time` totals the simulated sending time and
+	`wait_time` the time show() spent blocked.
+	"""
+	def __init__(self, num, pin, freq_hz = 800000, dma = 10, invert = False, \
+	             brightness = 255, channel = 0, strip_type = None, gamma = None, \
+	             timing = None, record = False):
+		self._leds = _Controller()
+		self._leds.freq = freq_hz
+		self._leds.dmanum = dma
+		self._channel = ws.ws2811_channel_get(self._leds, channel)
+		self._channel.count = num
+		self._channel.gpionum = pin
+		self._channel.brightness = brightness
+		self._channel.strip_type = WS2811_STRIP_GRB if strip_type is None else strip_type
+		if gamma is not None:
+			self._channel.gamma = list(gamma)
+		self.size = num
+		self.shown = np.zeros(num, dtype=np.uint32)
+		self.show_count = 0
+		self.frames = [] if record else None
+		self.timing = SIMULATE_TIMING if timing is None else timing
+		self.transfer_time = transferTime(num, freq_hz)
+		self.busy_until = 0.0
+		self.wire_time = 0.0
+		self.wait_time = 0.0
+
+	def begin(self):
+		self._channel.leds = np.zeros(self.size, dtype=np.uint32)
+
+	def show(self):
+		if self.timing:
+			now = time.perf_counter()
+			if now < self.busy_until:
+				time.sleep(self.busy_until - now)
+				self.wait_time += self.busy_until - now
+				now = self.busy_until
+			self.busy_until = now + self.transfer_time
+		self.wire_time += self.transfer_time
+		np.copyto(self.shown, self._channel.leds)
+		self.show_count += 1
+		if self.frames is not None:
+			self.frames.append(self.shown.copy())
+
+	def setGamma(self, gamma):
+		if type(gamma) is list and len(gamma) == 256:
+			ws.ws2811_channel_t_gamma_set(self._channel, gamma)
+
+	def setPixelColor(self, n, color):
+		self._channel.leds[n] = color
+
+	def setPixelColorRGB(self, n, red, green, blue, white = 0):
+		self.setPixelColor(n, Color(red, green, blue, white))
+
+	def getPixelColor(self, n):
+		return int(self._channel.leds[n])
+
+	def getPixels(self):
+		return [int(c) for c in self._channel.leds]
+
+	def getBrightness(self):
+		return ws.ws2811_channel_t_brightness_get(self._channel)
+
+	def setBrightness(self, brightness):
+		ws.ws2811_channel_t_brightness_set(self._channel, brightness)
+
+	def numPixels(self):
+		return ws.ws2811_channel_t_count_get(self._channel)
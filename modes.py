@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+
+# Lighting modes.  Each one is a Renderer that draws a whole frame at a time
+# into a FrameBuffer; server.py's AnimationEngine decides when to call it.
+
+import time
+import math
+import datetime
+import functools
+import numpy as np
+from sunsky import SkyLight
+
+from leds import *
+from colortemp import *
+
+MODE_SKYLIGHT_COLOR_BRIGHTSTAR = 0xE0E0FF
+MODE_SKYLIGHT_COLOR_DIMSTAR = 0x404050
+
+# The strip runs from the horizon (first LED) up to the zenith (last LED),
+# looking out towards this compass azimuth (radians clockwise from north)
+MODE_SKYLIGHT_TURBIDITY = 4
+MODE_SKYLIGHT_HORIZON_ANGLE = math.radians(88)
+MODE_SKYLIGHT_VIEW_AZIMUTH = math.pi
+
+PROBABILITY_STAR_BRIGHT = 0.02
+PROBABILITY_STAR = 0.05
+
+# Stars twinkle between full and (1 - depth) brightness, each at its own rate
+MODE_SKYLIGHT_TWINKLE_DEPTH = 0.6
+MODE_SKYLIGHT_TWINKLE_MIN_HZ = 0.2
+MODE_SKYLIGHT_TWINKLE_MAX_HZ = 1.5
+
+# Between sunset and the sun this far below the horizon (civil twilight), the
+# sky fades out as the stars fade in
+MODE_SKYLIGHT_DUSK_ANGLE = math.radians(6)
+# Seconds between skylight frames: the daytime sky barely moves in a minute,
+# but the stars twinkle
+MODE_SKYLIGHT_DAY_INTERVAL = 60.0
+MODE_SKYLIGHT_NIGHT_INTERVAL = 0.1
+# Seconds the wall clock has to move against the frame clock before skylight
+# counts it as set (e.g. by NTP after booting) and follows it
+MODE_SKYLIGHT_CLOCK_STEP = 10.0
+
+# For Romantic mode
+CANDLESIM_RED_MAX = 40
+CANDLESIM_YELLOW_MAX = 88
+CANDLESIM_RESET_PROB = 0.075
+CANDLESIM_ADJUST_PROB = 0.3
+CANDLESIM_STEP_RATE = 10         # steps per second the probabilities above are for
+CANDLESIM_FRAME_RATE = 30
+CANDLESIM_FLAME_SIZE = 3         # LEDs per independently flickering flame
+# Steps a flame's walk is replayed for when picking it up part way through;
+# by then nearly every flame has reset at least once, so it matches the
+# walk from the start
+CANDLESIM_CATCHUP_STEPS = 300
+# Steps whose random numbers are drawn together, from one generator
+CANDLESIM_BLOCK_STEPS = CANDLESIM_FRAME_RATE
+
+# For Christmas Light mode
+MODE_CHRISTMAS_FREQ = 4
+c9_red     = 0xae0202
+c9_orange  = 0xbf3803
+c9_green   = 0x04600
+c9_blue    = 0x202069
+c9_colors = [c9_red, c9_orange, c9_green, c9_blue]
+
+# For Easter mode
+easter_blue = 0x7cecf8
+easter_violet = 0x8876eb
+easter_pink = 0xfe7f91
+easter_yellow = 0xfdd27f
+easter_green = 0x76eba7
+easter_colors = [easter_blue, easter_violet, easter_pink, easter_yellow, easter_green]
+
+# For Audio mode: band colors, low frequencies first ('wheel' spreads the bands around wheel())
+AUDIO_PALETTES = {'wheel': None, 'christmas': c9_colors, 'easter': easter_colors}
+MODE_AUDIO_PALETTE = 'wheel'
+
+class Renderer:
+	"""A lighting mode, drawn one frame at a time.
+
+	`interval` is the number of seconds between frames, or None for modes
+	whose frame never changes; those are rendered once when they start.
+	`render()` is always called with the frame's scheduled time, so
+	animations stay in step with the wall clock even when frames are dropped.
+	A mode can change `interval` as it goes (skylight only needs a frame a
+	minute in daylight); nextFrame() turns it into the next wakeup, on a
+	grid counted from the start time so that servers sharing a clock draw
+	the same frames at the same moments.  Anything random has to follow
+	from the start time and a seed for the same reason.
+
+	`heavy` modes are rendered ahead of time in a worker process (see
+	offload.py), so they have to be picklable and must only depend on the
+	time they're given and their own state.
+	"""
+	interval = None
+	heavy = False
+
+	@property
+	def name(self):
+		# Used to label per-mode statistics
+		return type(self).__name__[:-len('Renderer')].lower()
+
+	def start(self, now):
+		self.start_time = now
+
+	def render(self, frame, now):
+		raise NotImplementedError
+
+	def nextFrame(self, last):
+		"""Clock time of the frame after the one due at `last`, or None for never."""
+		if self.interval is None:
+			return None
+		frames = math.floor((last - self.start_time) / self.interval + 1e-6) + 1
+		return self.start_time + frames * self.interval
+
+class SolidRenderer(Renderer):
+	def __init__(self, color):
+		self.color = color
+
+	def render(self, frame, now):
+		frame.fill(self.color)
+
+class KelvinRampRenderer(Renderer):
+	interval = 0.05
+
+	def __init__(self, ramp):
+		self.ramp = ramp
+
+	def render(self, frame, now):
+		elapsed = now - self.start_time
+		frame.fill(self.ramp.color(elapsed))
+		if self.ramp.done(elapsed):
+			# Nothing left to animate
+			self.interval = None
+
+@functools.lru_cache(maxsize = FRAME_CACHE_SIZE)
+def easterFrame(count):
+	bands = (np.arange(count) * len(easter_colors)) // count
+	frame = np.array(easter_colors, dtype=np.uint32)[bands]
+	frame.flags.writeable = False
+	return frame
+
+@functools.lru_cache(maxsize = FRAME_CACHE_SIZE)
+def christmasFrame(count):
+	frame = np.zeros(count, dtype=np.uint32)
+	bulbs = frame[::MODE_CHRISTMAS_FREQ]
+	bulbs[:] = np.array(c9_colors, dtype=np.uint32)[np.arange(len(bulbs)) % len(c9_colors)]
+	frame.flags.writeable = False
+	return frame
+
+class EasterRenderer(Renderer):
+	def render(self, frame, now):
+		np.copyto(frame.pixels, easterFrame(len(frame)))
+
+class ChristmasRenderer(Renderer):
+	def render(self, frame, now):
+		np.copyto(frame.pixels, christmasFrame(len(frame)))
+
+class RainbowRenderer(Renderer):
+	interval = 0.02
+
+	def render(self, frame, now):
+		rainbowFrame(frame.pixels, int(round((now - self.start_time) / self.interval)))
+
+class StarField:
+	"""The stars for one night: which LEDs they're on, their colors and twinkle.
+
+	Star positions are drawn once, from a generator seeded with the night,
+	so the same night always gets the same sky.
+	"""
+	def __init__(self, count, night):
+		rng = np.random.default_rng(night.toordinal())
+		r = rng.random(count)
+		self.night = night
+		self.count = count
+		self.index = np.flatnonzero(r < PROBABILITY_STAR)
+		bright = r[self.index] < PROBABILITY_STAR_BRIGHT
+		self.rgb = unpackRGB(np.where(bright, MODE_SKYLIGHT_COLOR_BRIGHTSTAR, MODE_SKYLIGHT_COLOR_DIMSTAR)).astype(np.float32)
+		self.frequency = rng.uniform(MODE_SKYLIGHT_TWINKLE_MIN_HZ, MODE_SKYLIGHT_TWINKLE_MAX_HZ, len(self.index))
+		self.phase = rng.uniform(0.0, 2 * math.pi, len(self.index))
+
+	def starRGB(self, now):
+		"""(stars, 3) colors of the stars at monotonic() time now."""
+		twinkle = 0.5 + 0.5 * np.sin(2 * math.pi * self.frequency * now + self.phase)
+		return self.rgb * (1.0 - MODE_SKYLIGHT_TWINKLE_DEPTH * twinkle)[:, np.newaxis]
+
+class SkylightRenderer(Renderer):
+	interval = MODE_SKYLIGHT_NIGHT_INTERVAL
+	heavy = True
+
+	def __init__(self, sun, sky = None, epoch = None):
+		# sun is a sunsky.SunPositionCache for where the strip is; sky is a
+		# SkyLight or SkyLightTable (anything with skyRGBArray).  epoch is the
+		# Unix time at frame time 0; without it, frame times are pinned to
+		# the wall clock when first drawn, and again whenever it's set
+		self.sun = sun
+		self.sky = SkyLight() if sky is None else sky
+		self.epoch = epoch
+		self.follow_wall_clock = epoch is None
+		self.view_theta = None
+		self.stars = None
+
+	def viewAngles(self, count):
+		# Zenith angle each LED looks at, from the horizon up to straight overhead
+		if self.view_theta is None or len(self.view_theta) != count:
+			self.view_theta = np.linspace(MODE_SKYLIGHT_HORIZON_ANGLE, 0.0, count)
+		return self.view_theta
+
+	def daySky(self, count, sun_altitude, sun_azimuth):
+		"""(count, 3) sky colors along the strip for a sun at or above the horizon."""
+		sun_theta = 0.5 * math.pi - max(sun_altitude, 0.0)
+		theta = self.viewAngles(count)
+		gamma = SkyLight.angleToSun(theta, MODE_SKYLIGHT_VIEW_AZIMUTH, sun_theta, sun_azimuth)
+		return self.sky.skyRGBArray(MODE_SKYLIGHT_TURBIDITY, theta, gamma, sun_theta)
+
+	def starField(self, count, date):
+		# A night runs from local noon to local noon
+		night = (date + datetime.timedelta(hours = self.sun.longitude / 15.0 - 12.0)).date()
+		if self.stars is None or self.stars.count != count or self.stars.night != night:
+			self.stars = StarField(count, night)
+		return self.stars
+
+	def frameDate(self, now):
+		"""The UTC datetime that frame time now stands for."""
+		if self.follow_wall_clock:
+			epoch = time.time() - now
+			if self.epoch is None or abs(epoch - self.epoch) > MODE_SKYLIGHT_CLOCK_STEP:
+				self.epoch = epoch
+		return datetime.datetime.fromtimestamp(self.epoch + now, datetime.timezone.utc)
+
+	def render(self, frame, now):
+		# Figure out the altitude angle of the sun, right here, at the frame's time
+		date = self.frameDate(now)
+		sun_altitude, sun_azimuth = self.sun.position(date)
+		sun_altitude = math.radians(sun_altitude)
+		sun_azimuth = math.radians(sun_azimuth)
+		if sun_altitude >= 0:
+			# Daytime
+			frame.setRGB(self.daySky(len(frame), sun_altitude, sun_azimuth))
+			self.interval = MODE_SKYLIGHT_DAY_INTERVAL
+			return
+
+		self.interval = MODE_SKYLIGHT_NIGHT_INTERVAL
+		stars = self.starField(len(frame), date)
+		star_rgb = stars.starRGB(now)
+		if sun_altitude > -MODE_SKYLIGHT_DUSK_ANGLE:
+			# Dusk or dawn: the sky as it is at sunset, fading out as the stars come up
+			daylight = 1.0 + sun_altitude / MODE_SKYLIGHT_DUSK_ANGLE
+			rgb = self.daySky(len(frame), 0.0, sun_azimuth) * daylight
+			rgb[stars.index] += star_rgb * (1.0 - daylight)
+			frame.setRGB(np.minimum(rgb + 0.5, 255.0).astype(np.uint8))
+		else:
+			# Nighttime: only the star pixels need working out
+			frame.fill(0x000000)
+			star_rgb = (star_rgb + 0.5).astype(np.uint8)
+			frame.pixels[stars.index] = packRGB(star_rgb[:, 0], star_rgb[:, 1], star_rgb[:, 2])
+
+class RomanticRenderer(Renderer):
+	"""Candlelight: every flame of CANDLESIM_FLAME_SIZE LEDs flickers on its own.
+
+	Each flame does the same random walk through red and yellow levels that
+	the whole strip used to, with the CANDLESIM_* probabilities scaled to
+	the frame rate.  All flames live in arrays and advance together.
+
+	The random numbers for each block of CANDLESIM_BLOCK_STEPS steps are
+	drawn at once from a generator seeded with (seed, block), and the walk
+	advances one step per frame period since the start time, however many
+	frames are actually drawn.  So the flicker is the same for the same
+	seed and start time: that is what keeps synchronized servers' candles
+	together.  Catching up a few hundred steps takes a handful of
+	generators, not one per step.
+	"""
+	interval = 1.0 / CANDLESIM_FRAME_RATE
+
+	def __init__(self, seed = None):
+		self.seed = np.random.SeedSequence().entropy & 0xffffffff if seed is None else seed
+
+	def start(self, now):
+		super().start(now)
+		self.step = None
+		self.red = None
+		self.yellow = None
+		self.block = None
+		self.numbers = None
+
+	def reset(self, flames, step):
+		# Start every flame somewhere random
+		rng = np.random.default_rng((self.seed, step, 1))
+		self.red = rng.integers(0, CANDLESIM_RED_MAX + 1, flames)
+		self.yellow = rng.integers(0, CANDLESIM_YELLOW_MAX + 1, flames)
+		self.step = step
+
+	def blockNumbers(self, block, flames):
+		"""The random numbers for every step of a block, as (steps, 4, flames)."""
+		if block != self.block or self.numbers.shape[2] != flames:
+			self.numbers = np.random.default_rng((self.seed, block)).random((CANDLESIM_BLOCK_STEPS, 4, flames))
+			self.block = block
+		return self.numbers
+
+	def advance(self, flames, target):
+		"""Walk every flame on to step target.
+
+		What each step does is worked out for a block's worth of steps at
+		once; only applying it is left to a loop over the steps.
+		"""
+		scale = CANDLESIM_STEP_RATE / CANDLESIM_FRAME_RATE
+		while self.step < target:
+			block, row = divmod(self.step, CANDLESIM_BLOCK_STEPS)
+			steps = min(CANDLESIM_BLOCK_STEPS - row, target - self.step)
+			action, direction, new_red, new_yellow = self.blockNumbers(block, flames)[row:row + steps].transpose(1, 0, 2)
+			reset = action <= CANDLESIM_RESET_PROB * scale
+			adjust_red = ~reset & (action <= CANDLESIM_ADJUST_PROB / 2. * scale)
+			adjust_yellow = ~reset & ~adjust_red & (action <= CANDLESIM_ADJUST_PROB * scale)
+			step = np.where(direction < 0.5, -1, 1)
+			new_red = (new_red * (CANDLESIM_RED_MAX + 1)).astype(int)
+			new_yellow = (new_yellow * (CANDLESIM_YELLOW_MAX + 1)).astype(int)
+
+			# Choose new colors, or slightly adjust existing ones
+			for i in range(steps):
+				self.red = np.where(reset[i], new_red[i], \
+				           np.where(adjust_red[i], np.minimum(np.maximum(self.red + step[i], 0), CANDLESIM_RED_MAX - 1), self.red))
+				self.yellow = np.where(reset[i], new_yellow[i], \
+				              np.where(adjust_yellow[i], np.minimum(np.maximum(self.yellow + step[i], 0), CANDLESIM_YELLOW_MAX - 1), self.yellow))
+			self.step += steps
+
+	def render(self, frame, now):
+		flames = -(-len(frame) // CANDLESIM_FLAME_SIZE)
+		target = max(0, int((now - self.start_time) * CANDLESIM_FRAME_RATE + 1e-6))
+		if self.step is None or len(self.red) != flames or not 0 <= target - self.step <= CANDLESIM_CATCHUP_STEPS:
+			self.reset(flames, max(0, target - CANDLESIM_CATCHUP_STEPS))
+		self.advance(flames, target)
+		red = 16 + self.red + (self.yellow >> 1)
+		green = 16 + (self.yellow >> 1)
+		blue = np.full(flames, 8)
+		colors = packRGB((red * correctColor.color_factor_r) // 0xff, \
+		                 (green * correctColor.color_factor_g) // 0xff, \
+		                 (blue * correctColor.color_factor_b) // 0xff)
+		frame.pixels[:] = np.repeat(colors, CANDLESIM_FLAME_SIZE)[:len(frame)]
+
+class AudioRenderer(Renderer):
+	"""Band levels from an audio.AudioInput as bars of color along the strip.
+
+	The strip is split into one run of LEDs per band, lowest first, each lit
+	in its palette color at the band's level.  It's drawn whenever new
+	levels come in (see AnimationEngine.wakeLayer()) rather than on a clock.
+	"""
+	def __init__(self, audio, palette = MODE_AUDIO_PALETTE):
+		self.audio = audio
+		self.palette = palette
+		self.band_rgb = None
+		self.band_index = None
+
+	def _layout(self, count, bands):
+		if self.band_rgb is None or len(self.band_rgb) != bands:
+			colors = AUDIO_PALETTES[self.palette]
+			if colors is None:
+				colors = [wheel(band * 256 // bands) for band in range(bands)]
+			self.band_rgb = unpackRGB([colors[band % len(colors)] for band in range(bands)]).astype(np.float32)
+			self.band_index = None
+		if self.band_index is None or len(self.band_index) != count:
+			self.band_index = (np.arange(count) * bands) // count
+
+	def render(self, frame, now):
+		levels = self.audio.levels
+		self._layout(len(frame), len(levels))
+		rgb = (self.band_rgb * levels[:, np.newaxis] + 0.5).astype(np.uint8)
+		frame.pixels[:] = packRGB(rgb[:, 0], rgb[:, 1], rgb[:, 2])[self.band_index]
+		self.audio.rendered()
+
+# Target rate and per-frame processing budget for streamed frames
+STREAM_FRAME_RATE = 60
+STREAM_FRAME_BUDGET = 0.002
+
+class StreamRenderer(Renderer):
+	"""Shows frames streamed in from an external renderer (the 'f' command).
+
+	Incoming frames are received straight into one of a few preallocated
+	(LED count, 3) RGB slots.  Only the newest frame is kept: one that is
+	replaced before its deadline counts as dropped, and one that has waited
+	longer than a frame period by the time it could be shown counts as late
+	and is discarded.  Per-frame processing time is checked against
+	STREAM_FRAME_BUDGET.  The engine only wakes it when a frame arrives
+	(see AnimationEngine.wakeLayer()).
+	"""
+	interval = 1.0 / STREAM_FRAME_RATE
+
+	def __init__(self, count, slots = 3):
+		self.slots = np.zeros((slots, count, 3), dtype=np.uint8)
+		self.views = [memoryview(slot).cast('B') for slot in self.slots]
+		self.next_slot = 0
+		self.pending = None               # (slot index, arrival time)
+		self.received = 0
+		self.shown = 0
+		self.dropped = 0
+		self.late = 0
+		self.over_budget = 0
+		self.cost_total = 0.0
+		self.cost_max = 0.0
+
+	def acquire(self):
+		"""Return a writable memoryview of a free slot for the next frame."""
+		index = self.next_slot
+		if self.pending is not None and self.pending[0] == index:
+			index = (index + 1) % len(self.slots)
+		self.next_slot = (index + 1) % len(self.slots)
+		return self.views[index]
+
+	def submit(self, slot, now):
+		"""Queue a slot from acquire() that has been filled with a frame."""
+		index = next(i for i, view in enumerate(self.views) if view is slot)
+		self.received += 1
+		if self.pending is not None:
+			self.dropped += 1
+		self.pending = (index, now)
+
+	def render(self, frame, now):
+		if self.pending is None:
+			return
+		index, arrival = self.pending
+		self.pending = None
+		if now - arrival > self.interval:
+			self.late += 1
+			return
+		started = time.perf_counter()
+		frame.setRGB(self.slots[index])
+		cost = time.perf_counter() - started
+		self.shown += 1
+		self.cost_total += cost
+		self.cost_max = max(self.cost_max, cost)
+		if cost > STREAM_FRAME_BUDGET:
+			self.over_budget += 1
+
+	def nextFrame(self, last):
+		# Idle until the next frame is submitted
+		return None if self.pending is None else last + self.interval
+
+	def stats(self):
+		return {
+			'received': self.received,
+			'shown': self.shown,
+			'dropped': self.dropped,
+			'late': self.late,
+			'over_budget': self.over_budget,
+			'cost_mean_us': 1e6 * self.cost_total / self.shown if self.shown else 0.0,
+			'cost_max_us': 1e6 * self.cost_max,
+			'budget_us': 1e6 * STREAM_FRAME_BUDGET,
+		}
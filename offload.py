@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# Renders expensive modes ahead of time in a separate process, so the event
+# loop only has to copy finished frames into the frame buffer.
+
+import time
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+from leds import PixelArray
+from modes import Renderer
+
+# Frames a worker may have rendered ahead (or be rendering) at once
+OFFLOAD_SLOTS = 4
+# How far ahead of its due time the worker starts on a frame
+OFFLOAD_LOOKAHEAD = 0.25
+
+def _work(name, slots, count, requests, results):
+	# Runs in the worker process, drawing frames on the renderer's own
+	# schedule until it runs out of free slots
+	memory = shared_memory.SharedMemory(name = name)
+	frames = np.ndarray((slots, count), dtype=np.uint32, buffer=memory.buf)
+	renderer = None
+	generation = None
+	free = []
+	when = None                  # engine clock time of the next frame to draw
+	offset = 0.0                 # engine clock - monotonic()
+	try:
+		while True:
+			timeout = None
+			if when is not None and free:
+				now = time.monotonic() + offset
+				interval = renderer.interval
+				if interval is not None and when < now - interval:
+					# Fallen behind: skip to the current frame, like the engine does
+					when += interval * int((now - when) // interval)
+				timeout = when - OFFLOAD_LOOKAHEAD - now
+				if timeout <= 0:
+					slot = free.pop()
+					started = time.perf_counter()
+					renderer.render(PixelArray(frames[slot]), when)
+					results.send((generation, slot, when, time.perf_counter() - started))
+					when = renderer.nextFrame(when)
+					continue
+			try:
+				message = requests.get(timeout = timeout)
+			except queue.Empty:
+				continue
+			if message is None:
+				break
+			if message[0] == 'load':
+				generation, renderer, when, offset = message[1:]
+				renderer.start(when)
+				free = list(range(slots))
+			elif message[1] == generation:
+				free.append(message[2])
+	finally:
+		del frames
+		memory.close()
+
+class RenderWorker:
+	"""A process, and a ring of shared-memory frames, for one layer's heavy renderers.
+
+	The main process hands it a renderer with load(); the worker then draws
+	frames on the renderer's own schedule, up to OFFLOAD_LOOKAHEAD early,
+	into whichever slots of `frames` are free and sends each back through a
+	pipe.  fileno() is that pipe, for an event loop to wait on, and poll()
+	collects what's arrived; slots go back to the worker with free().
+	Renderers are pickled across, so they must not hold anything that
+	can't be.  A worker is reused for every heavy renderer of its layer.
+	"""
+	def __init__(self, count, slots = OFFLOAD_SLOTS):
+		# A fresh interpreter rather than a fork of the event loop's process
+		context = multiprocessing.get_context('spawn')
+		self.count = count
+		self.slots = slots
+		self.memory = shared_memory.SharedMemory(create = True, size = slots * count * 4)
+		self.frames = np.ndarray((slots, count), dtype=np.uint32, buffer=self.memory.buf)
+		self.requests = context.Queue()
+		self.results, sender = context.Pipe(duplex = False)
+		self.generation = 0
+		self.stale = 0                    # frames that weren't ready in time
+		self.process = context.Process(target = _work, name = 'render-worker', daemon = True, \
+		                               args = (self.memory.name, slots, count, self.requests, sender))
+		self.process.start()
+		sender.close()
+
+	def load(self, renderer, start_time, offset = 0.0):
+		"""Switch to rendering for renderer from start_time; returns its generation number.
+
+		Times are on the engine's clock, which is `offset` ahead of monotonic().
+		"""
+		self.generation += 1
+		self.requests.put(('load', self.generation, renderer, start_time, offset))
+		return self.generation
+
+	def free(self, slot):
+		"""Give a slot back to the worker once its frame has been used."""
+		self.requests.put(('free', self.generation, slot))
+
+	def fileno(self):
+		return self.results.fileno()
+
+	def poll(self):
+		"""Frames finished since the last call, as (slot, due time, seconds taken) tuples."""
+		finished = []
+		try:
+			while self.results.poll():
+				generation, slot, when, cost = self.results.recv()
+				if generation == self.generation:
+					finished.append((slot, when, cost))
+		except EOFError:
+			# The worker died; alive() will say so
+			pass
+		return finished
+
+	def alive(self):
+		return self.process.is_alive()
+
+	def close(self):
+		self.requests.put(None)
+		self.process.join(1.0)
+		if self.process.is_alive():
+			self.process.terminate()
+		self.results.close()
+		del self.frames
+		self.memory.close()
+		self.memory.unlink()
+
+class OffloadedRenderer(Renderer):
+	"""Runs a heavy renderer in a RenderWorker, a little ahead of time.
+
+	The engine calls receive() whenever the worker's pipe is readable, and
+	then schedules this renderer for nextFrame(): the earliest finished
+	frame's due time.  render() never waits: it shows the newest finished
+	frame that is due and hands the older ones' slots back.  A frame that
+	arrives after its due time is counted as stale in the worker, and goes
+	out as soon as it arrives.
+	"""
+	def __init__(self, renderer, worker, instruments = None, clock = time.monotonic):
+		self.renderer = renderer
+		self.worker = worker
+		self.instruments = instruments
+		self.clock = clock
+
+	@property
+	def name(self):
+		return self.renderer.name
+
+	def start(self, now):
+		super().start(now)
+		self.worker.load(self.renderer, now, self.clock() - time.monotonic())
+		self.ready = []                   # (due time, slot), rendered and not yet shown
+
+	def receive(self, now):
+		for slot, when, cost in self.worker.poll():
+			self.ready.append((when, slot))
+			if when < now:
+				self.worker.stale += 1
+			if self.instruments is not None:
+				self.instruments.record('worker.render.' + self.name, cost)
+		self.ready.sort()
+
+	def render(self, frame, now):
+		self.receive(now)
+		due = [(when, slot) for when, slot in self.ready if when <= now]
+		if due:
+			np.copyto(frame.pixels, self.worker.frames[due[-1][1]])
+			for when, slot in due:
+				self.worker.free(slot)
+			self.ready = self.ready[len(due):]
+
+	def nextFrame(self, last):
+		# Nothing to do until the worker sends something
+		return self.ready[0][0] if self.ready else None
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+# Wire protocol for the LED server (port 4237).
+#
+# Two kinds of command share the socket:
+#
+# * Legacy commands: a command letter followed by a fixed-size ASCII payload,
+#   e.g. b'ma' (rainbow), b'bf' (full brightness), b'w02900', b'cff8000'.
+#   These are never acknowledged.
+#
+# * Framed commands: a 7-byte header (MAGIC, VERSION, sequence number,
+#   command letter, payload length) followed by a binary payload.  Every
+#   framed command is answered with a framed ACK carrying the same sequence
+#   number, a status byte and the state the server ended up in, except for
+#   streamed frames (FRAME), which would otherwise flood the client.
+#
+# MAGIC is not a valid legacy command letter, so the two can be interleaved.
+#
+# A framed command can be aimed at one named segment of the strips by
+# wrapping it in a SEGMENT command: the payload is the segment name
+# (NUL-padded) followed by the wrapped command letter and its payload.  The
+# ACK keeps the wrapper's sequence number and reports that segment's state.
+# Unwrapped commands apply to every segment.
+#
+# Likewise a command (possibly SEGMENT-wrapped) can be put off until a time
+# of day by wrapping it in a SCHEDULE command: the payload is a Unix time in
+# seconds followed by the wrapped command letter and its payload.  Its ACK
+# only says it was accepted; UNSCHEDULE drops everything still pending.
+
+import struct
+from collections import namedtuple
+
+MAGIC = 0xFE
+VERSION = 1
+
+HEADER = struct.Struct('!BBHcH')     # magic, version, sequence, command, payload length
+STATE = struct.Struct('!ccIH')       # mode, brightness, color (0xRRGGBB), Kelvin (0 if not white)
+ACK_STATUS = struct.Struct('!B')
+SEGMENT_NAME = struct.Struct('!16s')
+SCHEDULE_TIME = struct.Struct('!I')
+
+ACK = b'a'
+FRAME = b'f'                         # raw frame: LED count * 3 bytes of R, G, B; never acknowledged
+QUERY = b'q'                         # no-op whose ACK reports the current state
+STATS = b'i'                         # runtime statistics; answered with a REPLY instead of an ACK
+PROFILE = b'p'                       # 1 starts the profiler, 0 stops it and saves the results
+REPLY = b'j'                         # JSON answer to a STATS command, same sequence number
+SEGMENT = b'g'                       # wraps another command to aim it at one segment
+SCHEDULE = b't'                      # wraps another command to apply it at a given time
+UNSCHEDULE = b'u'                    # cancels every scheduled command
+ACK_APPLIED = 0
+ACK_SUPERSEDED = 1                   # a later command in the same burst replaced it
+ACK_ERROR = 2
+
+# Payload sizes of the legacy commands
+LEGACY_LENGTHS = {b'm': 1, b'b': 1, b'w': 5, b'c': 6, b'k': 15}
+
+# Framed payload layouts
+PAYLOADS = {
+	b'm': struct.Struct('!c'),          # mode letter
+	b'b': struct.Struct('!c'),          # brightness letter
+	b'w': struct.Struct('!H'),          # Kelvin
+	b'c': struct.Struct('!3s'),         # R, G, B
+	b'k': struct.Struct('!HHH'),        # start Kelvin, end Kelvin, seconds
+	QUERY: struct.Struct(''),
+	STATS: struct.Struct(''),
+	PROFILE: struct.Struct('!B'),
+	UNSCHEDULE: struct.Struct(''),
+}
+
+# Commands in the same category replace each other when they arrive together
+CATEGORIES = {b'm': 'mode', b'w': 'mode', b'c': 'mode', b'k': 'mode', b'b': 'brightness'}
+
+# Valid arguments of the mode and brightness commands
+MODES = (b'x', b'e', b'a', b'r', b's', b'v', b'p', b'0')
+BRIGHTNESSES = (b'f', b'm', b'd')
+
+WHITE_DEFAULT = 2900
+LEGACY_NUMBER_MAX = 0xffff
+
+# seq is None for legacy commands; error is a message if the payload was bad;
+# segment is the name of the segment it's aimed at, or None for all of them;
+# at is the Unix time it's scheduled for, or None for right away
+Command = namedtuple('Command', ['seq', 'command', 'args', 'error', 'segment', 'at'], defaults = (None, None))
+
+class ProtocolError(ValueError):
+	pass
+
+def _checkLetter(command, letter):
+	if (command == b'm' and letter not in MODES) or (command == b'b' and letter not in BRIGHTNESSES):
+		raise ProtocolError("Unknown argument %s for %s" % (letter, command))
+	return (letter,)
+
+def _legacyNumber(command, payload, digits = b'0123456789', base = 10):
+	# int() would also take a sign, spaces or underscores
+	if not payload or payload.strip(digits):
+		raise ProtocolError("Bad number %s for %s" % (payload, command))
+	return int(payload, base)
+
+def _decodeLegacy(command, payload):
+	# Five digits can go past what the framed fields hold; numbers are capped
+	# there so that every command can be encoded as a framed one
+	if command in (b'm', b'b'):
+		return _checkLetter(command, payload)
+	elif command == b'w':
+		return (min(_legacyNumber(command, payload), LEGACY_NUMBER_MAX) or WHITE_DEFAULT,)
+	elif command == b'c':
+		return (_legacyNumber(command, payload, b'0123456789abcdefABCDEF', 16),)
+	elif command == b'k':
+		return tuple(min(_legacyNumber(command, payload[i:i + 5]), LEGACY_NUMBER_MAX) for i in range(0, 15, 5))
+
+def _decodeFramed(command, payload):
+	layout = PAYLOADS.get(command)
+	if layout is None:
+		raise ProtocolError("Unknown command %s" % command)
+	if len(payload) != layout.size:
+		raise ProtocolError("Bad payload length %d for %s" % (len(payload), command))
+	args = layout.unpack(payload)
+	if command in (b'm', b'b'):
+		return _checkLetter(command, args[0])
+	elif command == b'c':
+		r, g, b = args[0]
+		return ((r << 16) | (g << 8) | b,)
+	return args
+
+def _unwrapSegment(payload):
+	# Returns (segment name, wrapped command, wrapped payload)
+	if len(payload) < SEGMENT_NAME.size + 1:
+		raise ProtocolError("Bad payload length %d for %s" % (len(payload), SEGMENT))
+	name, = SEGMENT_NAME.unpack_from(payload)
+	command = payload[SEGMENT_NAME.size:SEGMENT_NAME.size + 1]
+	if command not in CATEGORIES:
+		raise ProtocolError("%s can't be aimed at a segment" % command)
+	return name.rstrip(b'\0').decode('utf-8', 'replace'), command, payload[SEGMENT_NAME.size + 1:]
+
+def _unwrapSchedule(payload):
+	# Returns (Unix time, wrapped command, wrapped payload)
+	if len(payload) < SCHEDULE_TIME.size + 1:
+		raise ProtocolError("Bad payload length %d for %s" % (len(payload), SCHEDULE))
+	at, = SCHEDULE_TIME.unpack_from(payload)
+	command = payload[SCHEDULE_TIME.size:SCHEDULE_TIME.size + 1]
+	if command != SEGMENT and command not in CATEGORIES:
+		raise ProtocolError("%s can't be scheduled" % command)
+	return at, command, payload[SCHEDULE_TIME.size + 1:]
+
+class CommandParser:
+	"""Incrementally splits a byte stream into Commands.
+
+	The parser owns its receive buffer: socket code asks getBuffer() where to
+	put incoming bytes and then reports how many arrived with bufferUpdated(),
+	which returns every command completed so far (a trailing partial one is
+	kept for next time).  feed() does the same for data already in hand.
+
+	Streamed frames (b'f') never pass through the buffer: once their header
+	is seen, getBuffer() hands out the frame slot from frame_sink() itself,
+	and the finished Command carries that slot as its only argument.
+	"""
+	def __init__(self, frame_size = None, frame_sink = None, size = 65536):
+		self.buffer = bytearray(size)
+		self.filled = 0
+		self.frame_size = frame_size
+		self.frame_sink = frame_sink
+		self.frame = None                 # (seq, slot, bytes received) while a frame is arriving
+
+	def getBuffer(self, sizehint = -1):
+		if self.frame is not None:
+			seq, slot, received = self.frame
+			return slot[received:]
+		if self.filled == len(self.buffer):
+			# A single message bigger than the buffer: grow it
+			grown = bytearray(2 * len(self.buffer))
+			grown[:self.filled] = self.buffer
+			self.buffer = grown
+		return memoryview(self.buffer)[self.filled:]
+
+	def bufferUpdated(self, nbytes):
+		if self.frame is not None:
+			seq, slot, received = self.frame
+			received += nbytes
+			if received < len(slot):
+				self.frame = (seq, slot, received)
+				return []
+			self.frame = None
+			return [Command(seq, FRAME, (slot,), None)]
+		self.filled += nbytes
+		return self._parse()
+
+	def feed(self, data):
+		commands = []
+		data = memoryview(data)
+		while len(data):
+			target = self.getBuffer(len(data))
+			n = min(len(target), len(data))
+			target[:n] = data[:n]
+			commands += self.bufferUpdated(n)
+			data = data[n:]
+		return commands
+
+	def _startFrame(self, seq, view, start, length):
+		# Move whatever part of the frame is already buffered into its slot;
+		# the rest will be received straight into the slot
+		slot = self.frame_sink()
+		received = min(length, len(view) - start)
+		slot[:received] = view[start:start + received]
+		if received == length:
+			return start + received, Command(seq, FRAME, (slot,), None)
+		self.frame = (seq, slot, received)
+		return start + received, None
+
+	def _parse(self):
+		commands = []
+		view = memoryview(self.buffer)[:self.filled]
+		pos = 0
+		try:
+			while pos < len(view) and self.frame is None:
+				if view[pos] == MAGIC:
+					if len(view) - pos < HEADER.size:
+						break
+					magic, version, seq, command, length = HEADER.unpack_from(view, pos)
+					if command == FRAME and version == VERSION and self.frame_sink is not None and \
+					   length == self.frame_size:
+						pos, command = self._startFrame(seq, view, pos + HEADER.size, length)
+						if command is not None:
+							commands.append(command)
+						continue
+					end = pos + HEADER.size + length
+					if len(view) < end:
+						break
+					payload = bytes(view[pos + HEADER.size:end])
+					pos = end
+					if version != VERSION:
+						commands.append(Command(seq, command, (), "Unsupported protocol version %d" % version))
+						continue
+					segment = at = None
+					try:
+						if command == SCHEDULE:
+							at, command, payload = _unwrapSchedule(payload)
+						if command == SEGMENT:
+							segment, command, payload = _unwrapSegment(payload)
+						commands.append(Command(seq, command, _decodeFramed(command, payload), None, segment, at))
+					except (ProtocolError, struct.error) as e:
+						commands.append(Command(seq, command, (), str(e), segment, at))
+				else:
+					command = bytes(view[pos:pos + 1])
+					length = LEGACY_LENGTHS.get(command)
+					if length is None:
+						# Skip the stray byte and resynchronize on the next one
+						print("Unknown command %s" % command)
+						pos += 1
+						continue
+					if len(view) - pos - 1 < length:
+						break
+					payload = bytes(view[pos + 1:pos + 1 + length])
+					pos += 1 + length
+					try:
+						commands.append(Command(None, command, _decodeLegacy(command, payload), None))
+					except ValueError as e:
+						commands.append(Command(None, command, (), str(e)))
+			# Keep the unparsed tail at the front of the buffer
+			rest = len(view) - pos
+			self.buffer[:rest] = bytes(view[pos:])
+			self.filled = rest
+		finally:
+			view.release()
+		return commands
+
+def coalesce(commands):
+	"""Pick the commands from a burst that actually need applying.
+
+	Only the last valid command in each category survives; survivors keep
+	their relative order.  Commands for different segments never replace
+	each other, but one for every segment replaces all earlier ones in its
+	category.  Scheduled commands are left out; they never replace anything.
+	Returns (to_apply, superseded).
+	"""
+	last = {}
+	scheduled = []
+	for i, command in enumerate(commands):
+		if command.error is None:
+			if command.at is not None:
+				scheduled.append(i)
+				continue
+			category = CATEGORIES.get(command.command, command.command)
+			if command.segment is None:
+				for key in [key for key in last if key[1] == category]:
+					del last[key]
+			last[(command.segment, category)] = i
+	keep = sorted(list(last.values()) + scheduled)
+	keep_set = set(keep)
+	superseded = [command for i, command in enumerate(commands) if command.error is None and i not in keep_set]
+	return [commands[i] for i in keep], superseded
+
+def encodeCommand(seq, command, *args, segment = None, at = None):
+	"""Build a framed command; args are the fields of PAYLOADS[command].
+
+	With a segment name, the command is wrapped to apply to that segment only;
+	with `at` (a Unix time), it's wrapped to be applied then.
+	"""
+	if command == b'c':
+		color = args[0]
+		args = (bytes(((color >> 16) & 0xff, (color >> 8) & 0xff, color & 0xff)),)
+	payload = PAYLOADS[command].pack(*args)
+	if segment is not None:
+		payload = SEGMENT_NAME.pack(segment.encode('utf-8')) + command + payload
+		command = SEGMENT
+	if at is not None:
+		payload = SCHEDULE_TIME.pack(int(at)) + command + payload
+		command = SCHEDULE
+	return HEADER.pack(MAGIC, VERSION, seq & 0xffff, command, len(payload)) + payload
+
+def encodeFrame(seq, rgb):
+	"""Build a FRAME command from LED count * 3 bytes of R, G, B."""
+	rgb = memoryview(rgb).cast('B')
+	return HEADER.pack(MAGIC, VERSION, seq & 0xffff, FRAME, len(rgb)) + rgb
+
+def encodeAck(seq, status, state):
+	payload = ACK_STATUS.pack(status) + STATE.pack(*state)
+	return HEADER.pack(MAGIC, VERSION, seq, ACK, len(payload)) + payload
+
+def encodeReply(seq, payload):
+	return HEADER.pack(MAGIC, VERSION, seq, REPLY, len(payload)) + payload
+
+def decodeMessage(data):
+	"""Split one server message (ACK or REPLY) off the start of data.
+
+	Returns ((seq, command, payload), bytes consumed), or (None, 0) if data
+	doesn't hold a whole message yet.
+	"""
+	if len(data) < HEADER.size:
+		return None, 0
+	magic, version, seq, command, length = HEADER.unpack_from(data)
+	if magic != MAGIC:
+		raise ProtocolError("Lost sync with the server")
+	if len(data) < HEADER.size + length:
+		return None, 0
+	return (seq, command, bytes(data[HEADER.size:HEADER.size + length])), HEADER.size + length
+
+def decodeAckPayload(payload):
+	"""Returns (status, state) from an ACK's payload."""
+	status, = ACK_STATUS.unpack_from(payload)
+	return status, STATE.unpack_from(payload, ACK_STATUS.size)
+
+def decodeAck(data):
+	"""Decode one ACK from the start of data.
+
+	Returns ((seq, status, state), bytes consumed), or (None, 0) if data
+	doesn't hold a whole ACK yet.
+	"""
+	message, used = decodeMessage(data)
+	if message is None:
+		return None, 0
+	seq, command, payload = message
+	if command != ACK:
+		raise ProtocolError("Not an ACK")
+	return (seq,) + decodeAckPayload(payload), used
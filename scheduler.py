@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Timers for the animation engine: a heap of callbacks on the monotonic
+# clock, plus timers for wall-clock times that survive the clock being set.
+
+import time
+import heapq
+import itertools
+
+# Longest a wall-clock timer trusts the monotonic clock before checking the
+# wall clock again (a Pi without an RTC boots with the wrong time)
+WALL_CLOCK_RECHECK = 60.0
+
+class Timers:
+	"""A heap of callbacks, each due at a time on `clock` (default monotonic()).
+
+	add() returns a handle for cancel(); cancelled entries stay in the heap
+	and are dropped when they reach the top, so both are O(log n).
+	"""
+	def __init__(self, clock = time.monotonic):
+		self.clock = clock
+		self.heap = []
+		self.counter = itertools.count()
+
+	def add(self, when, callback):
+		entry = [when, next(self.counter), callback]
+		heapq.heappush(self.heap, entry)
+		return entry
+
+	def cancel(self, entry):
+		if entry is not None:
+			entry[2] = None
+
+	def next(self):
+		"""When the earliest live timer is due, or None if there aren't any."""
+		while self.heap and self.heap[0][2] is None:
+			heapq.heappop(self.heap)
+		return self.heap[0][0] if self.heap else None
+
+	def timeout(self, now):
+		"""Seconds from now until the next timer (None for never)."""
+		when = self.next()
+		return None if when is None else max(0.0, when - now)
+
+	def shift(self, delta):
+		"""Move every timer by delta seconds, e.g. after the clock itself jumped."""
+		for entry in self.heap:
+			entry[0] += delta
+
+	def pop(self, now):
+		"""Remove and return the callbacks due by now, earliest first."""
+		due = []
+		while self.heap and self.heap[0][0] <= now:
+			when, order, callback = heapq.heappop(self.heap)
+			if callback is not None:
+				due.append(callback)
+		return due
+
+class WallClockTimer:
+	"""Calls callback(now) once time.time() reaches `timestamp`.
+
+	It sleeps on the timers' clock, at most WALL_CLOCK_RECHECK at a time,
+	and checks the wall clock whenever it wakes, so it still fires at the
+	right time if the clock is stepped (e.g. by NTP just after boot).
+	"""
+	def __init__(self, timers, timestamp, callback):
+		self.timers = timers
+		self.timestamp = timestamp
+		self.callback = callback
+		self.entry = None
+		self._arm()
+
+	def _arm(self):
+		remaining = min(max(self.timestamp - time.time(), 0.0), WALL_CLOCK_RECHECK)
+		self.entry = self.timers.add(self.timers.clock() + remaining, self._check)
+
+	def _check(self, now):
+		if time.time() >= self.timestamp:
+			self.entry = None
+			self.callback(now)
+		else:
+			self._arm()
+
+	def cancel(self):
+		self.timers.cancel(self.entry)
+		self.entry = None
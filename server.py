@@ -1,233 +1,898 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import time
-import asyncio
+import json
 import random
+import signal
+import socket
+import asyncio
+import traceback
 
-import datetime
-from pysolar import *
-import math
-from sunsky import SkyLight
+from sunsky import SkyLightTable, SunPositionCache
 
 from leds import *
+from modes import *
+from protocol import *
+from instrument import Instruments
+from atomicfile import atomicWrite
+from scheduler import Timers, WallClockTimer
 
 LOCALHOST = '127.0.0.1'
-LED_INTERFACE_PORT = 4237
+LED_INTERFACE_PORT = int(os.environ.get('PARTYMODE_PORT', 4237))
+COMMAND_BUFFER_SIZE = 65536
 
 LATITUDE = 40.78431480655391
 LONGITUDE = -73.95592912942985
 
+# Precomputed skylight colors, built on first use of skylight mode
+SKYLIGHT_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'skytable.npz')
+
+# Where the state and ready files go; give each server its own to run
+# several on one machine
+RUN_DIR = os.environ.get('PARTYMODE_RUN_DIR', os.path.dirname(os.path.abspath(__file__)))
+
+# Last state of every segment, saved on changes and restored at startup
+STATE_PATH = os.path.join(RUN_DIR, 'partymode.state')
+# Seconds to let a burst of changes settle before saving them
+STATE_SAVE_DELAY = 1.0
+
+# Created once the server is listening, and removed when it stops
+READY_PATH = os.path.join(RUN_DIR, 'partymode.ready')
+
+# Frame sequence (see framefile.py) that replay mode plays
+REPLAY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replay.pmf')
+
+# Where the profile command saves cProfile results
+PROFILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'partymode.prof')
+
 MODE_FULL_COLOR = 0xFFFFFF
-MODE_SKYLIGHT_COLOR_BRIGHTSTAR = 0xE0E0FF
-MODE_SKYLIGHT_COLOR_DIMSTAR = 0x404050
 
 MODE_FULL_BRIGHTNESS = 255
 MODE_MEDIUM_BRIGHTNESS = 128
 MODE_DIM_COLOR = 0x303030
 MODE_DIM_BRIGHTNESS = 64
 MODE_OFF_BRIGHTNESS = 0
+BRIGHTNESS_LEVELS = {b'f': MODE_FULL_BRIGHTNESS, b'm': MODE_MEDIUM_BRIGHTNESS, b'd': MODE_DIM_BRIGHTNESS}
+
+# Seconds a brightness command takes to fade to its new level
+BRIGHTNESS_FADE_TIME = 0.3
+
+# Upper bound on how often the engine draws a frame
+FRAME_RATE = 60
+
+# 'leader' to have other servers follow this one's modes, 'follower' to
+# follow a leader (see sync.py)
+SYNC_ROLE = os.environ.get('PARTYMODE_SYNC')
+
+# Render heavy modes in a worker process instead of on the event loop; only
+# worth it with a core to spare for the worker
+OFFLOAD_HEAVY = os.environ.get('PARTYMODE_OFFLOAD', '1' if (os.cpu_count() or 1) > 1 else '0') != '0'
+
+class Layer:
+	"""A renderer and the part of the frame it draws into."""
+	def __init__(self, view):
+		self.view = view
+		self.renderer = None
+		self.deadline = None     # clock() time of its next frame, or None if nothing's due
+		self.timer = None        # the engine's timer for deadline
+		self.last = 0.0          # when its last frame was due
+		self.worker = None       # RenderWorker for heavy renderers, started on first use
+
+class AnimationEngine:
+	"""Draws renderers into the frame buffer when they next need drawing.
+
+	Every segment of the frame is a layer with its own renderer and
+	schedule, under a whole-frame layer (segment None) that is drawn first.
+	Each layer's next frame is a timer in a heap, set from its renderer's
+	nextFrame(), so the engine sleeps until the earliest one is due and not
+	at all for modes that never change.  Each wakeup draws every layer that
+	is due and then shows the frame once, so the strips get a single update
+	however many segments changed.
+
+	Frames are scheduled on a fixed grid per layer; if rendering falls
+	behind, the missed deadlines are dropped rather than drawn late.  A
+	renderer that raises is logged and taken off its layer, and a timer
+	callback that raises is logged, so the rest keep going.
+	setRenderer() wakes the engine immediately so a new mode never waits for
+	the old one's next frame.  With `offload` set, heavy renderers run in a
+	worker process per layer and the engine just copies their frames in
+	when the worker's pipe says they're ready; if the worker dies, its
+	renderer is drawn on the event loop instead.
+
+	Brightness fades, and dithered output, need the frame shown every
+	period whether or not anything was drawn; the engine keeps ticking
+	while either is going on.  at() and atTime() put other work, like a
+	command scheduled for a time of day, on the same timers.
+
+	All times are on `clock`, monotonic() unless the engine is following
+	another server's time base (see sync.py); renderers see the same clock.
+
+	Render time per mode, push time, how late each frame starts, how long
+	the event loop oversleeps a timer and the command-to-photon latency are
+	recorded in `instruments`.
+	"""
+	def __init__(self, frame, frame_rate = FRAME_RATE, instruments = None, offload = OFFLOAD_HEAVY, clock = time.monotonic):
+		self.frame = frame
+		self.period = 1.0 / frame_rate
+		self.offload = offload
+		self.clock = clock
+		self.layers = {None: Layer(frame)}
+		self.timers = Timers(clock)
+		self.due = []                     # layers whose deadline has passed
+		self.frame_timer = None           # timer for the next fade or dither frame
+		self.frame_due = False
+		self.fades = {}                   # segment name -> (segment, start time, from, to, duration)
+		self.last_tick = 0.0
+		self.frames_dropped = 0
+		self.instruments = Instruments() if instruments is None else instruments
+		self.command_received = None
+		self._wake = asyncio.Event()
+
+	def addSegment(self, segment):
+		self.layers[segment.name] = Layer(segment)
+
+	def renderer(self, segment = None):
+		return self.layers[segment].renderer
+
+	def _schedule(self, layer, when):
+		# Move layer's next frame to clock() time `when` (None for never)
+		self.timers.cancel(layer.timer)
+		layer.deadline = when
+		layer.timer = None if when is None else self.timers.add(when, lambda now: self._layerDue(layer))
+
+	def _layerDue(self, layer):
+		layer.timer = None
+		if layer not in self.due:
+			self.due.append(layer)
+
+	def at(self, when, callback):
+		"""Call callback(now) at clock() time `when`; returns a handle for cancel()."""
+		entry = self.timers.add(when, callback)
+		self._wake.set()
+		return entry
+
+	def atTime(self, timestamp, callback):
+		"""Call callback(now) once the wall clock reaches `timestamp`; returns a WallClockTimer."""
+		timer = WallClockTimer(self.timers, timestamp, callback)
+		self._wake.set()
+		return timer
+
+	def cancel(self, entry):
+		self.timers.cancel(entry)
+
+	def _startWorker(self, layer):
+		# multiprocessing is only worth importing once a heavy mode is used
+		from offload import RenderWorker
+		layer.worker = RenderWorker(len(layer.view))
+		asyncio.get_running_loop().add_reader(layer.worker.fileno(), self._workerReady, layer)
+
+	def _stopWorker(self, layer):
+		asyncio.get_running_loop().remove_reader(layer.worker.fileno())
+		layer.worker.close()
+		layer.worker = None
+
+	def _workerReady(self, layer):
+		# The worker has finished a frame (or died)
+		renderer = layer.renderer
+		if not layer.worker.alive():
+			worker = layer.worker
+			self._stopWorker(layer)
+			if getattr(renderer, 'worker', None) is worker:
+				# Carry on drawing it here; the next heavy mode gets a new worker
+				print("Render worker for %s died, drawing it on the event loop" % renderer.name)
+				inline = renderer.renderer
+				inline.start(renderer.start_time)
+				layer.renderer = inline
+				self._schedule(layer, self.clock())
+				self._wake.set()
+			return
+		if getattr(renderer, 'worker', None) is not layer.worker:
+			# Left over from a renderer that's gone
+			layer.worker.poll()
+			return
+		renderer.receive(self.clock())
+		when = renderer.nextFrame(None)
+		if when is not None and (layer.deadline is None or when < layer.deadline):
+			self._schedule(layer, when)
+			self._wake.set()
+
+	def wakeLayer(self, segment = None):
+		"""Draw a layer as soon as the frame rate allows, for renderers fed from outside."""
+		layer = self.layers[segment]
+		if layer.renderer is not None and layer.deadline is None:
+			self._schedule(layer, max(self.clock(), layer.last + self.period))
+			self._wake.set()
+
+	def setRenderer(self, renderer, segment = None, start = None):
+		"""Switch a layer to renderer, drawing its first frame right away.
+
+		start is the clock() time the mode counts as having started, for
+		picking up an animation part way through; it defaults to now.
+		"""
+		layer = self.layers[segment]
+		if renderer is not None and renderer.heavy and self.offload:
+			if layer.worker is not None and not layer.worker.alive():
+				self._stopWorker(layer)
+			if layer.worker is None:
+				self._startWorker(layer)
+			from offload import OffloadedRenderer
+			renderer = OffloadedRenderer(renderer, layer.worker, self.instruments, self.clock)
+		now = self.clock()
+		if renderer is not None:
+			renderer.start(now if start is None else start)
+		layer.renderer = renderer
+		if layer in self.due:
+			self.due.remove(layer)
+		self._schedule(layer, None if renderer is None else now)
+		self._wake.set()
+
+	def setBrightness(self, segment, brightness, fade = 0.0):
+		"""Set a segment's brightness, fading to it over `fade` seconds."""
+		if fade > 0 and segment.brightness != brightness:
+			self.fades[segment.name] = (segment, self.clock(), segment.brightness, brightness, fade)
+			self._scheduleFrame()
+		else:
+			self.fades.pop(segment.name, None)
+			segment.brightness = brightness
+
+	def targetBrightness(self, segment):
+		"""The brightness a segment is at, or fading to."""
+		fade = self.fades.get(segment.name)
+		return segment.brightness if fade is None else fade[3]
+
+	def _updateFades(self, now):
+		for name, (segment, started, start, end, duration) in list(self.fades.items()):
+			progress = min((now - started) / duration, 1.0)
+			segment.brightness = int(round(start + progress * (end - start)))
+			if progress >= 1.0:
+				del self.fades[name]
+
+	def _scheduleFrame(self):
+		# Fades and dithering need the frame shown again even if no layer is due
+		if self.frame_timer is None and (self.fades or self.frame.dithering()):
+			self.frame_timer = self.timers.add(self.last_tick + self.period, self._frameDue)
+			self._wake.set()
+
+	def _frameDue(self, now):
+		self.frame_timer = None
+		self.frame_due = True
+
+	def shiftClock(self, delta):
+		"""Keep everything scheduled where it was after clock() jumped by delta."""
+		self.timers.shift(delta)
+		for layer in self.layers.values():
+			if layer.deadline is not None:
+				layer.deadline += delta
+			layer.last += delta
+		self.last_tick += delta
+		for name, (segment, started, start, end, duration) in self.fades.items():
+			self.fades[name] = (segment, started + delta, start, end, duration)
+		self._wake.set()
+
+	def redraw(self):
+		"""Draw every layer again on the next tick, e.g. after another layer covered it."""
+		now = self.clock()
+		for layer in self.layers.values():
+			if layer.renderer is not None:
+				self._schedule(layer, now)
+		self._wake.set()
+
+	def close(self):
+		for layer in self.layers.values():
+			if layer.worker is not None:
+				self._stopWorker(layer)
+
+	def markCommand(self, received):
+		"""Note the perf_counter() time a command arrived, to time it to the strip."""
+		if self.frame_timer is None and not self.due and all(layer.deadline is None for layer in self.layers.values()):
+			# Nothing left to draw, so it's already on the strip
+			self.instruments.record('command_latency.direct', time.perf_counter() - received)
+		else:
+			self.command_received = received
+			self._wake.set()
+
+	async def _sleep(self, timeout):
+		# Returns True if we were woken up by a new renderer
+		try:
+			await asyncio.wait_for(self._wake.wait(), timeout)
+		except asyncio.TimeoutError:
+			return False
+		self._wake.clear()
+		return True
+
+	def _tick(self, due, now):
+		if due:
+			self.instruments.record('frame_lag', now - min(layer.deadline for layer in due))
+		self.last_tick = now
+		self._updateFades(now)
+		started = time.perf_counter()
+		for layer in due:
+			renderer = layer.renderer
+			deadline = layer.deadline
+			if renderer.interval is not None:
+				period = max(self.period, renderer.interval)
+				if now - deadline >= period:
+					missed = int((now - deadline) // period)
+					self.frames_dropped += missed
+					deadline += missed * period
+			try:
+				renderer.render(layer.view, deadline)
+				when = renderer.nextFrame(deadline)
+			except Exception:
+				# One broken mode mustn't stop everything else being drawn
+				print("Renderer %s failed, stopping it:" % renderer.name)
+				traceback.print_exc()
+				layer.renderer = None
+				self._schedule(layer, None)
+				continue
+			layer.last = deadline
+			rendered = time.perf_counter()
+			self.instruments.record('render.' + renderer.name, rendered - started)
+			started = rendered
+			self._schedule(layer, None if when is None else max(when, deadline + self.period))
+		pushed = self.frame.show()
+		shown = time.perf_counter()
+		if pushed:
+			self.instruments.record('push', shown - started)
+		if self.command_received is not None:
+			drawn = [layer.renderer for layer in due if layer.renderer is not None]
+			name = drawn[-1].name if drawn else 'fade'
+			self.instruments.record('command_latency.' + name, shown - self.command_received)
+			self.command_received = None
+		self._scheduleFrame()
+
+	def runDue(self):
+		"""Run the timers that are due and draw what needs drawing; returns seconds until the next timer."""
+		now = self.clock()
+		for callback in self.timers.pop(now):
+			try:
+				callback(now)
+			except Exception:
+				print("Timer callback failed:")
+				traceback.print_exc()
+		if self.due or self.frame_due:
+			# Draw in layer order, whole frame first
+			due = [layer for layer in self.layers.values() if layer in self.due]
+			self.due = []
+			self.frame_due = False
+			self._tick(due, now)
+		return self.timers.timeout(self.clock())
+
+	async def run(self):
+		while True:
+			timeout = self.runDue()
+			slept = time.monotonic()
+			if not await self._sleep(timeout) and timeout is not None:
+				# Anything hogging the event loop shows up as oversleeping
+				self.instruments.record('loop_lag', time.monotonic() - slept - timeout)
 
-PROBABILITY_STAR_BRIGHT = 0.02
-PROBABILITY_STAR = 0.05
-
-# For Romantic mode
-CANDLESIM_RED_MAX = 40
-CANDLESIM_YELLOW_MAX = 88
-CANDLESIM_RESET_PROB = 0.075
-CANDLESIM_ADJUST_PROB = 0.3
-
-# For Christmas Light mode
-MODE_CHRISTMAS_FREQ = 4
-c9_red     = 0xae0202
-c9_orange  = 0xbf3803
-c9_green   = 0x04600
-c9_blue    = 0x202069
-c9_colors = [c9_red, c9_orange, c9_green, c9_blue]
-
-# For Easter mode
-easter_blue = 0x7cecf8
-easter_violet = 0x8876eb
-easter_pink = 0xfe7f91
-easter_yellow = 0xfdd27f
-easter_green = 0x76eba7
-easter_colors = [easter_blue, easter_violet, easter_pink, easter_yellow, easter_green]
-
-class LEDServerHandler:
-	def __init__(self):
-		self.strip = PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL, LED_STRIP)
-		self.strip.begin()
-		self.setBrightness(MODE_FULL_BRIGHTNESS)
-		self.color = MODE_FULL_COLOR
-		self.skylight = SkyLight()
+class SegmentState:
+	"""What one segment of the strips was last asked to show."""
+	def __init__(self, view):
+		self.view = view
 
 		# Cache these separately so that brightness commands don't override the mode
 		self.mode = b'0'
-		self.brightness = b'0'
+		self.brightness = b'f'
+		self.color = MODE_FULL_COLOR
+		self.kelvin = 0
 
-	def setBrightness(self, brightness):
-		CHANNEL_NUM = 0
-		channel = ws.ws2811_channel_get(self.strip._leds, CHANNEL_NUM)
-		ws.ws2811_channel_t_gamma_set(channel, gammaTable(2.0))
-		ws.ws2811_channel_t_brightness_set(channel, brightness)
+		# The command that set the mode, when (on the engine's clock) it
+		# started and the seed for anything random in it, which is all
+		# another server needs to show exactly the same thing
+		self.command = Command(None, b'm', (b'0',), None)
+		self.start = 0.0
+		self.seed = 0
 
-	def brightnessFull(self):
-		self.setBrightness(MODE_FULL_BRIGHTNESS)
-		self.strip.show()
+	@property
+	def name(self):
+		return self.view.name
 
-	def brightnessMedium(self):
-		self.setBrightness(MODE_MEDIUM_BRIGHTNESS)
-		self.strip.show()
+	def state(self):
+		return (self.mode, self.brightness, self.color, self.kelvin)
+
+class LEDServerHandler:
+	"""Applies commands to the strips.
+
+	With a state_path, every segment's mode, brightness, color and
+	temperature are saved there shortly after they change and put back
+	when the handler starts, so the lights survive a reboot.
+
+	`clock` is the engine's.  `sync`, a sync.SyncLeader or SyncFollower
+	when servers are synchronized, is told about every change so that a
+	leader can pass it on.
+	"""
+	def __init__(self, state_path = None, clock = time.monotonic):
+		self.strips = openStrips()
+		self.frame = FrameBuffer(self.strips)
+		self.engine = AnimationEngine(self.frame, clock = clock)
+		self.sync = None
+		self.segments = {}
+		for name, (start, count) in (LED_SEGMENTS or {'all': (0, len(self.frame))}).items():
+			view = self.frame.addSegment(name, start, count)
+			self.engine.addSegment(view)
+			self.segments[name] = SegmentState(view)
+			self.setBrightness(self.segments[name], MODE_FULL_BRIGHTNESS)
+		self.stream = StreamRenderer(len(self.frame))
+		self.skylight = None
+		self.sun = SunPositionCache(LATITUDE, LONGITUDE)
+		self.audio = None                 # audio.AudioInput while a segment is in audio mode
+		self.scheduled = []               # (WallClockTimer, Command) waiting for their time
+		self.state_path = state_path
+		self.saved_state = None           # the snapshot last written, as JSON
+		self.save_timer = None
+		if state_path is not None:
+			self.restoreState()
+
+	def setBrightness(self, segment, brightness, fade = 0.0):
+		self.engine.setBrightness(segment.view, brightness, fade)
+
+	def brightnessFull(self, segment):
+		self.setBrightness(segment, MODE_FULL_BRIGHTNESS, BRIGHTNESS_FADE_TIME)
+
+	def brightnessMedium(self, segment):
+		self.setBrightness(segment, MODE_MEDIUM_BRIGHTNESS, BRIGHTNESS_FADE_TIME)
 	
-	def brightnessDim(self):
-		self.setBrightness(MODE_DIM_BRIGHTNESS)
-		self.strip.show()
+	def brightnessDim(self, segment):
+		self.setBrightness(segment, MODE_DIM_BRIGHTNESS, BRIGHTNESS_FADE_TIME)
 	
-	def modeEaster(self):
-		setColor(self.strip, 0x000000)
-		self.setBrightness(MODE_FULL_BRIGHTNESS)
-		for i in range(0, LED_COUNT):
-			self.strip.setPixelColor(i, easter_colors[(i * len(easter_colors)) // LED_COUNT])
-		self.strip.show()
-
-	def modeChristmas(self):
-		color_idx = 0
-		setColor(self.strip, 0x000000)
-		self.setBrightness(MODE_FULL_BRIGHTNESS)
-		for i in range(0, LED_COUNT, MODE_CHRISTMAS_FREQ):
-			self.strip.setPixelColor(i, c9_colors[color_idx])
-			color_idx = (color_idx + 1) % len(c9_colors)
-		self.strip.show()
-
-	def modeRainbow(self):
-		self.setBrightness(MODE_FULL_BRIGHTNESS)
-		rainbow(self.strip)
-
-	def modeSkylight(self):
-		# Figure out the altitude angle of the sun, right here, right now
-		date = datetime.datetime.now(datetime.timezone.utc)
-		sun_altitude = math.radians(solar.get_altitude(LATITUDE, LONGITUDE, date))
-		sun_azimuth = math.radians(solar.get_azimuth(LATITUDE, LONGITUDE, date))
-		if sun_altitude < 0:
-			# Nighttime
-			setColor(self.strip, 0x000000)
-			for i in range(0, LED_COUNT):
-				r = random.random()
-				if r < PROBABILITY_STAR_BRIGHT:
-					self.strip.setPixelColor(i, MODE_SKYLIGHT_COLOR_BRIGHTSTAR)
-				elif r < PROBABILITY_STAR:
-					self.strip.setPixelColor(i, MODE_SKYLIGHT_COLOR_DIMSTAR)
-		else:
-			# Daytime
-			half_pi = 0.5 * math.pi
-			r, g, b = self.skylight.skyRGB(4, half_pi - sun_altitude, sun_azimuth + half_pi, half_pi - sun_altitude)
-			for i in range(0, LED_COUNT):
-				self.strip.setPixelColorRGB(i, r, g, b)
-		self.strip.show()
-
-	def modeRomantic(self):
-		self.cur_color_idx = (8 << 8) | 8;
-		self.modeRomanticUpdate(force = True)
-
-	def modeRomanticUpdate(self, force = False):
-		red    = (self.cur_color_idx >> 8) & 0xff;
-		yellow = (self.cur_color_idx & 0xff);
-
-		def updateRomanticColor(self, red, yellow):
-			self.cur_color_idx = (red << 8) | yellow
-			self.color = correctColor()( \
-			             ((16 + red + (yellow >> 1)) << 16) | \
-			             ((16 + (yellow >> 1)) << 8) | \
-			             8);
-			setColor(self.strip, self.color)
-			self.strip.show()
-
-		action_prob = random.random()
-		if CANDLESIM_RESET_PROB >= action_prob or force:
-			# Choose new colors
-			red = random.randint(0, CANDLESIM_RED_MAX);
-			yellow = random.randint(0, CANDLESIM_YELLOW_MAX);
-			updateRomanticColor(self, red, yellow)
-
-		elif CANDLESIM_ADJUST_PROB >= action_prob:
-			# Slightly adjust existing colors
-			if CANDLESIM_ADJUST_PROB / 2. >= action_prob:
-				red = max(min(red + random.choice((-1, 1)), CANDLESIM_RED_MAX - 1), 0)
+	def useRenderer(self, segment, renderer):
+		self.engine.setRenderer(renderer, segment.name, segment.start)
+
+	def modeEaster(self, segment):
+		self.setBrightness(segment, MODE_FULL_BRIGHTNESS)
+		self.useRenderer(segment, EasterRenderer())
+
+	def modeChristmas(self, segment):
+		self.setBrightness(segment, MODE_FULL_BRIGHTNESS)
+		self.useRenderer(segment, ChristmasRenderer())
+
+	def modeRainbow(self, segment):
+		self.setBrightness(segment, MODE_FULL_BRIGHTNESS)
+		self.useRenderer(segment, RainbowRenderer())
+
+	def modeSkylight(self, segment):
+		if self.skylight is None:
+			self.skylight = SkyLightTable.cached(SKYLIGHT_TABLE_PATH, (MODE_SKYLIGHT_TURBIDITY,))
+		self.useRenderer(segment, SkylightRenderer(self.sun, self.skylight))
+
+	def modeRomantic(self, segment):
+		self.useRenderer(segment, RomanticRenderer(segment.seed))
+
+	def modeAudio(self, segment):
+		if self.audio is None:
+			from audio import AudioInput
+			self.audio = AudioInput(instruments = self.engine.instruments, listener = self.audioReady)
+			self.audio.start()
+		self.useRenderer(segment, AudioRenderer(self.audio))
+
+	def audioReady(self):
+		# New levels: draw every segment that shows them
+		for segment in self.segments.values():
+			if segment.mode == b'v':
+				self.engine.wakeLayer(segment.name)
+
+	def stopAudio(self):
+		if self.audio is not None and all(segment.mode != b'v' for segment in self.segments.values()):
+			self.audio.stop()
+			self.audio = None
+
+	def modeReplay(self, segment):
+		from framefile import FrameSequence, ReplayRenderer
+		try:
+			sequence = FrameSequence(REPLAY_PATH)
+		except (OSError, ValueError) as e:
+			raise ProtocolError("Can't replay %s: %s" % (REPLAY_PATH, e))
+		self.useRenderer(segment, ReplayRenderer(sequence))
+
+	def modeSolid(self, segment, color):
+		self.useRenderer(segment, SolidRenderer(color))
+
+	def modeKelvinRamp(self, segment, start_kelvin, end_kelvin, duration):
+		self.useRenderer(segment, KelvinRampRenderer(KelvinRamp(start_kelvin, end_kelvin, duration)))
+
+	def modeOff(self, segment):
+		self.engine.setRenderer(None, segment.name)
+		self.setBrightness(segment, MODE_OFF_BRIGHTNESS)
+
+	def stopStream(self):
+		if self.engine.renderer() is self.stream:
+			self.engine.setRenderer(None)
+			# The stream drew over every segment
+			self.engine.redraw()
+
+	def targets(self, name):
+		"""The segments a command is aimed at: all of them when name is None."""
+		if name is None:
+			return list(self.segments.values())
+		segment = self.segments.get(name)
+		if segment is None:
+			raise ProtocolError("Unknown segment %s" % name)
+		return [segment]
+
+	def state(self, name = None):
+		return self.targets(name)[0].state()
+
+	def schedule(self, command):
+		"""Apply a command (e.g. off, or a sunrise Kelvin ramp) when the wall clock reaches command.at."""
+		self.targets(command.segment)
+		entry = []
+		def due(now):
+			self.scheduled.remove(entry)
+			try:
+				self.apply(command._replace(at = None))
+			except ProtocolError as e:
+				print(e)
+			self.stateChanged()
+		entry += [self.engine.atTime(command.at, due), command]
+		self.scheduled.append(entry)
+
+	def snapshot(self):
+		return json.dumps({name: {
+			'mode': segment.mode.decode('ascii'),
+			'brightness': segment.brightness.decode('ascii'),
+			'color': segment.color,
+			'kelvin': segment.kelvin,
+		} for name, segment in self.segments.items()}, separators = (',', ':'))
+
+	def stateChanged(self):
+		"""Save the state once the current burst of changes has settled."""
+		if self.sync is not None:
+			self.sync.changed()
+		if self.state_path is not None and self.save_timer is None:
+			self.save_timer = self.engine.at(self.engine.clock() + STATE_SAVE_DELAY, self.saveState)
+
+	def saveState(self, now = None):
+		self.save_timer = None
+		snapshot = self.snapshot()
+		if snapshot == self.saved_state:
+			return
+		try:
+			with atomicWrite(self.state_path) as f:
+				f.write(snapshot)
+			self.saved_state = snapshot
+		except OSError as e:
+			print("Couldn't save state: %s" % e)
+
+	def restoreState(self):
+		"""Put every segment back the way the last saved state had it."""
+		try:
+			with open(self.state_path) as f:
+				snapshot = f.read()
+			saved = json.loads(snapshot)
+		except FileNotFoundError:
+			return
+		except (OSError, ValueError) as e:
+			print("Couldn't restore state: %s" % e)
+			return
+		self.saved_state = snapshot
+		for name, state in saved.items():
+			segment = self.segments.get(name)
+			if segment is None:
+				continue
+			try:
+				mode = state['mode'].encode('ascii')
+				brightness = state['brightness'].encode('ascii')
+				if mode in (b'w', b'k'):
+					# A ramp is restored as where it ends up
+					command = Command(None, b'w', (state['kelvin'],), None, name)
+				elif mode == b'c':
+					command = Command(None, b'c', (state['color'],), None, name)
+				elif mode in MODES:
+					command = Command(None, b'm', (mode,), None, name)
+				else:
+					# Streamed frames are gone
+					command = Command(None, b'm', (b'0',), None, name)
+				self.applyMode(segment, command)
+				if brightness in BRIGHTNESS_LEVELS:
+					self.setBrightness(segment, BRIGHTNESS_LEVELS[brightness])
+					segment.brightness = brightness
+			except Exception as e:
+				# Leave it off rather than fail to start
+				print("Couldn't restore segment %s: %s" % (name, e))
+
+	def unschedule(self):
+		for timer, command in self.scheduled:
+			timer.cancel()
+		self.scheduled = []
+
+	def apply(self, command, start = None, seed = None):
+		"""Apply a command now; see applyMode() for start and seed."""
+		args = command.args
+		if command.at is not None:
+			self.schedule(command)
+			return
+
+		elif command.command == UNSCHEDULE:
+			self.unschedule()
+			return
+
+		elif command.command == QUERY:
+			# Nothing to do; the ACK carries the state
+			return
+
+		elif command.command == PROFILE:
+			if args[0]:
+				self.engine.instruments.startProfile()
 			else:
-				yellow = max(min(yellow + random.choice((-1, 1)), CANDLESIM_YELLOW_MAX - 1), 0)
-			updateRomanticColor(self, red, yellow)
-
-	def modeOff(self):
-		self.setBrightness(MODE_OFF_BRIGHTNESS)
-		self.strip.show()
-
-	async def handle_client(self, reader, writer):
-		while not reader.at_eof():
-			command = await reader.read(1)
-			if command == b'm':
-				mode = await reader.read(1)
-				if mode == b'x':
-					self.modeChristmas()
-				elif mode == b'e':
-					self.modeEaster()
-				elif mode == b'a':
-					self.modeRainbow()
-				elif mode == b'r':
-					self.modeRomantic()
-				elif mode == b's':
-					self.modeSkylight()
-				elif mode == b'0':
-					self.modeOff()
-
-				# Update stored mode
-				self.mode = mode
-
-			elif command == b'b':
-				brightness = await reader.read(1)
+				print(self.engine.instruments.stopProfile(PROFILE_PATH))
+			return
+
+		targets = self.targets(command.segment)
+		if command.command == b'b':
+			brightness = args[0]
+			for segment in targets:
 				if brightness == b'f':                 # Full
-					self.brightnessFull()
+					self.brightnessFull(segment)
 				elif brightness == b'm':               # Medium
-					self.brightnessMedium()
+					self.brightnessMedium(segment)
 				elif brightness == b'd':               # Dim
-					self.brightnessDim()
+					self.brightnessDim(segment)
+				else:
+					raise ProtocolError("Unknown brightness %s" % brightness)
 
 				# Update stored brightness
-				self.brightness = brightness
-
-			elif command == b'w':
-				temperature = await reader.read(5)
-				try:
-					temperature = int(temperature.decode('ascii').lstrip('0'))
-				except ValueError:
-					temperature = 2900
-
-				self.color = getWhite(temperature)
-				setColor(self.strip, self.color)
-				self.strip.show()
-
-			elif command == b'c':
-				self.color = correctColor()(int(str(await reader.read(6), encoding='ascii'), 16))
-				setColor(self.strip, self.color)
-				self.strip.show()
+				segment.brightness = brightness
+			return
+
+		self.stopStream()
+		try:
+			for segment in targets:
+				self.applyMode(segment, command, start, seed)
+		finally:
+			# The stream covered every segment, and the ones that haven't got
+			# a mode of their own mustn't keep showing its last frame
+			for segment in self.segments.values():
+				if segment.mode == FRAME:
+					self.applyMode(segment, Command(None, b'm', (b'0',), None))
+		self.stopAudio()
+		if command.command == b'm' and args[0] == b'0':
+			self.frame.show()
+
+	def applyMode(self, segment, command, start = None, seed = None):
+		"""Set a segment's mode from a mode, white, Kelvin ramp or color command.
+
+		start (on the engine's clock) and seed default to now and a random
+		seed; a follower passes the leader's so its frames match.
+		"""
+		previous = (segment.start, segment.seed, segment.view.white)
+		segment.start = self.engine.clock() if start is None else start
+		segment.seed = random.getrandbits(32) if seed is None else seed
+		# Solid colors are white balanced on the way out; other modes' colors are used as they are
+		segment.view.white = LED_NO_CORRECTION
+		try:
+			command = self._setMode(segment, command)
+		except ProtocolError:
+			# Nothing changed, so the current mode carries on as it was
+			segment.start, segment.seed, segment.view.white = previous
+			raise
+		segment.command = command._replace(seq = None, segment = None, at = None)
+
+	def _setMode(self, segment, command):
+		# Returns command, with any out of range values clamped
+		args = command.args
+		if command.command == b'm':
+			mode = args[0]
+			if mode == b'x':
+				self.modeChristmas(segment)
+			elif mode == b'e':
+				self.modeEaster(segment)
+			elif mode == b'a':
+				self.modeRainbow(segment)
+			elif mode == b'r':
+				self.modeRomantic(segment)
+			elif mode == b's':
+				self.modeSkylight(segment)
+			elif mode == b'v':
+				self.modeAudio(segment)
+			elif mode == b'p':
+				self.modeReplay(segment)
+			elif mode == b'0':
+				self.modeOff(segment)
 			else:
-				print("Unknown command %s" % command)
-
-	@staticmethod
-	async def updateLighting(self):
-		while True:
-			if self.mode == b's':
-				self.modeSkylight()
-			elif self.mode == b'r':
-				self.modeRomanticUpdate()
-			await asyncio.sleep(0.1)
+				raise ProtocolError("Unknown mode %s" % mode)
+
+			# Update stored mode
+			segment.mode = mode
+
+		elif command.command == b'w':
+			# Clamped here so that the state, ACKs and saved state all stay in range
+			command = command._replace(args = (clampKelvin(args[0]),))
+			segment.mode = b'w'
+			segment.kelvin = command.args[0]
+			segment.color = getWhite(segment.kelvin)
+			self.modeSolid(segment, segment.color)
+
+		elif command.command == b'k':
+			# Fade between two temperatures
+			start, end, duration = args
+			command = command._replace(args = (clampKelvin(start), clampKelvin(end), duration))
+			segment.mode = b'k'
+			segment.kelvin = command.args[1]
+			segment.color = getWhite(segment.kelvin)
+			self.modeKelvinRamp(segment, command.args[0], segment.kelvin, duration)
+
+		elif command.command == b'c':
+			segment.mode = b'c'
+			segment.kelvin = 0
+			segment.color = args[0]
+			segment.view.white = LED_PURE_WHITE_CORRECTION
+			self.modeSolid(segment, segment.color)
+
+		return command
+
+	def streamFrame(self, slot):
+		"""Show a streamed frame; streaming takes over every segment."""
+		self.stream.submit(slot, self.engine.clock())
+		if self.engine.renderer() is not self.stream:
+			for segment in self.segments.values():
+				segment.mode = FRAME
+				self.engine.setRenderer(None, segment.name)
+				self.setBrightness(segment, MODE_FULL_BRIGHTNESS)
+			self.engine.setRenderer(self.stream)
+		else:
+			self.engine.wakeLayer()
+
+	def stats(self):
+		stats = self.engine.instruments.summary()
+		stats['segments'] = {name: {
+			'mode': segment.mode.decode('ascii'),
+			'brightness': segment.brightness.decode('ascii'),
+			'leds': len(segment.view),
+		} for name, segment in self.segments.items()}
+		stats['frames'] = {
+			'rendered': self.frame.frames_rendered,
+			'pushed': self.frame.frames_pushed,
+			'dropped': self.engine.frames_dropped,
+			'stale': sum(layer.worker.stale for layer in self.engine.layers.values() if layer.worker is not None),
+		}
+		stats['stream'] = self.stream.stats()
+		if self.audio is not None:
+			stats['audio'] = self.audio.stats()
+		if self.sync is not None:
+			stats['sync'] = self.sync.stats()
+		stats['scheduled'] = [{
+			'at': command.at,
+			'command': command.command.decode('ascii'),
+			'segment': command.segment,
+		} for timer, command in self.scheduled]
+		stats['sun'] = {
+			'evaluations': self.sun.evaluations,
+			'evaluation_time_s': self.sun.evaluation_time,
+		}
+		return stats
+
+	def handleCommands(self, commands, received = None):
+		"""Apply a burst of commands; returns the ACKs and replies to send back.
+
+		received is the perf_counter() time the burst arrived.
+		"""
+		# Only the latest command of each kind in a burst needs applying
+		to_apply, superseded = coalesce([command for command in commands if command.command not in (FRAME, STATS)])
+		status = {id(command): ACK_SUPERSEDED for command in superseded}
+		for command in commands:
+			if command.command == FRAME and command.error is None:
+				self.streamFrame(command.args[0])
+		for command in to_apply:
+			try:
+				self.apply(command)
+				status[id(command)] = ACK_APPLIED
+			except ProtocolError as e:
+				print(e)
+				status[id(command)] = ACK_ERROR
+		# Only commands that change the strips have a latency worth timing;
+		# the webserver's state queries would swamp the rest
+		changes = any(command.at is None and command.command in CATEGORIES for command in to_apply)
+		if changes and received is not None:
+			self.engine.markCommand(received)
+		if changes:
+			self.stateChanged()
+		for command in commands:
+			if command.error is not None:
+				print("Bad %s command: %s" % (command.command, command.error))
+
+		replies = []
+		for command in commands:
+			if command.seq is None or command.command == FRAME:
+				continue
+			if command.command == STATS and command.error is None:
+				replies.append(encodeReply(command.seq, json.dumps(self.stats()).encode('utf-8')))
+			else:
+				try:
+					state = self.state(command.segment)
+				except ProtocolError:
+					state = self.state()
+				replies.append(encodeAck(command.seq, status.get(id(command), ACK_ERROR), state))
+		return b''.join(replies)
+
+class LEDServerProtocol(asyncio.BufferedProtocol):
+	"""One client connection.
+
+	Incoming bytes are received directly into the command parser's buffer,
+	or for streamed frames directly into the frame slot, with no
+	intermediate copies.  Everything that arrives in one read is handled as
+	one burst.
+	"""
+	def __init__(self, handler):
+		self.handler = handler
+		self.parser = CommandParser(frame_size = len(handler.frame) * 3, frame_sink = handler.stream.acquire, \
+		                            size = COMMAND_BUFFER_SIZE)
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def get_buffer(self, sizehint):
+		return self.parser.getBuffer(sizehint)
+
+	def buffer_updated(self, nbytes):
+		received = time.perf_counter()
+		commands = self.parser.bufferUpdated(nbytes)
+		if commands:
+			acks = self.handler.handleCommands(commands, received)
+			if acks:
+				self.transport.write(acks)
+
+def notifyReady():
+	"""Tell whatever started the server that it's listening.
+
+	Writes READY_PATH, and if systemd is watching (Type=notify) sends it
+	READY=1 over $NOTIFY_SOCKET.
+	"""
+	try:
+		with open(READY_PATH, 'w') as f:
+			f.write('%d\n' % os.getpid())
+	except OSError as e:
+		print("Couldn't write %s: %s" % (READY_PATH, e))
+	address = os.environ.get('NOTIFY_SOCKET')
+	if address:
+		if address.startswith('@'):
+			# Abstract socket namespace
+			address = '\0' + address[1:]
+		try:
+			with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+				sock.connect(address)
+				sock.sendall(b'READY=1')
+		except OSError as e:
+			print("Couldn't notify systemd: %s" % e)
 
 async def main():
-	ctx = LEDServerHandler()
-	server = await asyncio.start_server(ctx.handle_client, LOCALHOST, LED_INTERFACE_PORT)
-	loop = server.get_loop()
-	task = loop.create_task(LEDServerHandler.updateLighting(ctx), name='update')
-	async with server:
-		await server.serve_forever()
+	if os.path.exists(READY_PATH):
+		os.remove(READY_PATH)
+	clock = time.monotonic
+	if SYNC_ROLE is not None:
+		import sync
+		if SYNC_ROLE == 'follower':
+			clock = sync.SyncClock()
+		elif SYNC_ROLE != 'leader':
+			sys.exit("PARTYMODE_SYNC must be leader or follower, not %s" % SYNC_ROLE)
+	ctx = LEDServerHandler(STATE_PATH, clock)
+	loop = asyncio.get_running_loop()
+	# Start drawing the restored state while the listener comes up
+	task = loop.create_task(ctx.engine.run(), name='update')
+	server = await loop.create_server(lambda: LEDServerProtocol(ctx), LOCALHOST, LED_INTERFACE_PORT)
+	if SYNC_ROLE == 'leader':
+		ctx.sync = sync.SyncLeader(ctx)
+	elif SYNC_ROLE == 'follower':
+		ctx.sync = sync.SyncFollower(ctx, clock)
+	if ctx.sync is not None:
+		await ctx.sync.start()
+	# systemd (and so a reboot) stops the server with SIGTERM
+	stopped = loop.create_future()
+	loop.add_signal_handler(signal.SIGTERM, lambda: stopped.done() or stopped.set_result(None))
+	notifyReady()
+	try:
+		async with server:
+			await stopped
+	finally:
+		if ctx.sync is not None:
+			ctx.sync.close()
+		if ctx.save_timer is not None:
+			ctx.saveState()
+		ctx.engine.close()
+		if os.path.exists(READY_PATH):
+			os.remove(READY_PATH)
 
 if __name__ == '__main__':
 	asyncio.run(main())
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
-from pysolar.solar import *
-from rgbxy import Converter as ColorspaceConverter
+# pysolar and rgbxy are slow to import, so they're only loaded once they're
+# needed: most of the time the server never touches the sky
+import os
+import sys
+import time
+import argparse
 import datetime
 import numpy as np
 import math
 
+from atomicfile import atomicWrite
+
 class SkyLight:
 	ZENITH_CHROMATICITY_MATRIX_x = np.array([ \
 		[0.0017,	-0.0037,	0.0021,		0.000], \
@@ -39,6 +45,7 @@ class SkyLight:
 		[-0.0109,	0.0529]])
 
 	def __init__(self):
+		from rgbxy import Converter as ColorspaceConverter
 		self.colorspace_converter = ColorspaceConverter()
 
 	@staticmethod
@@ -60,14 +67,14 @@ class SkyLight:
 	def zenithChromaticity(self, turbidity, sun_theta):
 		turbidity_row = np.array([[math.pow(turbidity, 2.0), turbidity, 1.0]])
 		sun_angle_col = np.array([[math.pow(sun_theta, 3.0)], [math.pow(sun_theta, 2.0)], [sun_theta], [1.0]])
-		return (turbidity_row @ self.ZENITH_CHROMATICITY_MATRIX_x @ sun_angle_col, \
-		        turbidity_row @ self.ZENITH_CHROMATICITY_MATRIX_y @ sun_angle_col)
+		return ((turbidity_row @ self.ZENITH_CHROMATICITY_MATRIX_x @ sun_angle_col).item(), \
+		        (turbidity_row @ self.ZENITH_CHROMATICITY_MATRIX_y @ sun_angle_col).item())
 
 	def skyYxy(self, turbidity, theta, gamma, sun_theta):
 		turbidity_col = np.array([[turbidity], [1.0]])
-		AY, BY, CY, DY, EY = list(self.COEFFICIENTS_Y @ turbidity_col)
-		Ax, Bx, Cx, Dx, Ex = list(self.COEFFICIENTS_x @ turbidity_col)
-		Ay, By, Cy, Dy, Ey = list(self.COEFFICIENTS_y @ turbidity_col)
+		AY, BY, CY, DY, EY = (self.COEFFICIENTS_Y @ turbidity_col).ravel()
+		Ax, Bx, Cx, Dx, Ex = (self.COEFFICIENTS_x @ turbidity_col).ravel()
+		Ay, By, Cy, Dy, Ey = (self.COEFFICIENTS_y @ turbidity_col).ravel()
 
 		Yz = self.zenithLuminance(turbidity, sun_theta)
 		Y = SkyLight.componentByAngle(AY, BY, CY, DY, EY, Yz, theta, gamma, sun_theta)
@@ -81,3 +88,281 @@ class SkyLight:
 		Y, x, y = self.skyYxy(turbidity, theta, gamma, sun_theta)
 		r, g, b = self.colorspace_converter.xy_to_rgb(x, y)
 		return (r, g, b)
+
+	# Batched versions of the above: theta and gamma may be arrays (one entry
+	# per LED), and everything is evaluated in a single NumPy pass.
+
+	@staticmethod
+	def angleToSun(theta, phi, sun_theta, sun_phi):
+		"""Angle (gamma) between view directions (theta, phi) and the sun."""
+		cos_gamma = np.cos(sun_theta) * np.cos(theta) + \
+		            np.sin(sun_theta) * np.sin(theta) * np.cos(phi - sun_phi)
+		return np.arccos(np.clip(cos_gamma, -1.0, 1.0))
+
+	@staticmethod
+	def componentFArray(coefficients, theta, gamma):
+		A, B, C, D, E = coefficients
+		return (1.0 + A * np.exp(B / np.cos(theta))) * \
+		       (1.0 + C * np.exp(D * gamma) + E * np.cos(gamma) ** 2)
+
+	def skyYxyArray(self, turbidity, theta, gamma, sun_theta):
+		theta = np.asarray(theta, dtype=np.float64)
+		gamma = np.asarray(gamma, dtype=np.float64)
+		turbidity_col = np.array([turbidity, 1.0])
+		xz, yz = self.zenithChromaticity(turbidity, sun_theta)
+		zenith_values = (self.zenithLuminance(turbidity, sun_theta), xz, yz)
+		coefficient_sets = (self.COEFFICIENTS_Y, self.COEFFICIENTS_x, self.COEFFICIENTS_y)
+
+		Yxy = []
+		for coefficients, zenith_value in zip(coefficient_sets, zenith_values):
+			coefficients = coefficients @ turbidity_col
+			Yxy.append(zenith_value * SkyLight.componentFArray(coefficients, theta, gamma) / \
+			           SkyLight.componentFArray(coefficients, 0.0, sun_theta))
+		return tuple(Yxy)
+
+	def xyToRGBArray(self, x, y):
+		"""Vectorized equivalent of `Converter.xy_to_rgb` (brightness 1).
+
+		Returns an (..., 3) uint8 array.
+		"""
+		gamut = self.colorspace_converter.color
+		red = np.array([gamut.Red.x, gamut.Red.y])
+		lime = np.array([gamut.Lime.x, gamut.Lime.y])
+		blue = np.array([gamut.Blue.x, gamut.Blue.y])
+		cross = lambda p1, p2: p1[..., 0] * p2[..., 1] - p1[..., 1] * p2[..., 0]
+
+		x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+		point = np.stack((x, y), axis=-1)
+
+		# Pull chromaticities the LEDs can't reproduce onto the closest gamut edge
+		v1 = lime - red
+		v2 = blue - red
+		q = point - red
+		s = cross(q, v2) / cross(v1, v2)
+		t = cross(v1, q) / cross(v1, v2)
+		in_reach = (s >= 0.0) & (t >= 0.0) & (s + t <= 1.0)
+
+		candidates = []
+		for a, b in ((red, lime), (blue, red), (lime, blue)):
+			ab = b - a
+			along = np.clip(((point - a) @ ab) / (ab @ ab), 0.0, 1.0)
+			candidates.append(a + along[..., np.newaxis] * ab)
+		candidates = np.stack(candidates)
+		closest = np.argmin(np.linalg.norm(candidates - point, axis=-1), axis=0)
+		clamped = np.take_along_axis(candidates, closest[np.newaxis, ..., np.newaxis], axis=0)[0]
+		point = np.where(in_reach[..., np.newaxis], point, clamped)
+
+		# xyY (Y = 1) -> XYZ -> wide gamut RGB
+		x, y = point[..., 0], point[..., 1]
+		XYZ = np.stack((x / y, np.ones_like(x), (1.0 - x - y) / y), axis=-1)
+		rgb = XYZ @ np.array([[1.656492, -0.354851, -0.255038], \
+		                      [-0.707196, 1.655397, 0.036152], \
+		                      [0.051713, -0.121364, 1.011530]]).T
+
+		# Reverse gamma, then normalize so the largest component is at most 1
+		rgb = np.where(rgb <= 0.0031308, 12.92 * rgb, \
+		               1.055 * np.power(np.maximum(rgb, 0.0031308), 1.0 / 2.4) - 0.055)
+		rgb = np.maximum(rgb, 0.0)
+		rgb /= np.maximum(rgb.max(axis=-1, keepdims=True), 1.0)
+		return (rgb * 255).astype(np.uint8)
+
+	def skyRGBArray(self, turbidity, theta, gamma, sun_theta):
+		Y, x, y = self.skyYxyArray(turbidity, theta, gamma, sun_theta)
+		return self.xyToRGBArray(x, y)
+
+class SunPositionCache:
+	"""Sun altitude/azimuth for one location, sampled every `step` seconds.
+
+	Samples for the current UTC day live in two compact float32 arrays and are
+	filled in the first time they are needed, so a lookup costs an
+	interpolation plus (at most) one pysolar evaluation per `step`.  Crossing
+	into a new UTC day or changing the location discards the table.
+	"""
+	def __init__(self, latitude, longitude, step = 60):
+		self.latitude = latitude
+		self.longitude = longitude
+		self.step = step
+		self.samples = 86400 // step + 1
+		self.day = None
+		self.evaluations = 0
+		self.evaluation_time = 0.0
+
+	def setLocation(self, latitude, longitude):
+		if (latitude, longitude) != (self.latitude, self.longitude):
+			self.latitude = latitude
+			self.longitude = longitude
+			self.day = None
+
+	def _startDay(self, day):
+		self.day = day
+		self.altitude = np.full(self.samples, np.nan, dtype=np.float32)
+		self.azimuth = np.full(self.samples, np.nan, dtype=np.float32)
+
+	def _sample(self, i):
+		if np.isnan(self.altitude[i]):
+			from pysolar.solar import get_altitude, get_azimuth
+			started = time.perf_counter()
+			when = self.day + datetime.timedelta(seconds = i * self.step)
+			self.altitude[i] = get_altitude(self.latitude, self.longitude, when)
+			self.azimuth[i] = get_azimuth(self.latitude, self.longitude, when)
+			self.evaluations += 1
+			self.evaluation_time += time.perf_counter() - started
+
+	def _index(self, date):
+		date = date.astimezone(datetime.timezone.utc)
+		day = datetime.datetime(date.year, date.month, date.day, tzinfo = datetime.timezone.utc)
+		if day != self.day:
+			self._startDay(day)
+		offset = (date - day).total_seconds() / self.step
+		i = min(int(offset), self.samples - 2)
+		return i, offset - i
+
+	def precompute(self, date):
+		"""Fill in every sample for date's UTC day up front."""
+		self._index(date)
+		for i in range(self.samples):
+			self._sample(i)
+
+	def position(self, date):
+		"""Return the sun's (altitude, azimuth) in degrees at an aware datetime."""
+		i, frac = self._index(date)
+		self._sample(i)
+		self._sample(i + 1)
+		altitude = self.altitude[i] + frac * (self.altitude[i + 1] - self.altitude[i])
+		# Azimuth wraps around at 360 degrees
+		delta = (self.azimuth[i + 1] - self.azimuth[i] + 180.0) % 360.0 - 180.0
+		azimuth = (self.azimuth[i] + frac * delta) % 360.0
+		return float(altitude), float(azimuth)
+
+class SkyLightTable:
+	"""Precomputed SkyLight colors, looked up instead of evaluating the model.
+
+	RGB is sampled on a dense grid over sun zenith angle, view zenith angle
+	(theta) and view-to-sun angle (gamma) for each turbidity in the table;
+	lookups interpolate linearly between samples.  `skyRGBArray` has the
+	same signature as SkyLight's, so the two are interchangeable.
+	"""
+	SUN_THETA_STEPS = 91       # 1 degree steps over 0..90
+	THETA_STEPS = 46           # 2 degree steps over 0..90
+	GAMMA_STEPS = 91           # 2 degree steps over 0..180
+
+	def __init__(self, turbidities, table):
+		self.turbidities = np.asarray(turbidities, dtype=np.float64)
+		self.table = table
+		self.sun_thetas = np.linspace(0.0, 0.5 * math.pi, self.SUN_THETA_STEPS)
+		self.thetas = np.linspace(0.0, 0.5 * math.pi, self.THETA_STEPS)
+		self.gammas = np.linspace(0.0, math.pi, self.GAMMA_STEPS)
+		self._slice_key = None
+
+	@classmethod
+	def build(cls, turbidities = (4,), skylight = None):
+		skylight = SkyLight() if skylight is None else skylight
+		table = np.zeros((len(turbidities), cls.SUN_THETA_STEPS, cls.THETA_STEPS, cls.GAMMA_STEPS, 3), dtype=np.uint8)
+		sky = cls(turbidities, table)
+		theta, gamma = np.meshgrid(sky.thetas, sky.gammas, indexing='ij')
+		for t, turbidity in enumerate(turbidities):
+			for s, sun_theta in enumerate(sky.sun_thetas):
+				table[t, s] = skylight.skyRGBArray(turbidity, theta, gamma, sun_theta)
+		return sky
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as data:
+			return cls(data['turbidities'], data['table'])
+
+	@classmethod
+	def cached(cls, path, turbidities = (4,)):
+		"""Load the table at path, (re)building and saving it if it's missing or stale."""
+		try:
+			sky = cls.load(path)
+			if sky.table.shape[1:4] == (cls.SUN_THETA_STEPS, cls.THETA_STEPS, cls.GAMMA_STEPS) and \
+			   np.array_equal(sky.turbidities, np.asarray(turbidities, dtype=np.float64)):
+				return sky
+		except Exception as e:
+			# Missing, or cut short or mangled (e.g. by a power cut): build it again
+			if not isinstance(e, FileNotFoundError):
+				print("Rebuilding sky table %s: %s" % (path, e))
+		sky = cls.build(turbidities)
+		try:
+			sky.save(path)
+		except OSError as e:
+			print("Unable to save sky table to %s: %s" % (path, e))
+		return sky
+
+	def save(self, path):
+		with atomicWrite(path, 'wb') as f:
+			np.savez_compressed(f, turbidities=self.turbidities, table=self.table)
+
+	@staticmethod
+	def _locate(grid, value):
+		# Index of the sample at or below value, and how far it is towards the next
+		position = np.interp(value, grid, np.arange(len(grid)))
+		i = np.minimum(np.floor(position).astype(np.intp), len(grid) - 2)
+		return i, position - i
+
+	def _sunSlice(self, turbidity, sun_theta):
+		# Colors over (theta, gamma) for one sun position, kept until the sun moves
+		key = (turbidity, sun_theta)
+		if key != self._slice_key:
+			if len(self.turbidities) > 1:
+				t, t_frac = self._locate(self.turbidities, turbidity)
+				by_turbidity = (1.0 - t_frac) * self.table[t] + t_frac * self.table[t + 1]
+			else:
+				by_turbidity = self.table[0]
+			s, s_frac = self._locate(self.sun_thetas, sun_theta)
+			self._slice = (1.0 - s_frac) * by_turbidity[s] + s_frac * by_turbidity[s + 1]
+			self._slice_key = key
+		return self._slice
+
+	def skyRGBArray(self, turbidity, theta, gamma, sun_theta):
+		sky = self._sunSlice(turbidity, sun_theta)
+		i, i_frac = self._locate(self.thetas, theta)
+		j, j_frac = self._locate(self.gammas, gamma)
+		i_frac = i_frac[..., np.newaxis]
+		j_frac = j_frac[..., np.newaxis]
+		rgb = (1.0 - i_frac) * ((1.0 - j_frac) * sky[i, j] + j_frac * sky[i, j + 1]) + \
+		      i_frac * ((1.0 - j_frac) * sky[i + 1, j] + j_frac * sky[i + 1, j + 1])
+		return (rgb + 0.5).astype(np.uint8)
+
+	def validate(self, skylight = None, samples = 100000, seed = 0):
+		"""Compare random lookups against the analytic model.
+
+		Returns (maximum, mean) absolute error over all channels, in 0-255 units.
+		"""
+		skylight = SkyLight() if skylight is None else skylight
+		rng = np.random.default_rng(seed)
+		max_error = 0
+		total_error = 0.0
+		for turbidity in self.turbidities:
+			for sun_theta in rng.uniform(0.0, 0.5 * math.pi, 100):
+				theta = rng.uniform(0.0, 0.5 * math.pi, samples // 100)
+				gamma = rng.uniform(0.0, math.pi, samples // 100)
+				error = np.abs(self.skyRGBArray(turbidity, theta, gamma, sun_theta).astype(np.int16) - \
+				               skylight.skyRGBArray(turbidity, theta, gamma, sun_theta).astype(np.int16))
+				max_error = max(max_error, int(error.max()))
+				total_error += error.mean()
+		return max_error, total_error / (100 * len(self.turbidities))
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Build or check the precomputed skylight color table')
+	parser.add_argument('path', help = 'table file (.npz)')
+	parser.add_argument('-t', '--turbidity', type = float, action = 'append', help = 'turbidity to tabulate (repeatable, default 4)')
+	parser.add_argument('--validate', action = 'store_true', help = 'report the error against the analytic model')
+	parser.add_argument('--tolerance', type = int, default = 8, help = 'fail validation above this error (0-255 scale)')
+	args = parser.parse_args()
+
+	turbidities = tuple(args.turbidity) if args.turbidity else (4,)
+	if args.validate and os.path.exists(args.path):
+		sky = SkyLightTable.load(args.path)
+	else:
+		sky = SkyLightTable.build(turbidities)
+		sky.save(args.path)
+		print("Wrote %s (%d bytes)" % (args.path, os.path.getsize(args.path)))
+	if args.validate:
+		max_error, mean_error = sky.validate()
+		print("Max error %d, mean error %.3f (0-255 scale)" % (max_error, mean_error))
+		return 1 if max_error > args.tolerance else 0
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
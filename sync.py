@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# Synchronized playback across several servers.  One server leads: it
+# multicasts a beacon with every segment's mode whenever something changes,
+# and once a second anyway.  The others follow: they keep their clocks on
+# the leader's by pinging it, and set the same modes with the same start
+# times and seeds.  Every mode draws each frame from the start time, the
+# seed and the clock alone, so the followers' strips match the leader's
+# without a single frame crossing the network.
+#
+# Run the leader with PARTYMODE_SYNC=leader and the rest with
+# PARTYMODE_SYNC=follower; to try it on one machine, give each server its
+# own PARTYMODE_PORT and PARTYMODE_RUN_DIR and set
+# PARTYMODE_SYNC_INTERFACE=127.0.0.1.
+
+import os
+import time
+import random
+import socket
+import struct
+import asyncio
+import collections
+
+from protocol import *
+
+SYNC_GROUP = os.environ.get('PARTYMODE_SYNC_GROUP', '239.42.37.1')
+SYNC_PORT = int(os.environ.get('PARTYMODE_SYNC_PORT', 4238))
+# Address of the network interface to multicast on (any: the default route's)
+SYNC_INTERFACE = os.environ.get('PARTYMODE_SYNC_INTERFACE', '0.0.0.0')
+# Multicast hops; 1 keeps beacons on the local network
+SYNC_TTL = 1
+
+SYNC_MAGIC = b'PMSY'
+SYNC_VERSION = 2
+SYNC_HEADER = struct.Struct('!4sBcId')    # magic, version, kind, leader epoch, time
+SYNC_SEGMENT = struct.Struct('!dIcBH')    # start time, seed, brightness letter and level, mode command length
+SYNC_ECHO = struct.Struct('!d')           # the ping's time, sent back with the leader's
+BEACON = b'b'
+PING = b'p'
+PONG = b'q'
+
+# Seconds between beacons when nothing changes
+SYNC_BEACON_INTERVAL = 1.0
+
+# Clock offset samples kept; the one with the shortest round trip is used
+SYNC_SAMPLES = 8
+# Seconds between pings, quicker until there are SYNC_SAMPLES samples
+SYNC_PING_INTERVAL = 1.0
+SYNC_FAST_PING_INTERVAL = 0.05
+# Longest round trip worth taking a sample from
+SYNC_MAX_RTT = 0.25
+# An offset change bigger than this is a jump (e.g. a new leader), and every
+# mode is set again on the new clock
+SYNC_STEP = 0.1
+
+def segmentCommands(data):
+	"""A beacon's segments, as (name, start, seed, brightness, level, command) tuples."""
+	segments = []
+	pos = SYNC_HEADER.size
+	while pos < len(data):
+		start, seed, brightness, level, length = SYNC_SEGMENT.unpack_from(data, pos)
+		pos += SYNC_SEGMENT.size
+		commands = CommandParser().feed(data[pos:pos + length])
+		pos += length
+		if len(commands) != 1 or commands[0].error is not None or commands[0].segment is None:
+			raise ProtocolError("Bad segment command in beacon")
+		command = commands[0]._replace(seq = None)
+		segments.append((command.segment, start, seed, brightness, level, command))
+	return segments
+
+class SyncClock:
+	"""monotonic() moved onto the leader's clock by `offset` seconds."""
+	def __init__(self):
+		self.offset = 0.0
+
+	def __call__(self):
+		return time.monotonic() + self.offset
+
+class SyncLeader(asyncio.DatagramProtocol):
+	"""Multicasts the handler's segments, and answers followers' pings.
+
+	`epoch` is picked at random on startup, so followers can tell when
+	the leader has restarted (or been replaced) and resynchronize.
+	"""
+	def __init__(self, handler, group = SYNC_GROUP, port = SYNC_PORT, interface = SYNC_INTERFACE):
+		self.handler = handler
+		self.group = (group, port)
+		self.interface = interface
+		self.epoch = random.getrandbits(32)
+		self.transport = None
+		self.timer = None
+		self.beacons = 0
+		self.pings = 0
+
+	async def start(self):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, SYNC_TTL)
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+		sock.bind((self.interface, 0))
+		self.transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(lambda: self, sock = sock)
+		self.changed()
+
+	def close(self):
+		self.handler.engine.cancel(self.timer)
+		if self.transport is not None:
+			self.transport.close()
+
+	def changed(self):
+		"""Send a beacon on the engine's next wakeup."""
+		self._arm(self.handler.engine.clock())
+
+	def _arm(self, when):
+		self.handler.engine.cancel(self.timer)
+		self.timer = self.handler.engine.at(when, self.send)
+
+	def beacon(self, now):
+		parts = [SYNC_HEADER.pack(SYNC_MAGIC, SYNC_VERSION, BEACON, self.epoch, now)]
+		for name, segment in self.handler.segments.items():
+			command = segment.command
+			if segment.mode == FRAME:
+				# Streamed frames only go to this server
+				command = Command(None, b'm', (b'0',), None)
+			encoded = encodeCommand(0, command.command, *command.args, segment = name)
+			level = int(self.handler.engine.targetBrightness(segment.view))
+			parts.append(SYNC_SEGMENT.pack(segment.start, segment.seed, segment.brightness, level, len(encoded)))
+			parts.append(encoded)
+		return b''.join(parts)
+
+	def send(self, now):
+		self.timer = None
+		if self.transport is None:
+			return
+		self.transport.sendto(self.beacon(now), self.group)
+		self.beacons += 1
+		self._arm(now + SYNC_BEACON_INTERVAL)
+
+	def datagram_received(self, data, addr):
+		if len(data) != SYNC_HEADER.size or not data.startswith(SYNC_MAGIC):
+			return
+		magic, version, kind, epoch, sent = SYNC_HEADER.unpack(data)
+		if version == SYNC_VERSION and kind == PING:
+			now = self.handler.engine.clock()
+			self.transport.sendto(SYNC_HEADER.pack(SYNC_MAGIC, SYNC_VERSION, PONG, self.epoch, now) + SYNC_ECHO.pack(sent), addr)
+			self.pings += 1
+
+	def stats(self):
+		return {
+			'role': 'leader',
+			'epoch': self.epoch,
+			'beacons': self.beacons,
+			'pings': self.pings,
+		}
+
+class SyncFollower(asyncio.DatagramProtocol):
+	"""Keeps `clock` (a SyncClock) and the handler's segments on the leader's.
+
+	Each pong gives a round trip time and an estimate of the offset
+	between the clocks, taken as the midpoint of the round trip; the
+	estimate from the fastest of the last SYNC_SAMPLES round trips is
+	used, which on a quiet network is good to a fraction of a
+	millisecond.  Beacons are only followed once the clock is set.
+	"""
+	def __init__(self, handler, clock, group = SYNC_GROUP, port = SYNC_PORT, interface = SYNC_INTERFACE):
+		self.handler = handler
+		self.clock = clock
+		self.group = group
+		self.port = port
+		self.interface = interface
+		self.transport = None             # joined to the group, for beacons
+		self.pinger = None                # for pings and pongs
+		self.leader = None                # the leader's address
+		self.epoch = None
+		self.samples = collections.deque(maxlen = SYNC_SAMPLES)   # (round trip, offset)
+		self.synced = False
+		self.latest = None                # the last beacon's segments
+		self.failed = {}                  # segment name -> the beacon entry that couldn't be applied
+		self.timer = None
+		self.beacons = 0
+		self.jumps = 0
+
+	async def start(self):
+		loop = asyncio.get_running_loop()
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		# Other followers on the same machine share the port
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		sock.bind(('', self.port))
+		membership = socket.inet_aton(self.group) + socket.inet_aton(self.interface)
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+		self.transport, protocol = await loop.create_datagram_endpoint(lambda: self, sock = sock)
+		self.pinger, protocol = await loop.create_datagram_endpoint(lambda: self, local_addr = (self.interface, 0))
+
+	def close(self):
+		self.handler.engine.cancel(self.timer)
+		for transport in (self.transport, self.pinger):
+			if transport is not None:
+				transport.close()
+
+	def changed(self):
+		# Local changes last until the leader's next beacon
+		pass
+
+	def ping(self, now = None):
+		self.timer = None
+		self.pinger.sendto(SYNC_HEADER.pack(SYNC_MAGIC, SYNC_VERSION, PING, 0, time.monotonic()), self.leader)
+		interval = SYNC_PING_INTERVAL if len(self.samples) == SYNC_SAMPLES else SYNC_FAST_PING_INTERVAL
+		self.timer = self.handler.engine.at(self.clock() + interval, self.ping)
+
+	def datagram_received(self, data, addr):
+		if len(data) < SYNC_HEADER.size or not data.startswith(SYNC_MAGIC):
+			return
+		magic, version, kind, epoch, sent = SYNC_HEADER.unpack_from(data)
+		if version != SYNC_VERSION:
+			return
+		if kind == BEACON:
+			self.beaconReceived(data, addr, epoch)
+		elif kind == PONG and epoch == self.epoch and len(data) == SYNC_HEADER.size + SYNC_ECHO.size:
+			self.pongReceived(sent, SYNC_ECHO.unpack_from(data, SYNC_HEADER.size)[0])
+
+	def beaconReceived(self, data, addr, epoch):
+		try:
+			segments = segmentCommands(data)
+		except (ProtocolError, struct.error) as e:
+			print("Bad beacon from %s: %s" % (addr[0], e))
+			return
+		self.beacons += 1
+		if epoch != self.epoch:
+			# A new leader, or the old one restarted: start the clock over
+			print("Following %s:%d" % addr)
+			self.epoch = epoch
+			self.leader = addr
+			self.samples.clear()
+			self.synced = False
+			self.handler.engine.cancel(self.timer)
+			self.ping()
+		self.latest = segments
+		if self.synced:
+			self.follow(segments)
+
+	def pongReceived(self, leader_time, sent):
+		received = time.monotonic()
+		round_trip = received - sent
+		if not 0 <= round_trip <= SYNC_MAX_RTT:
+			return
+		self.samples.append((round_trip, leader_time - 0.5 * (sent + received)))
+		round_trip, offset = min(self.samples)
+		delta = offset - self.clock.offset
+		self.clock.offset = offset
+		if not self.synced or abs(delta) > SYNC_STEP:
+			# Keep what's scheduled where it was, and set every mode again on the new clock
+			self.handler.engine.shiftClock(delta)
+			self.jumps += 1
+			self.synced = True
+			if self.latest is not None:
+				self.follow(self.latest, force = True)
+
+	def follow(self, segments, force = False):
+		"""Set every segment whose mode, start, seed or brightness differs from the leader's."""
+		changed = False
+		for name, start, seed, brightness, level, command in segments:
+			segment = self.handler.segments.get(name)
+			if segment is None:
+				continue
+			mode = command._replace(segment = None)
+			entry = (mode, start, seed)
+			if force or (entry != (segment.command, segment.start, segment.seed) and self.failed.get(name) != entry):
+				try:
+					self.handler.apply(command, start, seed)
+					self.failed.pop(name, None)
+				except ProtocolError as e:
+					print("Can't follow segment %s: %s" % (name, e))
+					self.failed[name] = entry
+				changed = True
+			if brightness != segment.brightness and brightness in BRIGHTNESSES:
+				self.handler.apply(Command(None, b'b', (brightness,), None, name))
+				changed = True
+			if self.handler.engine.targetBrightness(segment.view) != level:
+				# Modes like off set the level without a brightness command
+				self.handler.setBrightness(segment, level)
+		if changed:
+			self.handler.stateChanged()
+
+	def stats(self):
+		return {
+			'role': 'follower',
+			'leader': None if self.leader is None else self.leader[0],
+			'synced': self.synced,
+			'offset': self.clock.offset,
+			'round_trip': min(self.samples)[0] if self.samples else None,
+			'beacons': self.beacons,
+			'jumps': self.jumps,
+		}
@@ -0,0 +1,43 @@
+# Tests for replacing files in one go
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from atomicfile import atomicWrite
+
+class AtomicWriteTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.directory.name, 'state')
+		with open(self.path, 'w') as f:
+			f.write('old')
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def read(self):
+		with open(self.path) as f:
+			return f.read()
+
+	def testReplaced(self):
+		with atomicWrite(self.path) as f:
+			f.write('new')
+			# Nothing changes until the block ends
+			self.assertEqual(self.read(), 'old')
+		self.assertEqual(self.read(), 'new')
+		self.assertEqual(os.listdir(self.directory.name), ['state'])
+
+	def testFailedWriteLeavesFile(self):
+		with self.assertRaises(RuntimeError):
+			with atomicWrite(self.path, 'wb') as f:
+				f.write(b'half')
+				raise RuntimeError
+		self.assertEqual(self.read(), 'old')
+		self.assertEqual(os.listdir(self.directory.name), ['state'])
+
+if __name__ == '__main__':
+	unittest.main()
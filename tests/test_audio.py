@@ -0,0 +1,46 @@
+# Tests for the band analysis behind the audio mode
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from audio import *
+
+def sine(frequency, amplitude = 0.5, count = AUDIO_FFT_SIZE, rate = AUDIO_RATE):
+	return (amplitude * np.sin(2 * np.pi * frequency * np.arange(count) / rate)).astype(np.float32)
+
+class BandAnalyzerTest(unittest.TestCase):
+	def testPeakBand(self):
+		# A sine in the middle of each band comes out loudest in that band
+		bins = BandAnalyzer().bins
+		for band in range(AUDIO_BANDS):
+			analyzer = BandAnalyzer()
+			analyzer.push(sine((bins[band] + bins[band + 1] - 1) / 2.0 * AUDIO_RATE / AUDIO_FFT_SIZE))
+			levels = analyzer.analyze(AUDIO_BLOCK / AUDIO_RATE)
+			self.assertEqual(int(np.argmax(levels)), band)
+			self.assertEqual(levels.max(), 1.0)
+
+	def testSilence(self):
+		analyzer = BandAnalyzer()
+		analyzer.push(np.zeros(AUDIO_FFT_SIZE, dtype=np.float32))
+		self.assertEqual(analyzer.analyze(0.1).max(), 0.0)
+
+	def testRelease(self):
+		# Levels fall away after the sound stops, rather than dropping at once
+		analyzer = BandAnalyzer()
+		analyzer.push(sine(1000.0))
+		band = int(np.argmax(analyzer.analyze(0.0)))
+		analyzer.push(np.zeros(AUDIO_FFT_SIZE, dtype=np.float32))
+		level = analyzer.analyze(AUDIO_RELEASE_TIME)[band]
+		self.assertAlmostEqual(level, math.exp(-1), places = 5)
+
+	def testSamples(self):
+		data = np.array([0, 16384, -32768], dtype='<i2').tobytes()
+		np.testing.assert_array_equal(toSamples(data), [0.0, 0.5, -1.0])
+		np.testing.assert_array_equal(toSamples(data + data[:2], channels = 2), [0.25, -0.5])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,87 @@
+# Tests for FrameBuffer's output stage against what the driver used to do
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PARTYMODE_MOCK_STRIP', '1')
+
+from mockstrip import PixelStrip
+from leds import *
+
+def driverOutput(colors, brightness, white, gamma = LED_GAMMA):
+	"""Pixels the old way: correctColor() in Python, then brightness and gamma in rpi_ws281x."""
+	correct = correctColor()
+	correct.color_factor_r = (white >> 16) & 0xff
+	correct.color_factor_g = (white >> 8) & 0xff
+	correct.color_factor_b = white & 0xff
+	table = gammaTable(gamma)
+	scale = (brightness & 0xff) + 1
+	output = []
+	for color in colors:
+		color = correct(int(color))
+		output.append((table[(((color >> 16) & 0xff) * scale) >> 8] << 16) | \
+		              (table[(((color >> 8) & 0xff) * scale) >> 8] << 8) | \
+		              table[((color & 0xff) * scale) >> 8])
+	return np.array(output, dtype=np.uint32)
+
+class OutputTableTest(unittest.TestCase):
+	def setUp(self):
+		rng = np.random.default_rng(16)
+		levels = np.arange(256, dtype=np.uint32)
+		# Every level of every channel, plus a spread of mixed colors
+		self.colors = np.concatenate((levels << 16, levels << 8, levels, levels * 0x010101,
+		                              rng.integers(0, 1 << 24, 2048).astype(np.uint32)))
+		self.strip = PixelStrip(len(self.colors), 18, timing = False)
+		self.strip.begin()
+		self.frame = FrameBuffer(self.strip)
+		self.segment = self.frame.addSegment('all', 0, len(self.colors))
+		self.segment.dither = False
+
+	def testBitExact(self):
+		for white in (LED_NO_CORRECTION, LED_PURE_WHITE_CORRECTION, ColorTemperature.Candle):
+			for brightness in (0, 1, 64, 128, 254, 255):
+				self.segment.white = white
+				self.segment.brightness = brightness
+				self.frame.pixels[:] = self.colors
+				self.frame.push()
+				np.testing.assert_array_equal(ledBuffer(self.strip), driverOutput(self.colors, brightness, white),
+				                              "white %06x brightness %d" % (white, brightness))
+
+	def testUncoveredLEDs(self):
+		# LEDs outside every segment get the default table
+		strip = PixelStrip(8, 18, timing = False)
+		strip.begin()
+		frame = FrameBuffer(strip)
+		frame.addSegment('half', 0, 4)
+		frame.pixels[:] = 0x804020
+		frame.push()
+		np.testing.assert_array_equal(ledBuffer(strip)[4:], driverOutput([0x804020] * 4, 255, LED_NO_CORRECTION))
+
+	def testDitherAverages(self):
+		# Each pixel's threshold runs through all 256 values in 256 frames, so
+		# its output averages out to exactly the level with 8 fractional bits
+		self.segment.dither = True
+		self.segment.brightness = 40
+		self.frame.pixels[:] = self.colors
+		total = np.zeros((len(self.colors), 3))
+		for i in range(256):
+			total += unpackRGB(self.frame.output())
+		exact = outputTable(40, LED_NO_CORRECTION, LED_GAMMA, True)
+		expected = np.stack([exact[PIXEL_BYTE_CHANNELS.index(channel)][unpackRGB(self.colors)[:, channel]] / 256.0
+		                     for channel in range(3)], axis = 1)
+		np.testing.assert_array_equal(total / 256, expected)
+
+class OpenStripsTest(unittest.TestCase):
+	def testOnePWMStrip(self):
+		strips = openStrips(((10, 18, 10, 0), (20, 21, 11, 0), (30, 10, 12, 0)))
+		self.assertEqual([strip.numPixels() for strip in strips], [10, 20, 30])
+
+	def testTwoPWMStrips(self):
+		with self.assertRaises(ValueError):
+			openStrips(((10, 18, 10, 0), (10, 13, 11, 1)))
+
+if __name__ == '__main__':
+	unittest.main()
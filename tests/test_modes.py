@@ -0,0 +1,138 @@
+# Tests for the renderers in modes.py, run on the software strip
+
+import os
+import sys
+import time
+import datetime
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PARTYMODE_MOCK_STRIP', '1')
+
+from mockstrip import PixelStrip
+from leds import FrameBuffer
+from modes import *
+from sunsky import SunPositionCache
+from framefile import FrameSequence, record
+
+START = 100.0
+
+class RomanticTest(unittest.TestCase):
+	def setUp(self):
+		strip = PixelStrip(90, 18, timing = False)
+		strip.begin()
+		self.segment = FrameBuffer(strip).addSegment('all', 0, 90)
+
+	def frames(self, steps, seed = 7):
+		"""The frames drawn at each of steps frame periods after START."""
+		renderer = RomanticRenderer(seed)
+		renderer.start(START)
+		frames = []
+		for step in steps:
+			renderer.render(self.segment, START + step * renderer.interval)
+			frames.append(np.array(self.segment.pixels))
+		return frames
+
+	def testDroppedFrames(self):
+		every = self.frames(range(200))
+		some = self.frames(range(0, 200, 7))
+		for frame, step in zip(some, range(0, 200, 7)):
+			np.testing.assert_array_equal(frame, every[step])
+
+	def testLateJoin(self):
+		every = self.frames(range(CANDLESIM_CATCHUP_STEPS + 100))
+		late = self.frames([CANDLESIM_CATCHUP_STEPS + 99])
+		np.testing.assert_array_equal(late[0], every[-1])
+
+	def testSeed(self):
+		self.assertFalse(np.array_equal(self.frames([50], seed = 1)[0], self.frames([50], seed = 2)[0]))
+
+class SkylightTest(unittest.TestCase):
+	# Noon in New York on midsummer's day
+	NOON = datetime.datetime(2024, 6, 21, 16, 0, tzinfo = datetime.timezone.utc).timestamp()
+
+	def setUp(self):
+		self.sun = SunPositionCache(40.78, -73.97)
+
+	def renderAt(self, now, epoch = NOON):
+		strip = PixelStrip(32, 18, timing = False)
+		strip.begin()
+		segment = FrameBuffer(strip).addSegment('all', 0, 32)
+		renderer = SkylightRenderer(self.sun, epoch = epoch)
+		renderer.start(0.0)
+		renderer.render(segment, now)
+		return np.array(segment.pixels)
+
+	def testFrameTime(self):
+		renderer = SkylightRenderer(self.sun, epoch = self.NOON)
+		self.assertEqual(renderer.frameDate(3600.0).timestamp(), self.NOON + 3600.0)
+		# Ten hours on it's the middle of the night
+		day, night = self.renderAt(0.0), self.renderAt(10 * 3600.0)
+		self.assertFalse(np.array_equal(day, night))
+		np.testing.assert_array_equal(night, self.renderAt(10 * 3600.0))
+
+	def testWallClock(self):
+		renderer = SkylightRenderer(self.sun)
+		self.assertAlmostEqual(renderer.frameDate(5.0).timestamp(), time.time(), delta = 1.0)
+		# Frames follow the frame clock, not how long rendering takes...
+		later = 5.0 + MODE_SKYLIGHT_CLOCK_STEP / 2
+		self.assertAlmostEqual(renderer.frameDate(later).timestamp() - renderer.frameDate(5.0).timestamp(), \
+		                       MODE_SKYLIGHT_CLOCK_STEP / 2, places = 3)
+		# ...until the wall clock is set
+		renderer.epoch -= 2 * MODE_SKYLIGHT_CLOCK_STEP
+		self.assertAlmostEqual(renderer.frameDate(5.0).timestamp(), time.time(), delta = 1.0)
+
+	def testRecorded(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'sky.pmf')
+			# An hour a frame, from noon into the night
+			record(SkylightRenderer(self.sun, epoch = self.NOON), path, 32, 12 * 3600.0, 1.0 / 3600)
+			sequence = FrameSequence(path)
+			self.assertFalse(np.array_equal(sequence.frames[0], sequence.frames[10]))
+
+class StreamTest(unittest.TestCase):
+	def setUp(self):
+		strip = PixelStrip(4, 18, timing = False)
+		strip.begin()
+		self.segment = FrameBuffer(strip).addSegment('all', 0, 4)
+		self.stream = StreamRenderer(4)
+
+	def submit(self, level, now):
+		slot = self.stream.acquire()
+		slot[:] = bytes([level]) * len(slot)
+		self.stream.submit(slot, now)
+
+	def testShown(self):
+		self.submit(10, 0.0)
+		self.stream.render(self.segment, 0.0)
+		self.assertEqual(list(self.segment.pixels), [0x0a0a0a] * 4)
+		self.assertEqual(self.stream.stats()['shown'], 1)
+		self.assertIsNone(self.stream.nextFrame(0.0))
+
+	def testDropped(self):
+		# Only the newest of the frames that arrive before a deadline is shown
+		self.submit(10, 0.0)
+		self.submit(20, 0.001)
+		self.stream.render(self.segment, 0.002)
+		self.assertEqual(list(self.segment.pixels), [0x141414] * 4)
+		stats = self.stream.stats()
+		self.assertEqual((stats['received'], stats['shown'], stats['dropped'], stats['late']), (2, 1, 1, 0))
+
+	def testLate(self):
+		self.submit(10, 0.0)
+		self.stream.render(self.segment, 2 * self.stream.interval)
+		self.assertEqual(list(self.segment.pixels), [0] * 4)
+		stats = self.stream.stats()
+		self.assertEqual((stats['shown'], stats['dropped'], stats['late']), (0, 0, 1))
+
+	def testPendingSlotKept(self):
+		# A frame waiting to be shown is never handed out to be overwritten
+		self.submit(10, 0.0)
+		pending = self.stream.pending[0]
+		for i in range(len(self.stream.slots)):
+			self.assertIsNot(self.stream.acquire(), self.stream.views[pending])
+
+if __name__ == '__main__':
+	unittest.main()
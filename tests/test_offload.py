@@ -0,0 +1,57 @@
+# Tests for rendering heavy modes in a worker process
+
+import os
+import sys
+import time
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PARTYMODE_MOCK_STRIP', '1')
+
+from mockstrip import PixelStrip
+from leds import FrameBuffer
+from modes import SkylightRenderer
+from sunsky import SunPositionCache
+from offload import OffloadedRenderer
+import server
+
+# Seconds to wait for a spawned worker to get going
+WORKER_TIMEOUT = 30.0
+
+class OffloadTest(unittest.TestCase):
+	def setUp(self):
+		strip = PixelStrip(16, 18, timing = False)
+		strip.begin()
+		self.frame = FrameBuffer(strip)
+		self.engine = server.AnimationEngine(self.frame, offload = True)
+
+	async def waitFor(self, condition):
+		deadline = time.monotonic() + WORKER_TIMEOUT
+		while not condition():
+			self.assertLess(time.monotonic(), deadline)
+			await asyncio.sleep(0.01)
+
+	async def runEngine(self):
+		task = asyncio.get_running_loop().create_task(self.engine.run())
+		try:
+			self.engine.setRenderer(SkylightRenderer(SunPositionCache(server.LATITUDE, server.LONGITUDE)))
+			renderer = self.engine.renderer()
+			self.assertIsInstance(renderer, OffloadedRenderer)
+			await self.waitFor(lambda: self.frame.frames_rendered > 0)
+
+			# A dead worker leaves the mode drawn on the event loop
+			self.engine.layers[None].worker.process.kill()
+			await self.waitFor(lambda: self.engine.renderer() is renderer.renderer)
+			self.assertIsNone(self.engine.layers[None].worker)
+			rendered = self.frame.frames_rendered
+			await self.waitFor(lambda: self.frame.frames_rendered > rendered)
+		finally:
+			task.cancel()
+			self.engine.close()
+
+	def testWorkerDies(self):
+		asyncio.run(self.runEngine())
+
+if __name__ == '__main__':
+	unittest.main()
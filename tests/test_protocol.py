@@ -0,0 +1,151 @@
+# Tests for the command parser and message encoding in protocol.py
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from protocol import *
+
+# Largest Kelvin value an ACK's STATE can carry
+KELVIN_FIELD_MAX = 0xffff
+
+def parse(*chunks):
+	"""Commands from feeding chunks to one parser in turn."""
+	parser = CommandParser()
+	commands = []
+	for chunk in chunks:
+		commands += parser.feed(chunk)
+	return commands
+
+class LegacyParsingTest(unittest.TestCase):
+	def testModeAndBrightness(self):
+		commands = parse(b'mrbd')
+		self.assertEqual([(c.seq, c.command, c.args, c.error) for c in commands],
+		                 [(None, b'm', (b'r',), None), (None, b'b', (b'd',), None)])
+
+	def testNumbers(self):
+		white, color, ramp = parse(b'w02700c00ff80k020000650000600')
+		self.assertEqual(white.args, (2700,))
+		self.assertEqual(color.args, (0x00ff80,))
+		self.assertEqual(ramp.args, (2000, 6500, 600))
+
+	def testWhiteDefault(self):
+		self.assertEqual(parse(b'w00000')[0].args, (WHITE_DEFAULT,))
+
+	def testNumbersCapped(self):
+		self.assertEqual(parse(b'w99999')[0].args, (LEGACY_NUMBER_MAX,))
+		self.assertEqual(parse(b'k999990000199999')[0].args, (LEGACY_NUMBER_MAX, 1, LEGACY_NUMBER_MAX))
+
+	def testSignsRejected(self):
+		for data in (b'c-00001', b'c+fffff', b'w-2700', b'w 2700', b'k0190006500-0001', b'k01_0006500000600'):
+			command, = parse(data)
+			self.assertIsNotNone(command.error, data)
+			self.assertEqual(command.args, ())
+
+	def testBadArguments(self):
+		mode, color = parse(b'mzcxyzxyz')
+		self.assertIsNotNone(mode.error)
+		self.assertIsNotNone(color.error)
+
+	def testSplitAcrossReads(self):
+		commands = parse(b'w0', b'27', b'00m', b'a')
+		self.assertEqual([(c.command, c.args) for c in commands], [(b'w', (2700,)), (b'm', (b'a',))])
+
+	def testResyncAfterStrayByte(self):
+		commands = parse(b'Zma\x00' + encodeCommand(1, b'm', b'x'))
+		self.assertEqual([(c.command, c.args) for c in commands], [(b'm', (b'a',)), (b'm', (b'x',))])
+
+class FramedParsingTest(unittest.TestCase):
+	def testRoundTrip(self):
+		data = encodeCommand(1, b'm', b'r') + encodeCommand(2, b'b', b'm') + encodeCommand(3, b'w', 4000) + \
+		       encodeCommand(4, b'c', 0x123456) + encodeCommand(5, b'k', 1000, 40000, 65535) + encodeCommand(6, QUERY)
+		commands = parse(data)
+		self.assertEqual([(c.seq, c.command, c.args, c.error) for c in commands], [
+			(1, b'm', (b'r',), None),
+			(2, b'b', (b'm',), None),
+			(3, b'w', (4000,), None),
+			(4, b'c', (0x123456,), None),
+			(5, b'k', (1000, 40000, 65535), None),
+			(6, QUERY, (), None),
+		])
+
+	def testByteAtATime(self):
+		data = encodeCommand(7, b'w', 2900) + b'ma'
+		commands = parse(*[data[i:i + 1] for i in range(len(data))])
+		self.assertEqual([(c.seq, c.command, c.args) for c in commands], [(7, b'w', (2900,)), (None, b'm', (b'a',))])
+
+	def testSegmentAndSchedule(self):
+		command, = parse(encodeCommand(9, b'm', b'x', segment = 'kitchen', at = 1700000000))
+		self.assertEqual((command.seq, command.command, command.args, command.segment, command.at),
+		                 (9, b'm', (b'x',), 'kitchen', 1700000000))
+
+	def testSequenceWraps(self):
+		self.assertEqual(parse(encodeCommand(0x10001, QUERY))[0].seq, 1)
+
+	def testErrorsKeepTheirSequence(self):
+		bad_length = HEADER.pack(MAGIC, VERSION, 3, b'w', 1) + b'\x00'
+		unknown = HEADER.pack(MAGIC, VERSION, 4, b'z', 0)
+		old = HEADER.pack(MAGIC, VERSION + 1, 5, b'm', 1) + b'a'
+		commands = parse(bad_length + unknown + old + encodeCommand(6, b'm', b'a'))
+		self.assertEqual([c.seq for c in commands], [3, 4, 5, 6])
+		self.assertEqual([c.error is None for c in commands], [False, False, False, True])
+
+	def testFrameIntoSlot(self):
+		slots = []
+		def sink():
+			# Like StreamRenderer.acquire(), a writable memoryview
+			slots.append(memoryview(bytearray(6)))
+			return slots[-1]
+		parser = CommandParser(frame_size = 6, frame_sink = sink)
+		data = encodeFrame(1, b'\x01\x02\x03\x04\x05\x06') + encodeCommand(2, QUERY)
+		commands = parser.feed(data[:8]) + parser.feed(data[8:])
+		self.assertEqual([c.command for c in commands], [FRAME, QUERY])
+		self.assertIs(commands[0].args[0], slots[0])
+		self.assertEqual(bytes(slots[0]), b'\x01\x02\x03\x04\x05\x06')
+
+class CoalesceTest(unittest.TestCase):
+	def testLatestPerCategory(self):
+		commands = parse(b'mabmw02700' + encodeCommand(1, b'b', b'd'))
+		to_apply, superseded = coalesce(commands)
+		self.assertEqual([(c.command, c.args) for c in to_apply], [(b'w', (2700,)), (b'b', (b'd',))])
+		self.assertEqual([(c.command, c.args) for c in superseded], [(b'm', (b'a',)), (b'b', (b'm',))])
+
+	def testSegments(self):
+		commands = [Command(1, b'm', (b'a',), None, 'hall'), Command(2, b'm', (b'x',), None, 'kitchen'),
+		            Command(3, b'm', (b'r',), None, 'hall')]
+		to_apply, superseded = coalesce(commands)
+		self.assertEqual([c.seq for c in to_apply], [2, 3])
+		# One for every segment replaces them all
+		to_apply, superseded = coalesce(commands + [Command(4, b'w', (2700,), None)])
+		self.assertEqual([c.seq for c in to_apply], [4])
+
+	def testScheduledAndBadKept(self):
+		commands = [Command(1, b'm', (b'a',), None, None, 1700000000), Command(2, b'm', (b'x',), None),
+		            Command(3, b'm', (), 'bad'), Command(4, b'm', (b'r',), None, None, 1700000001)]
+		to_apply, superseded = coalesce(commands)
+		self.assertEqual([c.seq for c in to_apply], [1, 2, 4])
+		self.assertEqual(superseded, [])
+
+class AckTest(unittest.TestCase):
+	def testRoundTrip(self):
+		for state in ((b'0', b'f', 0, 0), (b'w', b'd', 0xffffff, 65535), (b'c', b'm', 0x123456, KELVIN_FIELD_MAX)):
+			(seq, status, decoded), used = decodeAck(encodeAck(0xffff, ACK_ERROR, state))
+			self.assertEqual((seq, status, decoded), (0xffff, ACK_ERROR, state))
+
+	def testPartial(self):
+		data = encodeAck(1, ACK_APPLIED, (b'r', b'f', 0, 0))
+		self.assertEqual(decodeAck(data[:-1]), (None, 0))
+		self.assertEqual(decodeAck(data)[1], len(data))
+
+	def testOutOfRange(self):
+		with self.assertRaises(struct.error):
+			encodeAck(1, ACK_APPLIED, (b'w', b'f', 0, KELVIN_FIELD_MAX + 1))
+
+	def testReply(self):
+		(seq, command, payload), used = decodeMessage(encodeReply(5, b'{}'))
+		self.assertEqual((seq, command, payload), (5, REPLY, b'{}'))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,170 @@
+# Tests for the timers in scheduler.py and the engine's scheduling, on a fake clock
+
+import os
+import sys
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PARTYMODE_MOCK_STRIP', '1')
+
+from mockstrip import PixelStrip
+from leds import FrameBuffer
+from modes import Renderer
+from scheduler import *
+import server
+
+class FakeClock:
+	def __init__(self):
+		self.now = 0.0
+
+	def __call__(self):
+		return self.now
+
+class RecordingRenderer(Renderer):
+	"""Notes the time of every frame it's asked to draw."""
+	def __init__(self, interval = None):
+		self.interval = interval
+		self.frames = []
+
+	def render(self, frame, now):
+		self.frames.append(now)
+
+class TimersTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+		self.timers = Timers(self.clock)
+
+	def testOrder(self):
+		fired = []
+		for when in (3.0, 1.0, 2.0, 1.0):
+			self.timers.add(when, lambda now, when = when: fired.append(when))
+		self.assertEqual(self.timers.timeout(0.5), 0.5)
+		for callback in self.timers.pop(2.0):
+			callback(2.0)
+		self.assertEqual(fired, [1.0, 1.0, 2.0])
+		self.assertEqual(self.timers.next(), 3.0)
+
+	def testCancel(self):
+		first = self.timers.add(1.0, None)
+		self.timers.add(2.0, lambda now: None)
+		self.timers.cancel(first)
+		self.timers.cancel(None)
+		self.assertEqual(self.timers.next(), 2.0)
+		self.assertEqual(len(self.timers.pop(5.0)), 1)
+		self.assertIsNone(self.timers.timeout(5.0))
+
+	def testShift(self):
+		self.timers.add(1.0, lambda now: None)
+		self.timers.shift(-0.5)
+		self.assertEqual(self.timers.next(), 0.5)
+
+class WallClockTimerTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+		self.timers = Timers(self.clock)
+		self.wall = 1000000.0
+		patcher = unittest.mock.patch('scheduler.time.time', lambda: self.wall)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.fired = []
+
+	def advance(self, seconds, wall = None):
+		# Move both clocks on, or the monotonic one only with the wall clock set to wall
+		self.clock.now += seconds
+		self.wall = self.wall + seconds if wall is None else wall
+		for callback in self.timers.pop(self.clock.now):
+			callback(self.clock.now)
+
+	def testFires(self):
+		WallClockTimer(self.timers, self.wall + 10.0, self.fired.append)
+		self.assertEqual(self.timers.next(), 10.0)
+		self.advance(10.0)
+		self.assertEqual(self.fired, [10.0])
+		self.assertIsNone(self.timers.next())
+
+	def testRechecks(self):
+		WallClockTimer(self.timers, self.wall + 3600.0, self.fired.append)
+		self.assertEqual(self.timers.next(), WALL_CLOCK_RECHECK)
+		self.advance(WALL_CLOCK_RECHECK)
+		self.assertEqual(self.fired, [])
+		self.assertEqual(self.timers.next(), 2 * WALL_CLOCK_RECHECK)
+
+	def testClockStepped(self):
+		# Set forward by NTP: fires at the next check rather than an hour late
+		WallClockTimer(self.timers, self.wall + 3600.0, self.fired.append)
+		self.advance(WALL_CLOCK_RECHECK, wall = self.wall + 3600.0)
+		self.assertEqual(self.fired, [WALL_CLOCK_RECHECK])
+
+	def testCancel(self):
+		timer = WallClockTimer(self.timers, self.wall + 10.0, self.fired.append)
+		timer.cancel()
+		self.advance(10.0)
+		self.assertEqual(self.fired, [])
+
+class EngineTest(unittest.TestCase):
+	def setUp(self):
+		strip = PixelStrip(8, 18, timing = False)
+		strip.begin()
+		self.clock = FakeClock()
+		self.engine = server.AnimationEngine(FrameBuffer(strip), offload = False, clock = self.clock)
+
+	def runAt(self, now):
+		self.clock.now = now
+		return self.engine.runDue()
+
+	def testDrawnOnGrid(self):
+		renderer = RecordingRenderer(0.1)
+		self.engine.setRenderer(renderer)
+		self.assertEqual(self.runAt(0.0), 0.1)
+		self.runAt(0.1)
+		self.runAt(0.2)
+		self.assertEqual(renderer.frames, [0.0, 0.1, 0.2])
+		self.assertEqual(self.engine.frames_dropped, 0)
+
+	def testDropped(self):
+		# Falling behind skips the missed frames instead of drawing them late
+		renderer = RecordingRenderer(0.1)
+		self.engine.setRenderer(renderer)
+		self.runAt(0.0)
+		self.runAt(0.45)
+		self.assertEqual(len(renderer.frames), 2)
+		self.assertAlmostEqual(renderer.frames[1], 0.4)
+		self.assertEqual(self.engine.frames_dropped, 3)
+		self.assertAlmostEqual(self.engine.timers.next(), 0.5)
+
+	def testPreempted(self):
+		old = RecordingRenderer(1.0)
+		new = RecordingRenderer()
+		self.engine.setRenderer(old)
+		self.runAt(0.0)
+		# A new mode is drawn right away, not at the old one's next frame
+		self.clock.now = 0.5
+		self.engine.setRenderer(new)
+		self.runAt(0.5)
+		self.runAt(1.0)
+		self.assertEqual(old.frames, [0.0])
+		self.assertEqual(new.frames, [0.5])
+
+	def testIdle(self):
+		# A mode that never changes leaves nothing to wake up for
+		renderer = RecordingRenderer()
+		self.engine.setRenderer(renderer)
+		self.assertIsNone(self.runAt(0.0))
+		self.assertEqual(renderer.frames, [0.0])
+
+	def testSegments(self):
+		frame = self.engine.frame
+		self.engine.addSegment(frame.addSegment('a', 0, 4))
+		self.engine.addSegment(frame.addSegment('b', 4, 4))
+		fast = RecordingRenderer(0.1)
+		slow = RecordingRenderer(0.25)
+		self.engine.setRenderer(fast, 'a')
+		self.engine.setRenderer(slow, 'b')
+		for step in range(6):
+			self.runAt(step * 0.1)
+		self.assertEqual(len(fast.frames), 6)
+		self.assertEqual(slow.frames, [0.0, 0.25, 0.5])
+
+if __name__ == '__main__':
+	unittest.main()
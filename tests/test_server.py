@@ -0,0 +1,122 @@
+# Tests for LEDServerHandler, run on the software strip
+
+import os
+import sys
+import json
+import time
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PARTYMODE_MOCK_STRIP', '1')
+
+from protocol import *
+from colortemp import KELVIN_MIN, KELVIN_MAX
+import server
+
+def acks(data):
+	"""Every (seq, status, state) ACK in data."""
+	result = []
+	while data:
+		ack, used = decodeAck(data)
+		result.append(ack)
+		data = data[used:]
+	return result
+
+class KelvinRangeTest(unittest.TestCase):
+	def setUp(self):
+		self.state_dir = tempfile.TemporaryDirectory()
+		self.handler = server.LEDServerHandler(os.path.join(self.state_dir.name, 'partymode.state'))
+
+	def tearDown(self):
+		self.state_dir.cleanup()
+
+	def send(self, data):
+		return acks(self.handler.handleCommands(CommandParser().feed(data)))
+
+	def testLegacyWhiteOutOfRange(self):
+		# Used to make every later ACK raise struct.error
+		(seq, status, state), = self.send(b'w99999' + encodeCommand(1, QUERY))
+		self.assertEqual(state[0], b'w')
+		self.assertEqual(state[3], KELVIN_MAX)
+		self.assertEqual(self.handler.segments['all'].command.args, (KELVIN_MAX,))
+
+	def testLegacyRampOutOfRange(self):
+		(seq, status, state), = self.send(b'k000009999999999' + encodeCommand(1, QUERY))
+		self.assertEqual(state[0], b'k')
+		self.assertEqual(state[3], KELVIN_MAX)
+		start, end, duration = self.handler.segments['all'].command.args
+		self.assertEqual((start, end), (KELVIN_MIN, KELVIN_MAX))
+		# What a sync leader sends on has to encode
+		encodeCommand(0, b'k', start, end, duration)
+
+	def testSavedStateInRange(self):
+		self.send(b'w70000')
+		self.handler.saveState()
+		with open(self.handler.state_path) as f:
+			self.assertEqual(json.load(f)['all']['kelvin'], KELVIN_MAX)
+
+	def testRestoredStateClamped(self):
+		with open(self.handler.state_path, 'w') as f:
+			json.dump({'all': {'mode': 'w', 'brightness': 'f', 'color': 0, 'kelvin': 99999}}, f)
+		handler = server.LEDServerHandler(self.handler.state_path)
+		self.assertEqual(handler.state('all')[3], KELVIN_MAX)
+
+class FailedModeTest(unittest.TestCase):
+	def testReplayWithoutFile(self):
+		handler = server.LEDServerHandler()
+		segment = handler.segments['all']
+		handler.handleCommands(CommandParser().feed(b'cffc54d'))
+		before = (segment.start, segment.seed, segment.view.white, handler.frame.output().copy())
+		with tempfile.TemporaryDirectory() as missing:
+			with unittest.mock.patch.object(server, 'REPLAY_PATH', os.path.join(missing, 'replay.pmf')):
+				(seq, status, state), = acks(handler.handleCommands(CommandParser().feed(encodeCommand(1, b'm', b'p'))))
+		self.assertEqual(status, ACK_ERROR)
+		self.assertEqual(state[0], b'c')
+		after = (segment.start, segment.seed, segment.view.white, handler.frame.output())
+		self.assertEqual(before[:3], after[:3])
+		self.assertTrue((before[3] == after[3]).all())
+
+class LatencyTest(unittest.TestCase):
+	def testOnlyChangesTimed(self):
+		handler = server.LEDServerHandler()
+		histograms = handler.engine.instruments.histograms
+		handler.handleCommands(CommandParser().feed(encodeCommand(1, QUERY) + encodeCommand(2, STATS)), time.perf_counter())
+		self.assertEqual([name for name in histograms if name.startswith('command_latency.')], [])
+		handler.handleCommands(CommandParser().feed(encodeCommand(3, b'w', 2700)), time.perf_counter())
+		handler.engine.runDue()
+		self.assertEqual(sum(histograms[name].count for name in histograms if name.startswith('command_latency.')), 1)
+
+class StreamTest(unittest.TestCase):
+	def setUp(self):
+		self.start()
+
+	def start(self, segments = {}):
+		with unittest.mock.patch.object(server, 'LED_SEGMENTS', segments):
+			self.handler = server.LEDServerHandler()
+		self.parser = CommandParser(frame_size = len(self.handler.frame) * 3, frame_sink = self.handler.stream.acquire)
+
+	def send(self, data):
+		self.handler.handleCommands(self.parser.feed(data))
+		self.handler.engine.runDue()
+
+	def testOffThenStream(self):
+		self.send(b'm0')
+		self.send(encodeFrame(1, bytes([200]) * (len(self.handler.frame) * 3)))
+		self.assertEqual(self.handler.stream.shown, 1)
+		self.assertTrue((server.ledBuffer(self.handler.strips[0]) != 0).all())
+
+	def testModeForOneSegment(self):
+		count = len(self.handler.frame)
+		self.start({'a': (0, count // 2), 'b': (count // 2, count - count // 2)})
+		self.send(encodeFrame(1, bytes([200]) * (count * 3)))
+		self.send(encodeCommand(2, b'c', 0x00ff00, segment = 'a'))
+		# The other segment is switched off rather than left on the last streamed frame
+		self.assertEqual((self.handler.state('a')[0], self.handler.state('b')[0]), (b'c', b'0'))
+		output = server.ledBuffer(self.handler.strips[0])
+		self.assertTrue((output[:count // 2] != 0).all())
+		self.assertTrue((output[count // 2:] == 0).all())
+
+if __name__ == '__main__':
+	unittest.main()
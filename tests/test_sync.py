@@ -0,0 +1,67 @@
+# Tests for passing modes from a sync leader to its followers, without the network
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('PARTYMODE_MOCK_STRIP', '1')
+
+from protocol import *
+from sync import *
+import server
+
+class BeaconTest(unittest.TestCase):
+	def setUp(self):
+		self.leader = server.LEDServerHandler()
+		self.follower = server.LEDServerHandler()
+		self.sync = SyncLeader(self.leader)
+		self.following = SyncFollower(self.follower, SyncClock())
+
+	def send(self, handler, data):
+		parser = CommandParser(frame_size = len(handler.frame) * 3, frame_sink = handler.stream.acquire)
+		handler.handleCommands(parser.feed(data))
+
+	def follow(self):
+		"""Send the leader's beacon to the follower; returns its segments."""
+		segments = segmentCommands(self.sync.beacon(self.leader.engine.clock()))
+		self.following.follow(segments)
+		return segments
+
+	def assertFollowed(self):
+		for name, segment in self.leader.segments.items():
+			followed = self.follower.segments[name]
+			self.assertEqual((followed.command, followed.start, followed.seed, followed.mode, followed.brightness),
+			                 (segment.command, segment.start, segment.seed, segment.mode, segment.brightness))
+			self.assertEqual(self.follower.engine.targetBrightness(followed.view), self.leader.engine.targetBrightness(segment.view))
+
+	def testRoundTrip(self):
+		self.send(self.leader, b'mrbd')
+		(name, start, seed, brightness, level, command), = self.follow()
+		segment = self.leader.segments[name]
+		self.assertEqual((command.command, command.args, start, seed, brightness), (b'm', (b'r',), segment.start, segment.seed, b'd'))
+		self.assertFollowed()
+		self.assertEqual(self.follower.segments[name].mode, b'r')
+
+	def testColorsAndRamps(self):
+		for data in (b'cff8000', b'w02700', b'k020000650000600', b'm0'):
+			self.send(self.leader, data)
+			self.follow()
+			self.assertFollowed()
+
+	def testStreamNotPassedOn(self):
+		# Streamed frames only go to the leader; followers switch off
+		self.send(self.follower, b'ma')
+		self.send(self.leader, encodeFrame(1, bytes(len(self.leader.frame) * 3)))
+		(name, start, seed, brightness, level, command), = self.follow()
+		self.assertEqual(self.leader.segments[name].mode, FRAME)
+		self.assertEqual((command.command, command.args), (b'm', (b'0',)))
+		self.assertEqual(self.follower.segments[name].mode, b'0')
+
+	def testBadBeacon(self):
+		beacon = self.sync.beacon(0.0)
+		with self.assertRaises(ProtocolError):
+			segmentCommands(beacon[:-1] + b'z')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,56 @@
+# Tests for the webserver's form handling and its connection to the LED server
+
+import os
+import sys
+import socket
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webserver'))
+
+from webserver import *
+from protocol import CommandParser
+
+class FormTest(unittest.TestCase):
+	def testTime(self):
+		self.assertEqual(parseTime('1700000000'), 1700000000)
+		for value in ('abc', '-5', '1.5', str(1 << 32)):
+			with self.assertRaises(ValueError):
+				parseTime(value)
+
+	def testKelvin(self):
+		self.assertEqual(parseKelvin('white-2700'), 2700)
+		for action in ('white-70000', 'white--1', 'white-warm', 'white'):
+			with self.assertRaises(ValueError):
+				parseKelvin(action)
+
+class LEDInterfaceTest(unittest.TestCase):
+	def setUp(self):
+		self.listener = socket.socket()
+		self.listener.bind((LOCALHOST, 0))
+		self.listener.listen(1)
+		self.listener.settimeout(5)
+
+	def tearDown(self):
+		self.listener.close()
+
+	def received(self, sock, count):
+		"""The first count commands the LED server gets."""
+		parser = CommandParser()
+		commands = []
+		while len(commands) < count:
+			commands += parser.feed(sock.recv(4096))
+		return commands
+
+	def testBadCommandDropped(self):
+		interface = LEDInterface(self.listener.getsockname()[1])
+		sock, addr = self.listener.accept()
+		sock.settimeout(5)
+		with sock:
+			# One that can't be encoded mustn't stop the ones after it
+			interface.send(b'w', 70000)
+			interface.send(b'm', b'a')
+			commands = self.received(sock, 2)
+		self.assertEqual([(c.command, c.args) for c in commands], [(QUERY, ()), (b'm', (b'a',))])
+
+if __name__ == '__main__':
+	unittest.main()
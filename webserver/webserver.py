@@ -1,85 +1,275 @@
 #!/usr/bin/env python3
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import sys
+import time
+import gzip
+import json
+import hashlib
+import queue
+import collections
 import socket
+import struct
+import threading
+
+# Share the LED server's wire protocol
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from protocol import encodeCommand, decodeMessage, decodeAckPayload, ProtocolError, ACK, REPLY, QUERY, STATS, UNSCHEDULE
 
 LOCALHOST = '127.0.0.1'
 HOST_PORT = 8080
 LED_INTERFACE_PORT = 4237
 
+COMMAND_QUEUE_SIZE = 16        # Pending commands kept while the LED server is unreachable
+CONNECT_TIMEOUT = 2.0          # Seconds
+SEND_TIMEOUT = 2.0             # Seconds
+RECONNECT_MIN = 0.1            # Seconds, doubled after every failed attempt...
+RECONNECT_MAX = 5.0            # ...up to this
+CLIENT_TIMEOUT = 30            # Seconds a browser may take to send its request
+STATE_POLL_INTERVAL = 5.0      # Seconds between state queries while idle, to notice other clients
+EVENTS_KEEPALIVE = 15.0        # Seconds between keepalives on an idle event stream
+REQUEST_TIMEOUT = 2.0          # Seconds to wait for the LED server to answer a request
+
+ACTIONS = {
+    'rainbow': (b'm', b'a'),
+    'romantic': (b'm', b'r'),
+    'christmas': (b'm', b'x'),
+    'easter': (b'm', b'e'),
+    'skylight': (b'm', b's'),
+    'audio': (b'm', b'v'),
+    'replay': (b'm', b'p'),
+    'off': (b'm', b'0'),
+    'full': (b'b', b'f'),
+    'medium': (b'b', b'm'),
+    'dim': (b'b', b'd'),
+    'unschedule': (UNSCHEDULE,),
+}
+
+class PendingReply:
+    """ Hand-off between the thread waiting on a request and the reader thread """
+    def __init__(self):
+        self.event = threading.Event()
+        self.payload = None
+
+    def set(self, payload):
+        self.payload = payload
+        self.event.set()
+
+    def wait(self, timeout):
+        self.event.wait(timeout)
+        return self.payload
+
+def parseTime(value):
+    """ A form's Unix time, as the whole seconds a scheduled command carries """
+    try:
+        at = int(value)
+    except ValueError:
+        raise ValueError("Bad time %s" % value)
+    if not 0 <= at <= 0xffffffff:
+        raise ValueError("Time %d is out of range" % at)
+    return at
+
+def parseKelvin(action):
+    """ A white-NNNN action's color temperature, as a white command carries it """
+    try:
+        kelvin = int(action.split('-', 1)[1])
+    except (IndexError, ValueError):
+        raise ValueError("Bad action %s" % action)
+    if not 0 <= kelvin <= 0xffff:
+        raise ValueError("Kelvin %d is out of range" % kelvin)
+    return kelvin
+
 class LEDInterface:
+    """ Managed connection to the LED server.
+
+        Commands go into a bounded queue (when it's full the oldest pending
+        command is dropped) and a background thread sends them, connecting
+        and reconnecting with exponential backoff.  Commands the LED server
+        hasn't acknowledged yet are resent after a reconnect.  Nothing here
+        blocks an HTTP request, and the webserver doesn't care whether the
+        LED server is up yet.
+    """
     def __init__(self, port):
         self.cur_solid_color='ffffff'    # Persistence
-        self.socket = socket.socket()
-        self.socket.connect((LOCALHOST, port))
+        self.port = port
+        self.state = None                # Last state the LED server acknowledged
+        self.connected = False
+        self.sock = None                 # The current connection; older ones' readers may still be winding down
+        self.version = 0                 # Bumped whenever state or connected changes
+        self.changed = threading.Condition()
+        self.queue = queue.Queue(maxsize=COMMAND_QUEUE_SIZE)
+        self.unacked = collections.OrderedDict()
+        self.replies = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='led-interface', daemon=True)
+        self.thread.start()
 
     def do(self, action, data):
-        if action == 'rainbow':
-            self.socket.sendall(b'ma')
-        elif action == 'romantic':
-            self.socket.sendall(b'mr')
-        elif action == 'christmas':
-            self.socket.sendall(b'mx')
-        elif action == 'easter':
-            self.socket.sendall(b'me')
-        elif action == 'full':
-            self.socket.sendall(b'bf')
-        elif action == 'medium':
-            self.socket.sendall(b'bm')
-        elif action == 'dim':
-            self.socket.sendall(b'bd')
-        elif action == 'skylight':
-            self.socket.sendall(b'ms')
-        elif action == 'off':
-            self.socket.sendall(b'm0')
+        # Aimed at every segment unless the form names one, and applied right
+        # away unless it gives a Unix time to apply it at
+        wrap = {'segment': data.get('segment') or None}
+        if data.get('at') and action != 'unschedule':
+            wrap['at'] = parseTime(data['at'])
+        if action in ACTIONS:
+            self.send(*ACTIONS[action], **wrap)
         elif action == 'color':
             self.cur_solid_color = data['color'][-6:]
-            self.socket.sendall(b'c' + bytes(self.cur_solid_color, 'ascii'))
+            self.send(b'c', int(self.cur_solid_color, 16), **wrap)
         elif action.startswith('white'):
-            self.socket.sendall(b'w' + bytes('%05d' % int(action.split('-')[1]), 'ascii'))
+            self.send(b'w', parseKelvin(action), **wrap)
         else:
             print("Skipping unknown action %s" % action)
 
-class Partymode3Server:
-    def __init__(self, led_interface):
-        def handler(*args):
-            Partymode3Handler(led_interface, *args)
-        http_server = HTTPServer(('', HOST_PORT), handler)
+    def _setState(self, state, connected):
+        with self.changed:
+            if (state, connected) != (self.state, self.connected):
+                self.state = state
+                self.connected = connected
+                self.version += 1
+                self.changed.notify_all()
+
+    def stateDict(self):
+        with self.changed:
+            state, connected = self.state, self.connected
+        if state is None:
+            return {'connected': connected}
+        mode, brightness, color, kelvin = state
+        return {
+            'connected': connected,
+            'mode': mode.decode('ascii'),
+            'brightness': brightness.decode('ascii'),
+            'color': '%06x' % color,
+            'kelvin': kelvin,
+        }
+
+    def waitForChange(self, version, timeout):
+        """ Wait until the state moves past version; returns (version, state dict) """
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            version = self.version
+        return version, self.stateDict()
+
+    def send(self, command, *args, **wrap):
+        """ Queue a command; wrap holds encodeCommand()'s segment and at """
+        self._enqueue((command, args, wrap, None))
+
+    def request(self, command, *args, timeout=REQUEST_TIMEOUT):
+        """ Send a command and wait for its REPLY; returns the payload, or None on timeout """
+        reply = PendingReply()
+        self._enqueue((command, args, {}, reply))
+        return reply.wait(timeout)
+
+    def _enqueue(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _connect(self):
+        backoff = RECONNECT_MIN
+        while True:
+            try:
+                sock = socket.create_connection((LOCALHOST, self.port), timeout=CONNECT_TIMEOUT)
+            except OSError:
+                time.sleep(backoff)
+                backoff = min(2 * backoff, RECONNECT_MAX)
+                continue
+            sock.settimeout(SEND_TIMEOUT)
+            with self.lock:
+                self.sock = sock
+            self._setState(self.state, True)
+            threading.Thread(target=self._readAcks, args=(sock,), name='led-acks', daemon=True).start()
+            return sock
+
+    def _readAcks(self, sock):
+        data = b''
         try:
-            http_server.serve_forever()
-        except KeyboardInterrupt:
-            http_server.server_close()
+            while True:
+                try:
+                    chunk = sock.recv(4096)
+                except socket.timeout:
+                    continue
+                if not chunk:
+                    break
+                data += chunk
+                while True:
+                    message, used = decodeMessage(data)
+                    if message is None:
+                        break
+                    data = data[used:]
+                    seq, command, payload = message
+                    with self.lock:
+                        self.unacked.pop(seq, None)
+                        reply = self.replies.pop(seq, None)
+                    if command == ACK:
+                        status, state = decodeAckPayload(payload)
+                        self._setState(state, True)
+                    elif command == REPLY and reply is not None:
+                        reply.set(payload)
+        except (OSError, ProtocolError):
+            pass
+        # Tell the sender to reconnect, unless it already has
+        with self.lock:
+            current = sock is self.sock
+        if current:
+            self._setState(self.state, False)
 
-class Partymode3Handler(BaseHTTPRequestHandler):
-    """ A special implementation of BaseHTTPRequestHandler for
-        controlling PartyMode3 LED strips
-    """
-    def __init__(self, led_interface, *args):
-        self.led_interface = led_interface
-        BaseHTTPRequestHandler.__init__(self, *args)
+    def _run(self):
+        sock = None
+        seq = 0
+        resend = []
+        while True:
+            if sock is not None and not self.connected:
+                sock.close()
+                sock = None
+            if sock is None:
+                sock = self._connect()
+                # Anything sent on the old connection but never acknowledged may have been lost
+                with self.lock:
+                    resend = list(self.unacked.values())
+                    self.unacked.clear()
+                    self.replies.clear()
+                resend.append((QUERY, (), {}, None))
 
-    def do_HEAD(self):
-        """ do_HEAD() can be tested use curl command 
-            'curl -I http://server-ip-address:port' 
-        """
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
+            if resend:
+                item = resend.pop(0)
+            else:
+                try:
+                    item = self.queue.get(timeout=STATE_POLL_INTERVAL)
+                except queue.Empty:
+                    # Pick up changes made by other clients
+                    item = (QUERY, (), {}, None)
+            command, args, wrap, reply = item
+            try:
+                data = encodeCommand(seq, command, *args, **wrap)
+            except (struct.error, ProtocolError) as e:
+                # Don't let one bad command stop the sender
+                print("Dropping command %s%s: %s" % (command, args, e))
+                if reply is not None:
+                    reply.set(None)
+                continue
 
-    def _redirect(self, path):
-        self.send_response(303)
-        self.send_header('Content-type', 'text/html')
-        self.send_header('Location', path)
-        self.end_headers()
+            with self.lock:
+                self.unacked[seq] = item
+                while len(self.unacked) > COMMAND_QUEUE_SIZE:
+                    self.unacked.popitem(last=False)
+                if reply is not None:
+                    self.replies[seq] = reply
+            try:
+                sock.sendall(data)
+            except OSError:
+                # Still in unacked, so it goes out again once we're reconnected
+                self._setState(self.state, False)
+            seq = (seq + 1) & 0xffff
 
-    def do_GET(self):
-        """ do_GET() can be tested using curl command 
-            'curl http://server-ip-address:port' 
-        """
-        if self.path != '/':
-            html = ''
-        else:
-            html = '''
+# The control page never changes, so it's compressed and tagged once
+PAGE_HTML = '''
 <html lang="en">
 	<head>
 		<meta name="viewport" content="width=device-width, initial-scale=1">
@@ -89,7 +279,7 @@ class Partymode3Handler(BaseHTTPRequestHandler):
 	</head>
 	<body class="text-center">
 		<h1>PartyMode 3.0</h1>
-		<form action="/" method="POST" class="container">
+		<form action="/" method="POST" class="container" id="controls">
 			<div class="row pb-3">
 				<div class="col">
 					<button class="btn btn-lg btn-danger" type="submit" name="action" value="off">Off</button>
@@ -100,7 +290,7 @@ class Partymode3Handler(BaseHTTPRequestHandler):
 			</div>
 			<div class="row pb-3">
 				<div class="col">
-					<input class="btn btn-lg btn-secondary" type="color" name="color" value="#{0}" onchange="document.getElementById('change-color').click();" />
+					<input class="btn btn-lg btn-secondary" type="color" name="color" value="#ffffff" onchange="document.getElementById('change-color').click();" />
 					<button class="d-none" type="submit" name="action" id="change-color" value="color">Set Solid Color</button>
 					<button class="btn btn-lg btn-secondary" type="submit" name="action" value="rainbow">Rainbow</button>
 					<button class="btn btn-lg btn-secondary" type="submit" name="action" value="romantic">Romantic</button>
@@ -123,11 +313,133 @@ class Partymode3Handler(BaseHTTPRequestHandler):
 				</div>
 			</div>
 		</form>
+		<script>
+			// Post controls in the background and follow the LED server's state
+			// over server-sent events, instead of reloading the page.
+			const form = document.getElementById('controls');
+			const modes = {a: 'rainbow', r: 'romantic', x: 'christmas', e: 'easter', s: 'skylight', '0': 'off'};
+			const brightnesses = {f: 'full', m: 'medium', d: 'dim'};
+
+			form.addEventListener('submit', (event) => {
+				event.preventDefault();
+				const action = event.submitter ? event.submitter.value : 'color';
+				const body = new URLSearchParams({action: action, color: form.elements.color.value});
+				fetch('/', {method: 'POST', body: body, headers: {'Accept': 'application/json'}});
+			});
+
+			function show(state) {
+				const active = [modes[state.mode], brightnesses[state.brightness], 'white-' + state.kelvin];
+				form.elements.color.value = '#' + state.color;
+				for (const button of form.querySelectorAll('button')) {
+					button.classList.toggle('active', active.includes(button.value));
+				}
+				document.body.classList.toggle('opacity-50', !state.connected);
+			}
+
+			fetch('/state').then((response) => response.json()).then(show);
+			new EventSource('/events').onmessage = (event) => show(JSON.parse(event.data));
+		</script>
 	</body>
 </html>
-            '''.format(self.led_interface.cur_solid_color)
-        self.do_HEAD()
-        self.wfile.write(html.encode("utf-8"))
+'''.encode('utf-8')
+PAGE_GZIP = gzip.compress(PAGE_HTML)
+PAGE_ETAG = '"%s"' % hashlib.sha1(PAGE_HTML).hexdigest()
+
+class Partymode3Server:
+    def __init__(self, led_interface):
+        def handler(*args):
+            Partymode3Handler(led_interface, *args)
+        http_server = ThreadingHTTPServer(('', HOST_PORT), handler)
+        http_server.daemon_threads = True
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            http_server.server_close()
+
+class Partymode3Handler(BaseHTTPRequestHandler):
+    """ A special implementation of BaseHTTPRequestHandler for
+        controlling PartyMode3 LED strips
+    """
+    timeout = CLIENT_TIMEOUT
+
+    def __init__(self, led_interface, *args):
+        self.led_interface = led_interface
+        BaseHTTPRequestHandler.__init__(self, *args)
+
+    def do_HEAD(self):
+        """ do_HEAD() can be tested use curl command 
+            'curl -I http://server-ip-address:port' 
+        """
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        self.end_headers()
+
+    def _redirect(self, path):
+        self.send_response(303)
+        self.send_header('Content-type', 'text/html')
+        self.send_header('Location', path)
+        self.end_headers()
+
+    def _sendBody(self, content_type, body, headers={}):
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _sendPage(self):
+        headers = {'ETag': PAGE_ETAG, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if PAGE_ETAG in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+        elif 'gzip' in self.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            self._sendBody('text/html', PAGE_GZIP, headers)
+        else:
+            self._sendBody('text/html', PAGE_HTML, headers)
+
+    def _sendEvents(self):
+        """ Server-sent events: the state once on connect, then once per change """
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        version = None
+        try:
+            while True:
+                new_version, state = self.led_interface.waitForChange(version, EVENTS_KEEPALIVE)
+                if new_version == version:
+                    self.wfile.write(b': keepalive\n\n')
+                else:
+                    version = new_version
+                    self.wfile.write(b'data: ' + json.dumps(state).encode('utf-8') + b'\n\n')
+                self.wfile.flush()
+        except OSError:
+            pass    # Client went away
+
+    def do_GET(self):
+        """ do_GET() can be tested using curl command 
+            'curl http://server-ip-address:port' 
+        """
+        if self.path == '/':
+            self._sendPage()
+        elif self.path == '/state':
+            self._sendBody('application/json', json.dumps(self.led_interface.stateDict()).encode('utf-8'), \
+                           {'Cache-Control': 'no-cache'})
+        elif self.path == '/events':
+            self._sendEvents()
+        elif self.path == '/stats':
+            stats = self.led_interface.request(STATS)
+            if stats is None:
+                self.send_error(504, 'LED server did not answer')
+            else:
+                self._sendBody('application/json', stats, {'Cache-Control': 'no-cache'})
+        else:
+            self.send_error(404)
 
     def do_POST(self):
         """ do_POST() can be tested using curl command 
@@ -137,9 +449,18 @@ class Partymode3Handler(BaseHTTPRequestHandler):
         post_data = self.rfile.read(content_length).decode("utf-8")   # Get the data
         post_data = {k: v for k, v in [row.split('=') for row in post_data.split('&')]}
         if 'action' in post_data:
-            self.led_interface.do(post_data['action'], post_data)
-        
-        self._redirect('/')    # Redirect back to the root url
+            try:
+                self.led_interface.do(post_data['action'], post_data)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+
+        if 'application/json' in self.headers.get('Accept', ''):
+            # fetch() from the page: the new state arrives over /events
+            self.send_response(204)
+            self.end_headers()
+        else:
+            self._redirect('/')    # Redirect back to the root url
 
 def main():
     Partymode3Server(LEDInterface(LED_INTERFACE_PORT))